@@ -1,13 +1,40 @@
 import os
-
-from flask import Flask, flash, redirect, render_template, request, session
+import enum
+import json
+import time
+import random
+import click
+import hashlib
+import logging
+import signal
+import tempfile
+import threading
+
+from collections import Counter
+from contextvars import ContextVar
+from flask import Flask, flash, g, redirect, render_template, request, send_file, session, stream_template, stream_with_context
+from flask.cli import AppGroup
+from flask.sessions import SecureCookieSessionInterface
 from flask_sqlalchemy import SQLAlchemy
 from flask_session import Session
+from cachelib import FileSystemCache, NullCache
 from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime, date
-from sqlalchemy import func, extract
-
-from helper import apology, login_required, lookup
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from sqlalchemy import bindparam, cast, event, func, and_, or_, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+
+from helper import apology, login_required, fetch_movie, fetch_movies, parse_boxoffice, LRUCache, OmdbUnavailable, encode_cursor, decode_cursor
+from helper import DatabaseCache, DatabaseSessionInterface, PeriodicTask, RateLimiter, omdb
+from stats_engine import StatsSummary, build_cards, differences, NO_HISTORY, NO_WISHLIST
+from importer import Rejected, batched, detect_format, normalize, read_records
+from exporter import ExportUnavailable, FORMATS, HISTORY_COLUMNS, WISHLIST_COLUMNS, byte_range, encode
+from posters import PosterCache, PosterUnavailable
+from search_index import PrefixIndex, rank, trigrams
+from metrics import COUNT_BUCKETS, Registry, RequestStats
+from recommender import Recommender, RecommenderUnavailable
+from timeseries import PERIODS, series, streaks
 
 # Configure application
 app = Flask(__name__)
@@ -15,10 +42,18 @@ app = Flask(__name__)
 # Ensure templates are auto-reloaded
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-# Configure session to use filesystem (instead of signed cookies)
+# Sessions, SESSION_BACKEND picks where they are kept:
+# - "filesystem" (default): files in flask_session/, local to one host
+# - "sqlalchemy": the sessions table, shared by every worker on every host
+# - "cookie": signed cookies (the session only holds user_id), needs SECRET_KEY
+# Expired sessions are swept every SESSION_SWEEP_INTERVAL seconds (0 disables),
+# browser sessions expire after SESSION_IDLE_TIMEOUT seconds without a request
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+app.config["SESSION_BACKEND"] = os.environ.get("SESSION_BACKEND", "filesystem")
+app.config["SESSION_IDLE_TIMEOUT"] = int(os.environ.get("SESSION_IDLE_TIMEOUT", 7 * 24 * 3600))
+app.config["SESSION_SWEEP_INTERVAL"] = int(os.environ.get("SESSION_SWEEP_INTERVAL", 3600))
+if os.environ.get("SECRET_KEY"):
+    app.secret_key = os.environ["SECRET_KEY"]
 
 # v1: Configure SQLlite DB
 # app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///movies_sqlite.db" 
@@ -26,6 +61,104 @@ Session(app)
 # v2: Config for Heroku
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ['POSTGRESQL_URL']
 
+# OMDb lookup cache (seconds): entries live in the shared omdb_cache table for
+# OMDB_CACHE_TTL ("not found" answers for OMDB_NEGATIVE_CACHE_TTL), and each
+# worker keeps a small LRU in front of it for OMDB_MEMORY_CACHE_TTL
+app.config["OMDB_CACHE_TTL"] = int(os.environ.get("OMDB_CACHE_TTL", 7 * 24 * 3600))
+app.config["OMDB_NEGATIVE_CACHE_TTL"] = int(os.environ.get("OMDB_NEGATIVE_CACHE_TTL", 3600))
+app.config["OMDB_MEMORY_CACHE_TTL"] = int(os.environ.get("OMDB_MEMORY_CACHE_TTL", 300))
+app.config["OMDB_MEMORY_CACHE_SIZE"] = int(os.environ.get("OMDB_MEMORY_CACHE_SIZE", 512))
+
+# Watch history is shown HISTORY_PAGE_SIZE rows at a time (?page_size= can ask
+# for up to HISTORY_MAX_PAGE_SIZE); HISTORY_STREAM=1 streams the full history instead
+app.config["HISTORY_PAGE_SIZE"] = int(os.environ.get("HISTORY_PAGE_SIZE", 50))
+app.config["HISTORY_MAX_PAGE_SIZE"] = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 500))
+app.config["HISTORY_STREAM"] = os.environ.get("HISTORY_STREAM") == "1"
+
+# Bulk import: rows are written IMPORT_BATCH_SIZE at a time, unknown titles are
+# looked up with at most IMPORT_OMDB_WORKERS concurrent OMDb calls
+app.config["IMPORT_BATCH_SIZE"] = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+app.config["IMPORT_OMDB_WORKERS"] = int(os.environ.get("IMPORT_OMDB_WORKERS", 4))
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("IMPORT_MAX_UPLOAD_MB", 50)) * 1024 * 1024
+
+# Exports are read from the database and written to the response EXPORT_CHUNK_ROWS rows at a time
+app.config["EXPORT_CHUNK_ROWS"] = int(os.environ.get("EXPORT_CHUNK_ROWS", 1000))
+
+# Movies added from /search are checked against OMDb (and get their poster) by
+# the enrichment worker: ENRICH_WORKERS threads per worker process, at most
+# ENRICH_OMDB_RATE OMDb calls per second per process. A failed job is retried
+# after ENRICH_RETRY_BASE * 2^(attempts - 1) seconds, up to ENRICH_MAX_ATTEMPTS
+# times, then left as "dead". A job running longer than ENRICH_JOB_TIMEOUT is
+# assumed to belong to a crashed worker and picked up again.
+app.config["ENRICH_WORKERS"] = int(os.environ.get("ENRICH_WORKERS", 2))
+app.config["ENRICH_OMDB_RATE"] = float(os.environ.get("ENRICH_OMDB_RATE", 2))
+app.config["ENRICH_MAX_ATTEMPTS"] = int(os.environ.get("ENRICH_MAX_ATTEMPTS", 5))
+app.config["ENRICH_RETRY_BASE"] = int(os.environ.get("ENRICH_RETRY_BASE", 30))
+app.config["ENRICH_JOB_TIMEOUT"] = int(os.environ.get("ENRICH_JOB_TIMEOUT", 300))
+app.config["ENRICH_POLL_INTERVAL"] = float(os.environ.get("ENRICH_POLL_INTERVAL", 2))
+
+# Posters are served through /poster from a local cache in POSTER_CACHE_DIR,
+# resized to one of POSTER_WIDTHS (pixels); the poster wall uses POSTER_WALL_WIDTH
+app.config["POSTER_CACHE_DIR"] = os.environ.get("POSTER_CACHE_DIR", os.path.join(app.instance_path, "poster_cache"))
+app.config["POSTER_WIDTHS"] = [int(width) for width in os.environ.get("POSTER_WIDTHS", "100,200,300,600").split(",")]
+app.config["POSTER_WALL_WIDTH"] = int(os.environ.get("POSTER_WALL_WIDTH", 200))
+app.config["POSTER_WALL_PAGE_SIZE"] = int(os.environ.get("POSTER_WALL_PAGE_SIZE", 60))
+
+# /search looks titles up in our own movies table first and only asks OMDb when
+# nothing matches: the SEARCH_CANDIDATES titles sharing the most trigrams with
+# the query are ranked, and the best SEARCH_MAX_RESULTS shown
+app.config["SEARCH_CANDIDATES"] = int(os.environ.get("SEARCH_CANDIDATES", 200))
+app.config["SEARCH_MAX_RESULTS"] = int(os.environ.get("SEARCH_MAX_RESULTS", 20))
+
+# Autocomplete of the search box: AUTOCOMPLETE_LIMIT titles out of the first
+# AUTOCOMPLETE_CANDIDATES matching the prefix, from an in-memory index checked
+# against the movies table every AUTOCOMPLETE_REFRESH_INTERVAL seconds
+app.config["AUTOCOMPLETE_LIMIT"] = int(os.environ.get("AUTOCOMPLETE_LIMIT", 10))
+app.config["AUTOCOMPLETE_CANDIDATES"] = int(os.environ.get("AUTOCOMPLETE_CANDIDATES", 200))
+app.config["AUTOCOMPLETE_REFRESH_INTERVAL"] = int(os.environ.get("AUTOCOMPLETE_REFRESH_INTERVAL", 30))
+
+# The rendered stats dashboard is cached per user in STATS_CACHE_BACKEND:
+# "memory" (an LRU of STATS_CACHE_SIZE users in each worker), "filesystem"
+# (STATS_CACHE_DIR), "database" (the response_cache table) or "none". Entries
+# live STATS_CACHE_TTL seconds; a user's data version is cached for
+# STATS_CACHE_VERSION_TTL seconds, which with "memory" and several workers is
+# how long another worker may show a dashboard from before the user's last change
+app.config["STATS_CACHE_BACKEND"] = os.environ.get("STATS_CACHE_BACKEND", "memory")
+app.config["STATS_CACHE_SIZE"] = int(os.environ.get("STATS_CACHE_SIZE", 1000))
+app.config["STATS_CACHE_DIR"] = os.environ.get("STATS_CACHE_DIR", os.path.join(app.instance_path, "stats_cache"))
+app.config["STATS_CACHE_TTL"] = int(os.environ.get("STATS_CACHE_TTL", 24 * 3600))
+app.config["STATS_CACHE_VERSION_TTL"] = int(os.environ.get("STATS_CACHE_VERSION_TTL", 60))
+
+# /stats/top lists at most STATS_TOP_MAX_K ranks
+app.config["STATS_TOP_MAX_K"] = int(os.environ.get("STATS_TOP_MAX_K", 100))
+
+# The dashboard's "Over Time" section charts the last TIMELINE_MONTHS months of the watch history
+app.config["TIMELINE_MONTHS"] = int(os.environ.get("TIMELINE_MONTHS", 12))
+
+# "Watch next" recommendations (recommender.py, needs numpy and scipy): every
+# movie keeps its RECOMMEND_NEIGHBORS most similar movies, genres and directors
+# making up RECOMMEND_CONTENT_WEIGHT of the similarity. Each worker folds new
+# watches in every RECOMMEND_UPDATE_INTERVAL seconds and refits on the whole
+# watch history every RECOMMEND_REFIT_INTERVAL seconds (0 disables either).
+# /recommendations lists at most RECOMMEND_MAX_N movies
+app.config["RECOMMEND_NEIGHBORS"] = int(os.environ.get("RECOMMEND_NEIGHBORS", 50))
+app.config["RECOMMEND_CONTENT_WEIGHT"] = float(os.environ.get("RECOMMEND_CONTENT_WEIGHT", 0.3))
+app.config["RECOMMEND_UPDATE_INTERVAL"] = int(os.environ.get("RECOMMEND_UPDATE_INTERVAL", 60))
+app.config["RECOMMEND_REFIT_INTERVAL"] = int(os.environ.get("RECOMMEND_REFIT_INTERVAL", 6 * 3600))
+app.config["RECOMMEND_MAX_N"] = int(os.environ.get("RECOMMEND_MAX_N", 50))
+
+# Migrations that rewrite whole tables copy about MIGRATION_BATCH_SIZE rows per
+# transaction, so the app keeps working on the old tables meanwhile
+app.config["MIGRATION_BATCH_SIZE"] = int(os.environ.get("MIGRATION_BATCH_SIZE", 10000))
+
+# Instrumentation: every request is timed into the histograms of /metrics, and
+# INSTRUMENT_SAMPLE_RATE of them (0 to 1, 0 turns it off) also record their SQL
+# statements and OMDb calls, sent back in a Server-Timing header and logged as
+# JSON by the "instrumentation" logger. METRICS_TOKEN, if set, is the bearer
+# token /metrics asks for.
+app.config["INSTRUMENT_SAMPLE_RATE"] = float(os.environ.get("INSTRUMENT_SAMPLE_RATE", 0))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
 db = SQLAlchemy(app)
 
 # Create Model
@@ -33,32 +166,130 @@ class Users(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(200), nullable=False, unique=True)
     password = db.Column(db.String(200), nullable=False)
+    # bumped by every change to the user's history or wishlist, see bump_data_version();
+    # names the version of their dashboards and exports
+    data_version = db.Column(db.Integer, nullable=False, default=0)
     #email = db.Column(db.String(200), nullable=False, unique=True)
     #date_added = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Movies(db.Model):
-    movie_id = db.Column(db.String(200), primary_key=True)
+    __table_args__ = (
+        # every add looks the movie up by title; titles aren't unique, remakes share them
+        db.Index("ix_movies_title", "title"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    # OMDb's imdbID, NULL for movies added before it was kept or never found on OMDb
+    imdb_id = db.Column(db.String(20), unique=True)
     year = db.Column(db.Integer)
     genre = db.Column(db.String(200))
     director = db.Column(db.String(200))
     language = db.Column(db.String(200))
     poster_url = db.Column(db.String(300))
 
+# Genres, directors and languages of a movie, one row per name (OMDb joins
+# several with ", " in a single string), so they can be grouped and filtered on
+class Tags(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint("kind", "name"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # one of TAG_KINDS
+    kind = db.Column(db.String(20), nullable=False)
+    name = db.Column(db.String(200), nullable=False)
+
+class Movie_tags(db.Model):
+    __table_args__ = (
+        db.Index("ix_movie_tags_tag", "tag_id", "movie_id"),
+    )
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.id"), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey("tags.id"), primary_key=True)
+
+# Trigrams of each movie title (search_index.trigrams), the index of the local
+# search; the primary key doubles as the trigram -> movies lookup
+class Title_trigrams(db.Model):
+    trigram = db.Column(db.String(3), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.id"), primary_key=True)
+
 class Watch_history(db.Model):
+    __table_args__ = (
+        # every hot query is "this user's watches by date": history pages, the
+        # poster wall, year counts and the most recent watch
+        db.Index("ix_watch_history_user_date", "user_id", "watch_date", "movie_id"),
+        db.Index("ix_watch_history_user_boxoffice", "user_id", "boxoffice_amount"),
+        # top_k(): a user's best ratings are the first entries of their slice
+        db.Index("ix_watch_history_user_personal_rating", "user_id", db.text("personal_rating DESC")),
+        db.Index("ix_watch_history_user_imdb_rating", "user_id", db.text("imdb_rating DESC")),
+    )
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
-    movie_id = db.Column(db.String(200), db.ForeignKey("movies.movie_id"), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.id"), primary_key=True)
     watch_date = db.Column(db.Date, primary_key=True)
     personal_rating = db.Column(db.Float)
     comments = db.Column(db.Text())
     imdb_rating = db.Column(db.Float)
     boxoffice = db.Column(db.String(200))
+    # boxoffice in dollars, parsed once on write; NULL when OMDb had no figure
+    boxoffice_amount = db.Column(db.BigInteger)
 
 class Wishlist(db.Model):
+    __table_args__ = (
+        db.Index("ix_wishlist_user_boxoffice", "user_id", "boxoffice_amount"),
+        db.Index("ix_wishlist_user_imdb_rating", "user_id", db.text("imdb_rating DESC")),
+    )
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
-    movie_id = db.Column(db.String(200), db.ForeignKey("movies.movie_id"), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.id"), primary_key=True)
     comments = db.Column(db.Text())
     imdb_rating = db.Column(db.Float)
     boxoffice = db.Column(db.String(200))
+    boxoffice_amount = db.Column(db.BigInteger)
+
+class User_stats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    # JSON of StatsSummary.to_dict(), kept current by every write path
+    summary = db.Column(db.Text(), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class Sessions(db.Model):
+    # server-side sessions of the "sqlalchemy" SESSION_BACKEND
+    __table_args__ = (
+        db.Index("ix_sessions_expires_at", "expires_at"),
+    )
+    session_id = db.Column(db.String(64), primary_key=True)
+    # Flask's tagged JSON of the session dict
+    data = db.Column(db.Text(), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class Response_cache(db.Model):
+    # cached responses of the "database" STATS_CACHE_BACKEND, value is JSON
+    key = db.Column(db.String(200), primary_key=True)
+    value = db.Column(db.Text(), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class Enrichment_jobs(db.Model):
+    __table_args__ = (
+        # how the worker finds the next job
+        db.Index("ix_enrichment_jobs_status_run_after", "status", "run_after"),
+        db.Index("ix_enrichment_jobs_movie", "movie_id"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey("movies.id"), nullable=False)
+    # queued -> running -> done, or back to queued for a retry, or dead after the last attempt
+    status = db.Column(db.String(20), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text())
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class Omdb_cache(db.Model):
+    # normalized search title, see cache_key()
+    title = db.Column(db.String(200), primary_key=True)
+    # JSON of the fetch_movie() result, NULL when OMDb doesn't know the title
+    payload = db.Column(db.Text())
+    fetched_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
 
 # v1: SQLlite DB create tables
 # with app.app_context():
@@ -68,6 +299,850 @@ class Wishlist(db.Model):
 if not os.environ.get("API_KEY"):
     raise RuntimeError("API_KEY not set")
 
+def make_session_interface(backend):
+    if backend == "filesystem":
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config.setdefault("SESSION_FILE_DIR", os.path.join(os.getcwd(), "flask_session"))
+        Session(app)
+        return app.session_interface
+    elif backend == "sqlalchemy":
+        return DatabaseSessionInterface(Sessions.__table__, lambda: db.engine,
+                                        idle_timeout=timedelta(seconds=app.config["SESSION_IDLE_TIMEOUT"]))
+    elif backend == "cookie":
+        if not app.secret_key:
+            raise RuntimeError("SECRET_KEY not set, the cookie session backend signs sessions with it")
+        return SecureCookieSessionInterface()
+    raise RuntimeError(f"Unknown SESSION_BACKEND {backend!r}")
+
+app.session_interface = make_session_interface(app.config["SESSION_BACKEND"])
+
+def sweep_sessions():
+    """Delete expired sessions of the configured backend, return how many."""
+    backend = app.config["SESSION_BACKEND"]
+    idle_timeout = app.config["SESSION_IDLE_TIMEOUT"]
+    swept = 0
+    if backend == "sqlalchemy":
+        with app.app_context():
+            # in batches, so the sweep never holds locks on the whole table
+            batch = db.session.query(Sessions.session_id).filter(
+                Sessions.expires_at <= datetime.utcnow()
+            ).limit(1000)
+            while True:
+                deleted = Sessions.query.filter(Sessions.session_id.in_(batch.scalar_subquery())).delete(
+                    synchronize_session=False)
+                db.session.commit()
+                swept += deleted
+                if deleted < 1000:
+                    break
+    elif backend == "filesystem":
+        # the session files are rewritten on every request, so an old mtime means an idle session
+        directory = app.config["SESSION_FILE_DIR"]
+        cutoff = time.time() - max(idle_timeout, app.permanent_session_lifetime.total_seconds())
+        for entry in os.scandir(directory):
+            try:
+                # __wz_cache_count is cachelib's own bookkeeping file
+                if entry.is_file() and entry.name != "__wz_cache_count" and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    swept += 1
+            except FileNotFoundError:
+                pass
+    return swept
+
+session_sweeper = PeriodicTask(sweep_sessions, app.config["SESSION_SWEEP_INTERVAL"])
+
+@app.before_request
+def start_session_sweeper():
+    if app.config["SESSION_BACKEND"] != "cookie":
+        session_sweeper.start()
+
+@app.cli.command("sweep-sessions")
+def sweep_sessions_command():
+    """Delete expired server-side sessions."""
+    click.echo(f"Swept {sweep_sessions()} expired sessions")
+
+# Request instrumentation
+request_stats = ContextVar("request_stats", default=None)
+instrumentation_logger = logging.getLogger("instrumentation")
+metrics_registry = Registry()
+request_duration = metrics_registry.histogram(
+    "http_request_duration_seconds", "Time spent handling requests.", ("route", "method"))
+requests_handled = metrics_registry.counter(
+    "http_requests_total", "Requests handled.", ("route", "method", "status"))
+request_queries = metrics_registry.histogram(
+    "db_queries_per_request", "SQL statements run by sampled requests.", ("route",), COUNT_BUCKETS)
+request_db_time = metrics_registry.histogram(
+    "db_seconds_per_request", "Time sampled requests spent running SQL.", ("route",))
+request_omdb_calls = metrics_registry.histogram(
+    "omdb_calls_per_request", "OMDb calls made by sampled requests.", ("route",), COUNT_BUCKETS)
+metrics_registry.collected(
+    "omdb_client", "Calls, errors and latency of this worker's OMDb client.",
+    lambda: {key: value for key, value in omdb.metrics().items() if isinstance(value, (int, float))})
+metrics_registry.collected(
+    "omdb_lookup_cache_total", "OMDb lookups by where the answer came from.",
+    lambda: dict(lookup_cache_stats), kind="counter")
+
+def record_query_start(conn, cursor, statement, parameters, context, executemany):
+    if request_stats.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def record_query_end(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats.get()
+    if stats is not None and conn.info.get("query_started"):
+        stats.add_query(statement, time.perf_counter() - conn.info["query_started"].pop())
+
+def record_omdb_call(seconds):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.add_omdb_call(seconds)
+
+# with sampling off nothing listens to each statement at all
+if app.config["INSTRUMENT_SAMPLE_RATE"] > 0:
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", record_query_start)
+        event.listen(db.engine, "after_cursor_execute", record_query_end)
+    omdb.listeners.append(record_omdb_call)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    rate = app.config["INSTRUMENT_SAMPLE_RATE"]
+    # always set, worker threads serve one request after another
+    request_stats.set(RequestStats() if rate > 0 and random.random() < rate else None)
+
+@app.after_request
+def record_request(response):
+    started = g.get("request_started")
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_duration.observe(elapsed, route=route, method=request.method)
+    requests_handled.inc(route=route, method=request.method, status=response.status_code)
+
+    # streamed responses (?stream=1 history, exports) run most of their SQL after this
+    stats = request_stats.get()
+    if stats is not None:
+        request_queries.observe(stats.queries, route=route)
+        request_db_time.observe(stats.db_time, route=route)
+        request_omdb_calls.observe(stats.omdb_calls, route=route)
+        response.headers["Server-Timing"] = stats.server_timing(elapsed)
+        instrumentation_logger.info(json.dumps(dict(
+            route=route, method=request.method, path=request.path, status=response.status_code,
+            duration_ms=round(elapsed * 1000, 2), user_id=session.get("user_id"), **stats.to_dict())))
+    return response
+
+@app.teardown_request
+def clear_request_stats(error=None):
+    request_stats.set(None)
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Request, SQL and OMDb metrics of this worker, in the Prometheus text format"""
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return "Unauthorized", 401
+    return metrics_registry.render(), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Schema migrations
+# upgrade-db creates the tables that don't exist yet straight from the models,
+# then runs every migration not recorded in schema_migrations. Migrations bring
+# tables that already existed up to date, so each one must also be a no-op on
+# a table that was just created from the current models.
+class Schema_migrations(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+MIGRATIONS = []
+
+def migration(version, name):
+    def register(upgrade):
+        MIGRATIONS.append((version, name, upgrade))
+        return upgrade
+    return register
+
+def add_column(model, name):
+    """Add a column declared on model to its existing table, if it isn't there yet."""
+    columns = {column["name"] for column in inspect(db.session.connection()).get_columns(model.__tablename__)}
+    if name not in columns:
+        column_type = model.__table__.c[name].type.compile(db.engine.dialect)
+        db.session.execute(text(f"ALTER TABLE {model.__tablename__} ADD COLUMN {name} {column_type}"))
+
+def add_index(model, name):
+    """Create an index declared on model, if it doesn't exist yet."""
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    index.create(db.session.connection(), checkfirst=True)
+
+@migration(1, "index watch_history on (user_id, watch_date, movie_id)")
+def index_watch_history_by_date():
+    add_index(Watch_history, "ix_watch_history_user_date")
+
+@migration(2, "integer boxoffice_amount on watch_history and wishlist")
+def add_boxoffice_amount():
+    for model, index in ((Watch_history, "ix_watch_history_user_boxoffice"),
+                         (Wishlist, "ix_wishlist_user_boxoffice")):
+        add_column(model, "boxoffice_amount")
+        # backfill: parse each distinct "$1,234" string once and update all its rows together
+        values = db.session.query(model.boxoffice).filter(model.boxoffice_amount.is_(None)).distinct().all()
+        updates = [{"old": boxoffice, "amount": parse_boxoffice(boxoffice)} for boxoffice, in values]
+        updates = [update for update in updates if update["amount"] is not None]
+        if updates:
+            db.session.execute(text(f"UPDATE {model.__tablename__} SET boxoffice_amount = :amount "
+                                    f"WHERE boxoffice = :old"), updates)
+        add_index(model, index)
+    # stored dashboard summaries kept box office per movie before, rebuild them on next visit
+    User_stats.query.delete()
+
+@migration(3, "genre, director and language tags for existing movies")
+def tag_existing_movies():
+    if legacy_movie_keys():
+        # movie_tags is created keyed by movie id, migration 7 tags the movies after rekeying them
+        return
+    # tags and movie_tags were just created by create_all()
+    untagged = Movies.query.filter(~Movies.id.in_(db.session.query(Movie_tags.movie_id))).all()
+    tag_movies(untagged)
+    User_stats.query.delete()
+
+@migration(4, "title trigrams for the local search")
+def index_existing_titles():
+    if legacy_movie_keys():
+        return
+    # title_trigrams was just created by create_all()
+    unindexed = Movies.query.filter(~Movies.id.in_(db.session.query(Title_trigrams.movie_id))).all()
+    index_titles(unindexed)
+
+@migration(5, "data_version on users, for the stats dashboard cache")
+def add_data_version():
+    add_column(Users, "data_version")
+    Users.query.filter(Users.data_version.is_(None)).update({Users.data_version: 0})
+
+@migration(6, "index watch_history and wishlist on (user_id, rating DESC)")
+def index_ratings_by_user():
+    add_index(Watch_history, "ix_watch_history_user_personal_rating")
+    add_index(Watch_history, "ix_watch_history_user_imdb_rating")
+    add_index(Wishlist, "ix_wishlist_user_imdb_rating")
+
+# Migration 7: movies keyed by an integer id instead of their title.
+# The tables that referenced movies by title, parent first
+REKEYED_MODELS = (Movies, Movie_tags, Title_trigrams, Watch_history, Wishlist, Enrichment_jobs)
+
+def legacy_movie_keys(bind=None):
+    """Whether the movies table is still keyed by title, i.e. migration 7 hasn't run."""
+    inspector = inspect(bind if bind is not None else db.session.connection())
+    if not inspector.has_table("movies"):
+        return False
+    return "title" not in {column["name"] for column in inspector.get_columns("movies")}
+
+def keyed_by_title(inspector, model):
+    if not inspector.has_table(model.__tablename__):
+        return False
+    if model is Movies:
+        return True
+    column = next(column for column in inspector.get_columns(model.__tablename__) if column["name"] == "movie_id")
+    return isinstance(column["type"], db.String)
+
+def shadow_table(model, metadata):
+    """
+    An empty copy of model's table named <table>_new, for the rows being
+    rekeyed: no secondary indexes yet, references to movies point at movies_new.
+    """
+    columns = []
+    for column in model.__table__.columns:
+        references = [db.ForeignKey("movies_new.id" if key.column.table is Movies.__table__ else key.target_fullname)
+                      for key in column.foreign_keys]
+        columns.append(db.Column(column.name, column.type, *references, primary_key=column.primary_key,
+                                 nullable=column.nullable, unique=column.unique,
+                                 autoincrement=column.autoincrement))
+    return db.Table(f"{model.__tablename__}_new", metadata, *columns)
+
+def execute_sql(sql, **params):
+    """Run sql, list parameters are bound as an expanding IN (...)."""
+    statement = text(sql)
+    lists = [bindparam(name, expanding=True) for name, value in params.items() if isinstance(value, list)]
+    if lists:
+        statement = statement.bindparams(*lists)
+    return db.session.execute(statement, params)
+
+def copy_rekeyed(table, where, **params):
+    """Copy the rows of table (aliased o) matching where into <table>_new, with the movie's new id."""
+    columns = [column.name for column in db.metadata.tables[table].columns]
+    values = ", ".join("m.id" if name == "movie_id" else f"o.{name}" for name in columns)
+    execute_sql(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {values} FROM {table} o "
+                f"JOIN movies_new m ON m.title = o.movie_id WHERE {where}", **params)
+
+def user_batches(tables, size):
+    """(first, last) user id ranges having about size rows in tables."""
+    rows = Counter()
+    for table in tables:
+        for user_id, count in execute_sql(f"SELECT user_id, COUNT(*) FROM {table} GROUP BY user_id"):
+            rows[user_id] += count
+    first, batch_rows = None, 0
+    for user_id in sorted(rows):
+        first = user_id if first is None else first
+        batch_rows += rows[user_id]
+        if batch_rows >= size:
+            yield first, user_id
+            first, batch_rows = None, 0
+    if first is not None:
+        yield first, max(rows)
+
+MOVIE_COLUMNS = "year, genre, director, language, poster_url"
+
+@migration(7, "integer movie ids instead of titles as the key of movies")
+def rekey_movies():
+    """
+    Copy movies and the tables referencing them into new tables keyed by an
+    integer id, MIGRATION_BATCH_SIZE rows per transaction while the app keeps
+    using the old tables. Then, in one transaction with writes locked out,
+    catch up on what changed meanwhile (new movies, movies the enrichment
+    worker updated, the rows of users whose data_version moved), drop the old
+    tables and rename the new ones into place.
+    """
+    if not legacy_movie_keys():
+        return
+    size = app.config["MIGRATION_BATCH_SIZE"]
+    started = datetime.utcnow()
+    inspector = inspect(db.session.connection())
+    legacy = [model.__tablename__ for model in REKEYED_MODELS if keyed_by_title(inspector, model)]
+    # upgrading from before they existed: upgrade_database() left them for after the rekeying
+    missing = [model for model in REKEYED_MODELS if not inspector.has_table(model.__tablename__)]
+    per_user = [table for table in ("watch_history", "wishlist") if table in legacy]
+    per_movie = [table for table in ("movie_tags", "title_trigrams") if table in legacy]
+
+    metadata = db.MetaData()
+    for model in (Users, Tags):
+        model.__table__.to_metadata(metadata)
+    shadows = [shadow_table(model, metadata) for model in REKEYED_MODELS if model.__tablename__ in legacy]
+    # left over by an interrupted run, the old tables are untouched until the last step
+    metadata.drop_all(db.session.connection(), tables=shadows, checkfirst=True)
+    metadata.create_all(db.session.connection(), tables=shadows)
+    # what every copy joins on, and the declared index on movies.title once renamed
+    execute_sql("CREATE INDEX ix_movies_title ON movies_new (title)")
+    db.session.commit()
+
+    # movies in title order, each batch with its tags and trigrams
+    last = None
+    while True:
+        where = "" if last is None else "WHERE movie_id > :last "
+        titles = [title for title, in execute_sql(f"SELECT movie_id FROM movies {where}ORDER BY movie_id LIMIT :size",
+                                                  last=last, size=size)]
+        if not titles:
+            break
+        window = "o.movie_id >= :first AND o.movie_id <= :last"
+        execute_sql(f"INSERT INTO movies_new (title, {MOVIE_COLUMNS}) SELECT o.movie_id, {MOVIE_COLUMNS} "
+                    f"FROM movies o WHERE {window} ORDER BY o.movie_id", first=titles[0], last=titles[-1])
+        for table in per_movie:
+            copy_rekeyed(table, window, first=titles[0], last=titles[-1])
+        db.session.commit()
+        last = titles[-1]
+
+    # watch history and wishlists a range of users at a time, noting the
+    # data_version each user had before their rows were read
+    versions = {}
+    for first, last in user_batches(per_user, size):
+        versions.update(db.session.query(Users.id, Users.data_version).filter(Users.id.between(first, last)).all())
+        for table in per_user:
+            copy_rekeyed(table, "o.user_id BETWEEN :first AND :last", first=first, last=last)
+        db.session.commit()
+
+    # The switch, in the transaction upgrade_database() commits
+    if db.engine.dialect.name == "postgresql":
+        # reads go on, writes wait for the new tables
+        execute_sql(f"LOCK TABLE {', '.join(legacy)} IN EXCLUSIVE MODE")
+    added = [title for title, in execute_sql(
+        "SELECT o.movie_id FROM movies o WHERE NOT EXISTS (SELECT 1 FROM movies_new m WHERE m.title = o.movie_id)")]
+    if added:
+        execute_sql(f"INSERT INTO movies_new (title, {MOVIE_COLUMNS}) SELECT o.movie_id, {MOVIE_COLUMNS} "
+                    f"FROM movies o WHERE o.movie_id IN :titles", titles=added)
+    enriched = []
+    if "enrichment_jobs" in legacy:
+        enriched = [title for title, in execute_sql(
+            "SELECT DISTINCT movie_id FROM enrichment_jobs WHERE status = 'done' AND updated_at >= :started",
+            started=started)]
+    if enriched:
+        execute_sql("UPDATE movies_new SET " + ", ".join(
+            f"{name} = (SELECT o.{name} FROM movies o WHERE o.movie_id = movies_new.title)"
+            for name in MOVIE_COLUMNS.split(", ")) + " WHERE title IN :titles", titles=enriched)
+    if added or enriched:
+        for table in per_movie:
+            execute_sql(f"DELETE FROM {table}_new WHERE movie_id IN "
+                        f"(SELECT id FROM movies_new WHERE title IN :titles)", titles=added + enriched)
+            copy_rekeyed(table, "o.movie_id IN :titles", titles=added + enriched)
+    changed = [user_id for user_id, version in db.session.query(Users.id, Users.data_version)
+               if version != versions.get(user_id, 0)]
+    if changed:
+        for table in per_user:
+            execute_sql(f"DELETE FROM {table}_new WHERE user_id IN :users", users=changed)
+            copy_rekeyed(table, "o.user_id IN :users", users=changed)
+    if "enrichment_jobs" in legacy:
+        copy_rekeyed("enrichment_jobs", "1 = 1")
+        if db.engine.dialect.name == "postgresql":
+            execute_sql("SELECT setval(pg_get_serial_sequence('enrichment_jobs_new', 'id'), "
+                        "COALESCE(MAX(id), 0) + 1, false) FROM enrichment_jobs_new")
+
+    for table in reversed(legacy):
+        execute_sql(f"DROP TABLE {table}")
+    for table in legacy:
+        execute_sql(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for model in REKEYED_MODELS:
+        if model.__tablename__ in legacy:
+            for index in model.__table__.indexes:
+                add_index(model, index.name)
+    db.metadata.create_all(db.session.connection(), tables=[model.__table__ for model in missing])
+    if Movie_tags in missing:
+        tag_existing_movies()
+    if Title_trigrams in missing:
+        index_existing_titles()
+    # cached pages link posters by title
+    bump_data_version()
+
+@migration(8, "dashboard summaries keyed by movie id")
+def rekey_stats_summaries():
+    # stored summaries told movies apart by title, rebuild them on next visit
+    User_stats.query.delete()
+    bump_data_version()
+
+def upgrade_database():
+    """Create missing tables and run pending migrations, return the names of the ones run."""
+    # tables referencing movies by id can't be created before migration 7 gave movies an id
+    rekeyed = {model.__table__ for model in REKEYED_MODELS} if legacy_movie_keys(db.engine) else set()
+    db.metadata.create_all(db.engine, tables=[table for table in db.metadata.sorted_tables if table not in rekeyed])
+    applied = {row.version for row in Schema_migrations.query}
+    done = []
+    for version, name, upgrade in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        upgrade()
+        db.session.add(Schema_migrations(version=version, name=name, applied_at=datetime.utcnow()))
+        db.session.commit()
+        done.append(name)
+    return done
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """Bring the database schema up to date."""
+    for name in upgrade_database():
+        click.echo(f"Applied: {name}")
+    click.echo("Database is up to date")
+
+# Movie tags
+TAG_KINDS = ("genre", "director", "language")
+
+def split_tags(value):
+    return [name for name in (value or "").split(", ") if name]
+
+def tag_movies(movies):
+    """Link newly added movies to their genre, director and language tags, in the caller's transaction."""
+    links = {(movie.id, kind, name)
+             for movie in movies for kind in TAG_KINDS for name in split_tags(getattr(movie, kind))}
+    tag_ids = get_tag_ids({(kind, name) for _, kind, name in links})
+    db.session.add_all(Movie_tags(movie_id=movie_id, tag_id=tag_ids[(kind, name)])
+                       for movie_id, kind, name in links)
+
+def get_tag_ids(tags):
+    """Map each (kind, name) to its tag id, creating the tags that don't exist yet."""
+    tag_ids = {}
+    names = sorted({name for _, name in tags})
+    for i in range(0, len(names), 500):
+        for tag in Tags.query.filter(Tags.name.in_(names[i:i + 500])):
+            if (tag.kind, tag.name) in tags:
+                tag_ids[(tag.kind, tag.name)] = tag.id
+    for kind, name in sorted(tags - tag_ids.keys()):
+        tag = Tags(kind=kind, name=name)
+        try:
+            # a savepoint, so losing a race with another request creating the same tag is harmless
+            with db.session.begin_nested():
+                db.session.add(tag)
+        except IntegrityError:
+            tag = Tags.query.filter_by(kind=kind, name=name).one()
+        tag_ids[(kind, name)] = tag.id
+    return tag_ids
+
+def tagged(kind, name):
+    """Movie ids having the tag, for Watch_history.movie_id.in_(...) filters."""
+    return db.session.query(Movie_tags.movie_id).join(Tags).filter(Tags.kind==kind, Tags.name==name)
+
+# Local search
+def index_titles(movies):
+    """Add newly added movies to the title search index, in the caller's transaction."""
+    db.session.add_all(Title_trigrams(trigram=gram, movie_id=movie.id)
+                       for movie in movies for gram in trigrams(movie.title))
+    # and to this worker's autocomplete once it commits, other workers pick them up on their next refresh
+    db.session.info.setdefault("indexed_titles", []).extend(movie.title for movie in movies)
+
+def user_movie_ids(table, user_id, movie_ids):
+    """The movie_ids in the user's Watch_history or Wishlist."""
+    if not movie_ids:
+        return set()
+    return {movie_id for movie_id, in db.session.query(table.movie_id).filter(
+        table.user_id==user_id, table.movie_id.in_(movie_ids))}
+
+def user_movie_titles(table, user_id, titles):
+    """The titles of movies in the user's Watch_history or Wishlist."""
+    if not titles:
+        return set()
+    return {title for title, in db.session.query(Movies.title).join(table).filter(
+        table.user_id==user_id, Movies.title.in_(titles))}
+
+def search_movies(query, user_id, filters=None, scope="all"):
+    """
+    Search the movies table for titles like query, without calling OMDb.
+
+    filters narrows the search to a genre, director, language and/or year,
+    scope to the movies in the user's "history" or "wishlist". Returns the
+    best SEARCH_MAX_RESULTS movies (with in_history and in_wishlist set for
+    the user) and the facet counts over every match.
+    """
+    candidates = db.session.query(Title_trigrams.movie_id).filter(
+        Title_trigrams.trigram.in_(trigrams(query, prefix=True))
+    )
+    for kind, name in (filters or {}).items():
+        if kind == "year":
+            candidates = candidates.filter(Title_trigrams.movie_id.in_(
+                db.session.query(Movies.id).filter(Movies.year==name)))
+        else:
+            candidates = candidates.filter(Title_trigrams.movie_id.in_(tagged(kind, name)))
+    if scope in ("history", "wishlist"):
+        table = Watch_history if scope == "history" else Wishlist
+        candidates = candidates.filter(Title_trigrams.movie_id.in_(
+            db.session.query(table.movie_id).filter(table.user_id==user_id)))
+    candidates = candidates.group_by(
+        Title_trigrams.movie_id
+    ).order_by(
+        func.count().desc(), Title_trigrams.movie_id
+    ).limit(app.config["SEARCH_CANDIDATES"])
+
+    # movies sharing a title rank together
+    by_title = {}
+    for movie_id, title in db.session.query(Movies.id, Movies.title).filter(Movies.id.in_(candidates)):
+        by_title.setdefault(title, []).append(movie_id)
+    matches = [movie_id for _, title in rank(query, by_title) for movie_id in sorted(by_title[title])]
+    hits = matches[:app.config["SEARCH_MAX_RESULTS"]]
+    movies = {movie.id: movie for movie in Movies.query.filter(Movies.id.in_(hits))}
+    in_history = user_movie_ids(Watch_history, user_id, hits)
+    in_wishlist = user_movie_ids(Wishlist, user_id, hits)
+    results = [{"movie": movies[movie_id],
+                "in_history": movie_id in in_history,
+                "in_wishlist": movie_id in in_wishlist}
+               for movie_id in hits if movie_id in movies]
+    return results, search_facets(matches)
+
+title_index = PrefixIndex()
+title_index_checked = {"at": None}
+
+def current_title_index():
+    """The autocomplete index, reloaded when the movies table doesn't have as many titles (another worker added some)."""
+    now = time.monotonic()
+    checked = title_index_checked["at"]
+    if checked is None or now - checked >= app.config["AUTOCOMPLETE_REFRESH_INTERVAL"]:
+        title_index_checked["at"] = now
+        if db.session.query(func.count(Movies.title.distinct())).scalar() != len(title_index):
+            title_index.load(title for title, in db.session.query(Movies.title).distinct())
+    return title_index
+
+@event.listens_for(db.session, "after_commit")
+def add_indexed_titles(session):
+    title_index.add(session.info.pop("indexed_titles", ()))
+
+@event.listens_for(db.session, "after_soft_rollback")
+def drop_indexed_titles(session, previous_transaction):
+    # not when only a savepoint was rolled back, the rest of the transaction can still commit
+    if previous_transaction.parent is None:
+        session.info.pop("indexed_titles", None)
+
+def search_facets(movie_ids):
+    """{"genre": [(name, count)], ..., "year": [(year, count)]} over movie_ids, most common first."""
+    facets = {kind: [] for kind in TAG_KINDS + ("year",)}
+    if not movie_ids:
+        return facets
+    count = func.count().label("count")
+    rows = db.session.query(Tags.kind, Tags.name, count).join(Movie_tags).filter(
+        Movie_tags.movie_id.in_(movie_ids)
+    ).group_by(Tags.kind, Tags.name).order_by(count.desc(), Tags.name)
+    for kind, name, number in rows:
+        facets[kind].append((name, number))
+    facets["year"] = db.session.query(Movies.year, count).filter(
+        Movies.id.in_(movie_ids), Movies.year.isnot(None)
+    ).group_by(Movies.year).order_by(count.desc(), Movies.year.desc()).all()
+    return facets
+
+lookup_cache = LRUCache(app.config["OMDB_MEMORY_CACHE_SIZE"])
+lookup_cache_stats = Counter()
+_MISSING = object()
+
+def cache_key(title):
+    return " ".join(title.split()).lower()[:200]
+
+def lookup_key(title, imdb_id=None, year=None):
+    """The cache key of fetch_movie(title, imdb_id, year); that of a lookup by title alone is cache_key(title)."""
+    if imdb_id:
+        return "imdb:" + imdb_id.strip().lower()
+    if year:
+        return f"{cache_key(title or '')[:190]}|{year}"
+    return cache_key(title or "")
+
+def cached_lookup(title):
+    """
+    Look up movie data for title through the in-process LRU and the shared
+    omdb_cache table, only calling OMDb on a miss.
+
+    "Not found" answers are cached too (for a shorter time). If OMDb is down,
+    an expired database entry is served rather than nothing.
+    """
+    key = cache_key(title or "")
+    if not key:
+        return None
+
+    result = lookup_cache.get(key, _MISSING)
+    if result is not _MISSING:
+        lookup_cache_stats["memory_hits"] += 1
+        return result
+
+    now = datetime.utcnow()
+    row = db.session.get(Omdb_cache, key)
+    if row is not None and row.expires_at > now:
+        lookup_cache_stats["db_hits"] += 1
+        result = json.loads(row.payload) if row.payload else None
+        ttl = min(app.config["OMDB_MEMORY_CACHE_TTL"], (row.expires_at - now).total_seconds())
+        lookup_cache.set(key, result, ttl)
+        return result
+
+    lookup_cache_stats["misses"] += 1
+    try:
+        result = fetch_movie(title)
+    except OmdbUnavailable:
+        lookup_cache_stats["errors"] += 1
+        if row is not None and row.payload:
+            lookup_cache_stats["stale_hits"] += 1
+            return json.loads(row.payload)
+        result = stored_movie(title)
+        if result is not None:
+            lookup_cache_stats["fallback_hits"] += 1
+        return result
+
+    store_lookup(key, row, result, now)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another worker cached the same title first
+        db.session.rollback()
+    return result
+
+def peek_lookup(title):
+    """cached_lookup() without calling OMDb: the cached answer, or None if there is none."""
+    key = cache_key(title or "")
+    result = lookup_cache.get(key, _MISSING)
+    if result is not _MISSING:
+        return result
+    row = db.session.get(Omdb_cache, key) if key else None
+    if row is not None and row.payload:
+        return json.loads(row.payload)
+    return None
+
+def store_lookup(key, row, result, now):
+    """Put a fresh OMDb answer in both caches, row is its existing omdb_cache row or None."""
+    if result is None:
+        ttl = app.config["OMDB_NEGATIVE_CACHE_TTL"]
+    else:
+        ttl = app.config["OMDB_CACHE_TTL"]
+    if row is None:
+        row = Omdb_cache(title=key)
+        db.session.add(row)
+    row.payload = json.dumps(result) if result is not None else None
+    row.fetched_at = now
+    row.expires_at = now + timedelta(seconds=ttl)
+    lookup_cache.set(key, result, min(app.config["OMDB_MEMORY_CACHE_TTL"], ttl))
+
+def cached_lookup_many(queries, workers=4, fetch=True):
+    """
+    cached_lookup() for a batch of (title, imdb_id, year) queries, see
+    fetch_movie(): the in-process LRU, then one query on omdb_cache, then (if
+    fetch) OMDb for the rest with up to workers calls at a time.
+
+    Returns {lookup_key(*query): result}. A query that OMDb wasn't asked
+    about, or couldn't be, and that has no stale or stored fallback is left out.
+    """
+    queries = {lookup_key(*query): query for query in queries}
+    queries.pop("", None)
+    results = {}
+    for key in queries:
+        result = lookup_cache.get(key, _MISSING)
+        if result is not _MISSING:
+            lookup_cache_stats["memory_hits"] += 1
+            results[key] = result
+
+    now = datetime.utcnow()
+    rows = {row.title: row for row in Omdb_cache.query.filter(Omdb_cache.title.in_(queries.keys() - results.keys()))}
+    for key, row in rows.items():
+        if row.expires_at > now:
+            lookup_cache_stats["db_hits"] += 1
+            results[key] = json.loads(row.payload) if row.payload else None
+            ttl = min(app.config["OMDB_MEMORY_CACHE_TTL"], (row.expires_at - now).total_seconds())
+            lookup_cache.set(key, results[key], ttl)
+    if not fetch:
+        return results
+
+    missing = [query for key, query in queries.items() if key not in results]
+    lookup_cache_stats["misses"] += len(missing)
+    for query, result in fetch_movies(missing, workers).items():
+        key = lookup_key(*query)
+        row = rows.get(key)
+        if isinstance(result, OmdbUnavailable):
+            lookup_cache_stats["errors"] += 1
+            if row is not None and row.payload:
+                lookup_cache_stats["stale_hits"] += 1
+                results[key] = json.loads(row.payload)
+            else:
+                title, imdb_id, _ = query
+                # a movie of the same title may be another one than that IMDb id
+                stored = stored_movie(title) if not imdb_id else None
+                if stored is not None:
+                    lookup_cache_stats["fallback_hits"] += 1
+                    results[key] = stored
+            continue
+        store_lookup(key, row, result, now)
+        results[key] = result
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    return results
+
+def stored_movie(title):
+    """
+    Build a fetch_movie() style result from our own Movies table, used when OMDb is
+    unavailable and for local search hits. Rating and box office come from the
+    latest record of the movie.
+    """
+    movie = Movies.query.filter(func.lower(Movies.title) == cache_key(title)).order_by(Movies.id).first()
+    if movie is None:
+        return None
+    return movie_result(movie)
+
+def movie_result(movie):
+    """stored_movie() for a Movies row."""
+    latest = Watch_history.query.filter_by(movie_id=movie.id).order_by(Watch_history.watch_date.desc()).first()
+    return {
+        "title": movie.title,
+        "year": movie.year,
+        "imdb_rating": latest.imdb_rating if latest else "N/A",
+        "genre": movie.genre,
+        "director": movie.director,
+        "language": movie.language,
+        "boxoffice": latest.boxoffice if latest else "N/A",
+        "poster": movie.poster_url,
+        "imdb_id": movie.imdb_id,
+    }
+
+def get_or_add_movies(results):
+    """
+    The Movies row of each fetch_movie() style result, in the caller's transaction,
+    and the list of those that were added.
+
+    A result is the movie with its IMDb id; without one (or the first time
+    the id is seen) it is a movie of the same title and year (or without a
+    year) that isn't tied to another IMDb id yet, which then gets this one.
+    Otherwise a new movie is added, tagged and indexed for search: remakes sharing a title are
+    different movies. New movies are inserted with ON CONFLICT DO NOTHING, so
+    two requests adding the same movie at once end up sharing its row.
+    """
+    imdb_ids = {result["imdb_id"] for result in results if result.get("imdb_id")}
+    by_imdb_id = {movie.imdb_id: movie for movie in Movies.query.filter(Movies.imdb_id.in_(imdb_ids))}
+    titles = {result["title"] for result in results if result.get("imdb_id") not in by_imdb_id}
+    by_title = {}
+    for movie in Movies.query.filter(Movies.title.in_(titles)).order_by(Movies.id):
+        by_title.setdefault(movie.title, []).append(movie)
+
+    movies = []
+    added = []
+    for result in results:
+        imdb_id = result.get("imdb_id") or None
+        movie = by_imdb_id.get(imdb_id)
+        if movie is None:
+            same_title = by_title.setdefault(result["title"], [])
+            year = as_int(result["year"])
+            movie = next((movie for movie in same_title if (imdb_id is None or movie.imdb_id is None)
+                          and (year is None or movie.year is None or movie.year == year)), None)
+            if movie is None:
+                movie = Movies(title=result["title"], imdb_id=imdb_id, year=as_int(result["year"]),
+                               genre=result["genre"], director=result["director"], language=result["language"],
+                               poster_url=result["poster"])
+                added.append(movie)
+                same_title.append(movie)
+            elif imdb_id is not None:
+                movie.imdb_id = imdb_id
+            if imdb_id is not None:
+                by_imdb_id[imdb_id] = movie
+        movies.append(movie)
+    if added:
+        stored = {id(movie): row for movie, row in zip(added, insert_movies(added))}
+        movies = [stored.get(id(movie), movie) for movie in movies]
+        added = [movie for movie in added if stored[id(movie)] is movie]
+        tag_movies(added)
+        index_titles(added)
+    return movies, added
+
+def insert_movies(movies):
+    """
+    Insert the new (transient) Movies in one statement, ignoring those whose
+    IMDb id another request added since we looked. The row of each movie:
+    the movie itself, now persistent with its id, or the other request's.
+    """
+    columns = [column.name for column in Movies.__table__.columns if column.name != "id"]
+    returned = db.session.execute(
+        on_conflict_do_nothing(Movies).returning(Movies.id, Movies.imdb_id, Movies.title, Movies.year),
+        [{name: getattr(movie, name) for name in columns} for movie in movies]
+    )
+    # a title and year without an IMDb id is only added once per call, see get_or_add_movies()
+    ids = {(imdb_id, title, year): movie_id for movie_id, imdb_id, title, year in returned}
+    taken = [movie.imdb_id for movie in movies if (movie.imdb_id, movie.title, movie.year) not in ids]
+    existing = {}
+    if taken:
+        existing = {row.imdb_id: row for row in Movies.query.filter(Movies.imdb_id.in_(taken))}
+    rows = []
+    for movie in movies:
+        movie_id = ids.get((movie.imdb_id, movie.title, movie.year))
+        if movie_id is None:
+            rows.append(existing[movie.imdb_id])
+            continue
+        # the row is in the database already, attach the object without another INSERT
+        movie.id = movie_id
+        make_transient_to_detached(movie)
+        db.session.add(movie)
+        rows.append(movie)
+    return rows
+
+omdb_cache_cli = AppGroup("omdb-cache", help="Inspect and invalidate the OMDb lookup cache.")
+app.cli.add_command(omdb_cache_cli)
+
+@omdb_cache_cli.command("clear")
+@click.argument("titles", nargs=-1)
+@click.option("--expired", is_flag=True, help="Only remove entries that have expired.")
+def omdb_cache_clear(titles, expired):
+    """
+    Remove cached OMDb answers, for TITLES only if given.
+
+    Running workers keep their in-process copy for at most OMDB_MEMORY_CACHE_TTL.
+    """
+    query = Omdb_cache.query
+    if titles:
+        query = query.filter(Omdb_cache.title.in_([cache_key(title) for title in titles]))
+    if expired:
+        query = query.filter(Omdb_cache.expires_at <= datetime.utcnow())
+    count = query.delete(synchronize_session=False)
+    db.session.commit()
+    lookup_cache.clear()
+    click.echo(f"Removed {count} cached entries")
+
+@omdb_cache_cli.command("stats")
+def omdb_cache_show_stats():
+    """Show what is in the shared OMDb cache table."""
+    now = datetime.utcnow()
+    total = Omdb_cache.query.count()
+    not_found = Omdb_cache.query.filter(Omdb_cache.payload.is_(None)).count()
+    expired = Omdb_cache.query.filter(Omdb_cache.expires_at <= now).count()
+    click.echo(f"{total} entries, {not_found} cached as not found, {expired} expired")
+
 @app.route("/", methods=["GET"])
 @login_required
 def homepage():
@@ -175,34 +1250,75 @@ def register():
 def history():
     if request.method == "POST":
         if "delete" in request.form:
-            query = Watch_history.query.filter_by(user_id=session["user_id"], movie_id=request.form.get("movie_id"), watch_date=request.form.get("date")).first()
-            db.session.delete(query)
+            remove_watch(session["user_id"], request.form.get("movie_id", type=int), request.form.get("date"))
             db.session.commit()
 
     """Show history of transactions"""
-    history = list()
-    results = db.session.query(Movies, Watch_history).join(Watch_history).filter(Watch_history.user_id==session["user_id"]).order_by(Watch_history.watch_date.desc()).all()
-    for movies, watch_history in results:
-        history.append({"date": watch_history.watch_date, 
-                        "movie_id": watch_history.movie_id, 
-                        "year": movies.year,
-                        "genre": movies.genre,
-                        "director": movies.director,
-                        "language": movies.language,
-                        "boxoffice": watch_history.boxoffice,
-                        "imdb_rating": watch_history.imdb_rating,
-                        "personal_rating": watch_history.personal_rating,
-                        "comments": watch_history.comments})
-    return render_template("history.html", history=history)
+    query = db.session.query(
+        Movies, Watch_history
+    ).join(
+        Watch_history
+    ).filter(
+        Watch_history.user_id==session["user_id"]
+    ).order_by(
+        Watch_history.watch_date.desc(), Watch_history.movie_id.desc()
+    )
+
+    # ?genre=Drama, ?director=... or ?language=... only shows the movies with that tag
+    filters = {kind: request.args.get(kind) for kind in TAG_KINDS if request.args.get(kind)}
+    for kind, name in filters.items():
+        query = query.filter(Watch_history.movie_id.in_(tagged(kind, name)))
+
+    # Stream every row in constant memory instead of paginating
+    if request.args.get("stream", "1" if app.config["HISTORY_STREAM"] else "0") == "1":
+        rows = (history_row(movies, watch_history) for movies, watch_history in query.yield_per(500))
+        return stream_template("history.html", history=rows, filters=filters)
+
+    page_size = request.args.get("page_size", app.config["HISTORY_PAGE_SIZE"], type=int)
+    page_size = max(1, min(page_size, app.config["HISTORY_MAX_PAGE_SIZE"]))
+
+    # Keyset pagination: continue right after the (watch_date, movie_id) of the last row shown
+    if request.args.get("cursor"):
+        try:
+            watch_date, movie_id = decode_cursor(request.args.get("cursor"))
+            watch_date, movie_id = date.fromisoformat(watch_date), int(movie_id)
+        except (TypeError, ValueError):
+            return apology("Invalid page cursor")
+        query = query.filter(or_(Watch_history.watch_date < watch_date,
+                                 and_(Watch_history.watch_date == watch_date,
+                                      Watch_history.movie_id < movie_id)))
+
+    results = query.limit(page_size + 1).all()
+    history = [history_row(movies, watch_history) for movies, watch_history in results[:page_size]]
+    next_cursor = None
+    if len(results) > page_size:
+        next_cursor = encode_cursor(history[-1]["date"].isoformat(), history[-1]["movie_id"])
+
+    # "Load more" asks for the next rows only
+    if request.args.get("partial"):
+        return render_template("history_rows.html", history=history), {"X-Next-Cursor": next_cursor or ""}
+    return render_template("history.html", history=history, next_cursor=next_cursor, page_size=page_size,
+                           filters=filters)
+
+def history_row(movies, watch_history):
+    return {"date": watch_history.watch_date, 
+            "movie_id": watch_history.movie_id, 
+            "title": movies.title,
+            "year": movies.year,
+            "genre": movies.genre,
+            "director": movies.director,
+            "language": movies.language,
+            "boxoffice": watch_history.boxoffice,
+            "imdb_rating": watch_history.imdb_rating,
+            "personal_rating": watch_history.personal_rating,
+            "comments": watch_history.comments}
 
 @app.route("/wishlist", methods=["GET", "POST"])
 @login_required
 def wishlist():
     if request.method == "POST":
         if "delete" in request.form:
-            query = Wishlist.query.filter_by(user_id=session["user_id"], 
-                                             movie_id=request.form.get("movie_id")).first()
-            db.session.delete(query)
+            remove_wish(session["user_id"], request.form.get("movie_id", type=int))
             db.session.commit()
         if "add_to_history" in request.form:
             # Ensure watch date is not null
@@ -221,41 +1337,21 @@ def wishlist():
             elif rating > 10:
                 return apology("Rating can't exceed 10")
 
-            # Check whether this movie has been added for that day already
-            record = Watch_history.query.filter_by(user_id=session["user_id"], movie_id=request.form.get("movie_name"), watch_date=request.form.get("watchdate")).first()
-            if record is not None:
-                return apology("This watch history has already been recorded")
-
-            # Update movies table
-            # check if movie already exist in movies table
-            rows = Movies.query.filter_by(movie_id=request.form.get("movie_id")).first()
-            if rows is None:
-                # if not add the movie to movies table
-                # movies = Movies(movie_id=request.form.get("movie_id"),
-                #                 year = request.form.get("year"), 
-                #                 genre=request.form.get("genre"),
-                #                 director = request.form.get("director"),
-                #                 language = request.form.get("language"))
-                # db.session.add(movies)
-                # db.session.commit()
+            # Move the movie from the wishlist to the watch history
+            movie_watched = {"user_id": session["user_id"],
+                             "movie_id": request.form.get("movie_id_correct", type=int),
+                             "watch_date": datetime.strptime(request.form.get("watchdate"), '%Y-%m-%d').date(),
+                             "personal_rating": rating,
+                             "comments": request.form.get("comments"),
+                             "imdb_rating": as_float(request.form.get("imdb_correct")),
+                             "boxoffice": request.form.get("box_office_correct"),
+                             "boxoffice_amount": parse_boxoffice(request.form.get("box_office_correct"))}
+            result = move_wish_to_history(movie_watched)
+            if result is not Write.DONE:
+                db.session.rollback()
+                if result is Write.DUPLICATE:
+                    return apology("This watch history has already been recorded")
                 return apology("Please don't modify Movie Name")
-
-            # Update watch history
-            movie_watched = Watch_history(user_id=session["user_id"], 
-                                          movie_id = request.form.get("movie_name"), 
-                                          watch_date=datetime.strptime(request.form.get("watchdate"), '%Y-%m-%d').date(), 
-                                          personal_rating=rating, 
-                                          comments=request.form.get("comments"),
-                                          imdb_rating=request.form.get("imdb_correct"),
-                                          boxoffice=request.form.get("box_office_correct"))
-            db.session.add(movie_watched)
-            db.session.commit()
-
-            
-            # Update wishlist table
-            query = Wishlist.query.filter_by(user_id=session["user_id"], 
-                                             movie_id=request.form.get("movie_name")).first()
-            db.session.delete(query)
             db.session.commit()
 
             #return redirect("/")
@@ -267,6 +1363,7 @@ def wishlist():
     results = db.session.query(Movies, Wishlist).join(Wishlist).filter(Wishlist.user_id==session["user_id"]).all()
     for movies, wishlist in results:
         wishlist_list.append({"movie_id": wishlist.movie_id, 
+                        "title": movies.title,
                         "year": movies.year,
                         "genre": movies.genre,
                         "director": movies.director,
@@ -286,15 +1383,22 @@ def search():
             if not request.form.get("title"):
                 return apology("Title must not be null")
 
-            result = lookup(request.form.get("title"))
-
-            # movie title doesn't exist
-            if not result:
-                return apology("Can't find the movie", 400)
-            else:
-                return render_template("search_results.html", title=result["title"], year=result["year"],
-                    genre=result["genre"], director=result["director"], language=result["language"],
-                    imdb_rating=result["imdb_rating"], boxoffice=result["boxoffice"], poster=result["poster"])
+            # our own movies first, OMDb only when none of them matches
+            title = request.form.get("title")
+            results, facets = search_movies(title, session["user_id"])
+            for hit in results:
+                if cache_key(hit["movie"].title) == cache_key(title):
+                    return render_search_result(peek_lookup(title) or movie_result(hit["movie"]))
+            if results:
+                return render_template("search_matches.html", query=title, results=results, facets=facets,
+                                       filters={}, scope="all")
+            return render_search_result(cached_lookup(title))
+
+        # None of the local matches is the one, ask OMDb
+        if "search_omdb" in request.form:
+            if not request.form.get("title"):
+                return apology("Title must not be null")
+            return render_search_result(cached_lookup(request.form.get("title")))
 
         # User request to search for another movie
         if "search_again" in request.form:
@@ -302,8 +1406,6 @@ def search():
 
         # User request to add the movie to watch history
         if "add_to_history" in request.form:
-            result = lookup(request.form.get("title"))
-
             # Ensure watch date is not null
             if not request.form.get("watchdate"):
                 return apology("Watch date must not be null")
@@ -320,34 +1422,21 @@ def search():
             elif rating > 10:
                 return apology("Rating can't exceed 10")
 
-            # Check whether this movie has been added for that day already
-            record = Watch_history.query.filter_by(user_id=session["user_id"], movie_id=request.form.get("title"), watch_date=request.form.get("watchdate")).first()
-            if record is not None:
-                return apology("This watch history has already been recorded")
-
             # Update movies table
-            # check if movie already exist in movies table
-            rows = Movies.query.filter_by(movie_id=request.form.get("title")).first()
-            if rows is None:
-                # if not add the movie to movies table
-                movies = Movies(movie_id=request.form.get("title"),
-                                year = request.form.get("year"), 
-                                genre=request.form.get("genre"),
-                                director = request.form.get("director"),
-                                language = request.form.get("language"),
-                                poster_url = result["poster"])
-                db.session.add(movies)
-                db.session.commit()
-
-            # Update watch history
-            movie_watched = Watch_history(user_id=session["user_id"], 
-                                          movie_id = request.form.get("title"), 
-                                          watch_date=datetime.strptime(request.form.get("watchdate"), '%Y-%m-%d').date(), 
-                                          personal_rating=rating, 
-                                          comments=request.form.get("comments"),
-                                          imdb_rating=request.form.get("imdb_rating"),
-                                          boxoffice=request.form.get("boxoffice"))
-            db.session.add(movie_watched)
+            rows = movie_from_form(request.form)
+
+            # Update watch history, unless this movie has been added for that day already
+            movie_watched = {"user_id": session["user_id"],
+                             "movie_id": rows.id,
+                             "watch_date": datetime.strptime(request.form.get("watchdate"), '%Y-%m-%d').date(),
+                             "personal_rating": rating,
+                             "comments": request.form.get("comments"),
+                             "imdb_rating": as_float(request.form.get("imdb_rating")),
+                             "boxoffice": request.form.get("boxoffice"),
+                             "boxoffice_amount": parse_boxoffice(request.form.get("boxoffice"))}
+            if add_watch(movie_watched, rows) is Write.DUPLICATE:
+                db.session.rollback()
+                return apology("This watch history has already been recorded")
             db.session.commit()
 
             #return redirect("/")
@@ -355,316 +1444,1279 @@ def search():
 
         # User request to add the movie to wishlist
         if "add_to_wishlist" in request.form:
-            result = lookup(request.form.get("title"))
-            # If movie already exist in wishlist
-            rows = Wishlist.query.filter_by(user_id=session["user_id"], movie_id=request.form.get("title")).first()
-            if rows is not None:
-                return apology("movie already in wishlist")
-
             # Update movies table
-            # check if movie already exist in movies table
-            rows = Movies.query.filter_by(movie_id=request.form.get("title")).first()
-            if rows is None:
-                # if not add the movie to movies table
-                movies = Movies(movie_id=request.form.get("title"),
-                                year = request.form.get("year"), 
-                                genre=request.form.get("genre"),
-                                director = request.form.get("director"),
-                                language = request.form.get("language"),
-                                poster_url = result["poster"])
-                db.session.add(movies)
-                db.session.commit()
+            rows = movie_from_form(request.form)
 
-            # Update wishlist
+            # Update wishlist, unless the movie is already in it
             # Future enhancement: get rid of imdb_rating and boxoffice in wishlist table
-            add_to_wishlist = Wishlist(user_id=session["user_id"], 
-                                       movie_id = request.form.get("title"), 
-                                       comments=request.form.get("comments"),
-                                       imdb_rating=request.form.get("imdb_rating"),
-                                       boxoffice=request.form.get("boxoffice"))
-            db.session.add(add_to_wishlist)
+            add_to_wishlist = {"user_id": session["user_id"],
+                               "movie_id": rows.id,
+                               "comments": request.form.get("comments"),
+                               "imdb_rating": as_float(request.form.get("imdb_rating")),
+                               "boxoffice": request.form.get("boxoffice"),
+                               "boxoffice_amount": parse_boxoffice(request.form.get("boxoffice"))}
+            if add_wish(add_to_wishlist, rows) is Write.DUPLICATE:
+                db.session.rollback()
+                return apology("movie already in wishlist")
             db.session.commit()
             
             return redirect("/wishlist")
     else:
+        # A local match picked from the results
+        if request.args.get("movie"):
+            movie = db.session.get(Movies, request.args.get("movie", type=int) or 0)
+            return render_search_result(movie_result(movie) if movie else None)
+
+        # Local search, narrowed with the facets
+        if request.args.get("q"):
+            filters = {kind: request.args.get(kind) for kind in TAG_KINDS + ("year",) if request.args.get(kind)}
+            if "year" in filters:
+                try:
+                    filters["year"] = int(filters["year"])
+                except ValueError:
+                    return apology("Year must be a number")
+            scope = request.args.get("scope", "all")
+            results, facets = search_movies(request.args.get("q"), session["user_id"], filters, scope)
+            return render_template("search_matches.html", query=request.args.get("q"), results=results,
+                                   facets=facets, filters=filters, scope=scope)
+
         return render_template("search.html")
+
+@app.route("/search/autocomplete", methods=["GET"])
+@login_required
+def autocomplete():
+    """Titles with a word starting with ?q=, the user's own movies first, as JSON"""
+    query = request.args.get("q", "")
+    matches = current_title_index().search(query, app.config["AUTOCOMPLETE_CANDIDATES"])
+    titles = [title for title, _ in matches]
+    in_history = user_movie_titles(Watch_history, session["user_id"], titles)
+    in_wishlist = user_movie_titles(Wishlist, session["user_id"], titles)
+    # the user's movies, then titles starting with the query, then the shortest
+    matches.sort(key=lambda match: (match[0] not in in_history and match[0] not in in_wishlist,
+                                    match[1] > 0, len(match[0]), match[0]))
+    results = [{"title": title, "in_history": title in in_history, "in_wishlist": title in in_wishlist}
+               for title, _ in matches[:app.config["AUTOCOMPLETE_LIMIT"]]]
+    return {"query": query, "results": results}, {"Cache-Control": "private, max-age=60"}
+
+def render_search_result(result):
+    # movie title doesn't exist
+    if not result:
+        return apology("Can't find the movie", 400)
+    return render_template("search_results.html", title=result["title"], year=result["year"],
+        genre=result["genre"], director=result["director"], language=result["language"],
+        imdb_rating=result["imdb_rating"], boxoffice=result["boxoffice"], poster=result["poster"])
+
+def movie_from_form(form):
+    """
+    The Movies row of the search result the form was posted from. A new movie
+    is added with what the search page showed; the enrichment worker checks
+    it against OMDb and fills in anything missing.
+    """
+    cached = peek_lookup(form.get("title"))
+    # the IMDb id only comes from OMDb's own answer for this title, never from the
+    # form, so a posted form can't tie a title to another movie's id
+    if cached and cache_key(cached["title"]) != cache_key(form.get("title") or ""):
+        cached = None
+    result = {"title": form.get("title"), "year": form.get("year"), "genre": form.get("genre"),
+              "director": form.get("director"), "language": form.get("language"),
+              "poster": cached["poster"] if cached else None,
+              "imdb_id": cached.get("imdb_id") if cached else None}
+    (movie,), added = get_or_add_movies([result])
+    for movie in added:
+        enqueue_enrichment(movie.id, added=True)
+    return movie
     
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+def import_history_upload():
+    """Bulk import watch history from a Letterboxd/IMDb export or our own CSV/JSON"""
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if upload is None or not upload.filename:
+            return apology("must choose a file to import")
+        head = upload.stream.read(64)
+        upload.stream.seek(0)
+        fmt = request.form.get("format") or detect_format(upload.filename, head)
+        try:
+            # OMDb is left to the enrichment worker, the upload only reads our caches
+            report = import_history(session["user_id"], read_records(upload.stream, fmt), fetch=False)
+        except (ValueError, UnicodeDecodeError) as error:
+            db.session.rollback()
+            return apology(f"Could not read the file: {error}")
+        return render_template("import.html", report=report)
+    return render_template("import.html")
+
+@app.cli.command("import-history")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--user", "username", required=True, help="Username to import the history for.")
+@click.option("--format", "fmt", type=click.Choice(["csv", "json"]), help="Default: from the file name or content.")
+@click.option("--batch-size", type=int, help="Rows per transaction (default IMPORT_BATCH_SIZE).")
+def import_history_command(file, username, fmt, batch_size):
+    """Bulk import watch history from a Letterboxd/IMDb export or our own CSV/JSON."""
+    user = Users.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user {username!r}")
+    with open(file, "rb") as f:
+        fmt = fmt or detect_format(file, f.read(64))
+        f.seek(0)
+        def progress(report):
+            click.echo(f"{report['rows']} rows read, {report['imported']} imported "
+                       f"({report['rows_per_second']} rows/s)", err=True)
+        report = import_history(user.id, read_records(f, fmt), batch_size=batch_size, progress=progress)
+    click.echo(json.dumps(report, indent=2, default=str))
+
+def import_history(user_id, records, batch_size=None, workers=None, progress=None, fetch=True):
+    """
+    Import (line number, raw row) records into the user's watch history.
+
+    Rows are normalized, deduplicated on (movie_id, watch_date) against the
+    file itself and the user's existing history, looked up batch by batch
+    through the OMDb cache (by IMDb id when the file has it, else by title and
+    year), and written with one multi-row insert per table and one commit per
+    batch. Movies OMDb wasn't asked about, because it is down or fetch is
+    False, are added as the file has them and queued for the enrichment
+    worker. Returns a report of what happened to each row.
+    """
+    batch_size = batch_size or app.config["IMPORT_BATCH_SIZE"]
+    workers = workers or app.config["IMPORT_OMDB_WORKERS"]
+    report = {"rows": 0, "imported": 0, "duplicates": 0, "rejected": 0, "queued": 0,
+              "reasons": Counter(), "rejections": [], "seconds": 0, "rows_per_second": 0}
+    seen = set()
+    start = time.perf_counter()
+    for batch in batched(records, batch_size):
+        import_batch(user_id, batch, seen, report, workers, fetch)
+        report["seconds"] = round(time.perf_counter() - start, 3)
+        report["rows_per_second"] = round(report["rows"] / max(report["seconds"], 0.001), 1)
+        if progress:
+            progress(report)
+    report["reasons"] = dict(report["reasons"])
+    return report
+
+def reject(report, line, title, reason):
+    report["rejected"] += 1
+    report["reasons"][reason] += 1
+    # the first rows are enough to see what's wrong with a file
+    if len(report["rejections"]) < 100:
+        report["rejections"].append({"line": line, "title": title, "reason": reason})
+
+def import_batch(user_id, batch, seen, report, workers, fetch):
+    rows = []
+    for line, raw in batch:
+        report["rows"] += 1
+        try:
+            rows.append((line, normalize(raw)))
+        except Rejected as error:
+            reject(report, line, raw.get("Title") or raw.get("Name") or raw.get("title")
+                   if isinstance(raw, dict) else None, str(error))
+
+    queries = [(record["title"], record["imdb_id"], record["year"]) for _, record in rows]
+    movies = cached_lookup_many(queries, workers, fetch)
+
+    accepted = []
+    found = {}
+    # movies the enrichment worker is to look up
+    unknown = set()
+    for (line, record), query in zip(rows, queries):
+        movie = movies.get(lookup_key(*query), _MISSING)
+        if movie is None:
+            reject(report, line, record["title"], "movie not found on OMDb")
+            continue
+        if movie is _MISSING:
+            movie = {"title": record["title"], "imdb_id": record["imdb_id"], "year": record["year"],
+                     "genre": None, "director": None, "language": None, "poster": None,
+                     "imdb_rating": None, "boxoffice": None}
+        # the same movie whatever title the file used for it
+        movie_key = movie.get("imdb_id") or lookup_key(movie["title"], year=movie["year"])
+        if movie["boxoffice"] is None and movie["imdb_rating"] is None:
+            unknown.add(movie_key)
+        if (movie_key, record["watch_date"]) in seen:
+            report["duplicates"] += 1
+            continue
+        seen.add((movie_key, record["watch_date"]))
+        found[movie_key] = movie
+        accepted.append((movie_key, movie, record))
+    if not accepted:
+        return
+
+    movie_rows, added = get_or_add_movies(list(found.values()))
+    movie_ids = {movie_key: row.id for movie_key, row in zip(found, movie_rows)}
+    added_ids = {movie.id for movie in added}
+    for movie_key in unknown & movie_ids.keys():
+        report["queued"] += enqueue_enrichment(movie_ids[movie_key], added=movie_ids[movie_key] in added_ids)
+    watches = {}
+    for movie_key, movie, record in accepted:
+        watches[(movie_ids[movie_key], record["watch_date"])] = {
+            "user_id": user_id,
+            "movie_id": movie_ids[movie_key],
+            "watch_date": record["watch_date"],
+            "personal_rating": record["personal_rating"],
+            "comments": record["comments"],
+            "imdb_rating": as_float(movie["imdb_rating"]),
+            "boxoffice": movie["boxoffice"],
+            "boxoffice_amount": parse_boxoffice(movie["boxoffice"]),
+        }
+
+    existing = db.session.query(Watch_history.movie_id, Watch_history.watch_date).filter(
+        Watch_history.user_id==user_id,
+        Watch_history.movie_id.in_(set(movie_ids.values()))
+    )
+    for movie_id, watch_date in existing:
+        if watches.pop((movie_id, watch_date), None) is not None:
+            report["duplicates"] += 1
+
+    insert_or_ignore(Watch_history, list(watches.values()))
+    # the stored dashboard summary is rebuilt on the next visit
+    User_stats.query.filter_by(user_id=user_id).delete()
+    bump_data_version([user_id])
+    db.session.commit()
+    report["imported"] += len(watches)
+
+def on_conflict_do_nothing(model):
+    """
+    INSERT into model's table that skips rows repeating its primary key or a
+    unique column: ON CONFLICT DO NOTHING, which SQLite also reads as INSERT OR IGNORE.
+    """
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model.__table__).on_conflict_do_nothing()
+
+def insert_or_ignore(model, rows):
+    """Insert rows (dicts) in one executemany, skipping those whose primary key already exists."""
+    if not rows:
+        return
+    db.session.execute(on_conflict_do_nothing(model), rows)
+
+@app.route("/export", methods=["GET"])
+@login_required
+def export():
+    """Download the watch history or wishlist as CSV, NDJSON or Parquet"""
+    table = request.args.get("table", "history")
+    fmt = request.args.get("format", "csv")
+    if table not in ("history", "wishlist") or fmt not in FORMATS:
+        return apology("Unknown export")
+
+    user_id = session["user_id"]
+    try:
+        chunks = export_chunks(user_id, table, fmt)
+    except ExportUnavailable as error:
+        return apology(str(error))
+
+    mimetype, extension = FORMATS[fmt]
+    etag = export_etag(user_id, table, fmt)
+    headers = {"Content-Disposition": f'attachment; filename="movie-tracker-{table}.{extension}"',
+               "Accept-Ranges": "bytes",
+               "ETag": f'"{etag}"'}
+
+    # Resuming a download: If-Range makes sure the data hasn't changed since the first
+    # part. The range needs the total length up front: it is kept under the ETag by an
+    # earlier response, otherwise the export is encoded once into a spooled file
+    if_range = request.if_range
+    if (request.range is not None and len(request.range.ranges) == 1
+            and (if_range.etag == etag or (if_range.etag is None and if_range.date is None))):
+        total = stats_cache.get(f"export-size:{etag}")
+        if total is None:
+            spooled = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MEMORY)
+            for chunk in chunks:
+                spooled.write(chunk)
+            total = spooled.tell()
+            stats_cache.set(f"export-size:{etag}", total, app.config["STATS_CACHE_TTL"])
+            chunks = read_spooled(spooled)
+        satisfiable = request.range.range_for_length(total)
+        if satisfiable is None:
+            chunks.close()
+            return "", 416, {"Content-Range": f"bytes */{total}"}
+        start, stop = satisfiable
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{total}"
+        headers["Content-Length"] = str(stop - start)
+        return app.response_class(stream_with_context(byte_range(chunks, start, stop)), 206,
+                                  headers=headers, mimetype=mimetype)
+    return app.response_class(stream_with_context(keep_export_size(chunks, etag)), headers=headers,
+                              mimetype=mimetype)
+
+# an export being resumed without a known length is spooled in memory up to this size, then on disk
+EXPORT_SPOOL_MEMORY = 8 * 1024 * 1024
+
+def read_spooled(spooled, block_size=64 * 1024):
+    """The content of a spooled file, block_size bytes at a time; the file is closed at the end."""
+    with spooled:
+        spooled.seek(0)
+        block = spooled.read(block_size)
+        while block:
+            yield block
+            block = spooled.read(block_size)
+
+def keep_export_size(chunks, etag):
+    """Pass the export's chunks on, then keep its total size under etag for the range requests resuming it."""
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        yield chunk
+    stats_cache.set(f"export-size:{etag}", total, app.config["STATS_CACHE_TTL"])
+
+@app.cli.command("export")
+@click.argument("username")
+@click.option("--table", type=click.Choice(["history", "wishlist"]), default="history")
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="csv")
+@click.option("-o", "--output", type=click.File("wb"), default="-", help="Default: standard output.")
+def export_command(username, table, fmt, output):
+    """Export a user's watch history or wishlist."""
+    user = Users.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user {username!r}")
+    try:
+        for chunk in export_chunks(user.id, table, fmt):
+            output.write(chunk)
+    except ExportUnavailable as error:
+        raise click.ClickException(str(error))
+
+def export_chunks(user_id, table, fmt):
+    """The encoded export, read with a server-side cursor EXPORT_CHUNK_ROWS rows at a time."""
+    if table == "history":
+        columns = HISTORY_COLUMNS
+        query = db.session.query(
+            Movies.title, Movies.year, Movies.genre, Movies.director, Movies.language,
+            Watch_history.watch_date, Watch_history.personal_rating, Watch_history.comments,
+            Watch_history.imdb_rating, Watch_history.boxoffice
+        ).join(
+            Watch_history
+        ).filter(
+            Watch_history.user_id==user_id
+        ).order_by(
+            Watch_history.watch_date, Movies.title, Watch_history.movie_id
+        )
+    else:
+        columns = WISHLIST_COLUMNS
+        query = db.session.query(
+            Movies.title, Movies.year, Movies.genre, Movies.director, Movies.language,
+            Wishlist.comments, Wishlist.imdb_rating, Wishlist.boxoffice
+        ).join(
+            Wishlist
+        ).filter(
+            Wishlist.user_id==user_id
+        ).order_by(
+            Movies.title, Wishlist.movie_id
+        )
+    chunk_rows = app.config["EXPORT_CHUNK_ROWS"]
+    return encode(query.yield_per(chunk_rows), columns, fmt, chunk_rows)
+
+def export_etag(user_id, table, fmt):
+    """
+    Names the version of the export. Every change to the user's history or
+    wishlist, or to a movie in them, bumps their data_version (see
+    bump_data_version()), so a resumed download can't mix two versions.
+    """
+    # from the database: the stats cache's copy can lag behind in other processes
+    version = db.session.query(Users.data_version).filter_by(id=user_id).scalar()
+    return hashlib.sha1(f"export:{user_id}:{version}:{table}:{fmt}".encode()).hexdigest()[:20]
+
+# OMDb enrichment queue
+enrichment_rate = RateLimiter(app.config["ENRICH_OMDB_RATE"])
+enrichment_logger = logging.getLogger("enrichment")
+
+def enqueue_enrichment(movie_id, added=False):
+    """
+    Queue a refresh of the movie from OMDb, in the caller's transaction, unless
+    one is pending; returns whether it was queued. added: the movie was added
+    in this transaction, so it has no jobs yet.
+    """
+    pending = None
+    if not added:
+        pending = Enrichment_jobs.query.filter(
+            Enrichment_jobs.movie_id==movie_id,
+            Enrichment_jobs.status.in_(("queued", "running"))
+        ).first()
+    if pending is None:
+        now = datetime.utcnow()
+        db.session.add(Enrichment_jobs(movie_id=movie_id, status="queued", attempts=0, run_after=now,
+                                       created_at=now, updated_at=now))
+    return pending is None
+
+def claim_enrichment_job(worker):
+    """Take the next due job (or one abandoned by a crashed worker), return it or None."""
+    now = datetime.utcnow()
+    abandoned = now - timedelta(seconds=app.config["ENRICH_JOB_TIMEOUT"])
+    candidates = db.session.query(
+        Enrichment_jobs.id, Enrichment_jobs.status, Enrichment_jobs.attempts
+    ).filter(
+        or_(and_(Enrichment_jobs.status=="queued", Enrichment_jobs.run_after <= now),
+            and_(Enrichment_jobs.status=="running", Enrichment_jobs.locked_at < abandoned))
+    ).order_by(
+        Enrichment_jobs.run_after
+    ).limit(10)
+    if db.engine.dialect.name == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+    for job_id, status, attempts in candidates.all():
+        # only one worker wins a job, even where SKIP LOCKED isn't available
+        claimed = Enrichment_jobs.query.filter_by(id=job_id, status=status, attempts=attempts).update(
+            {"status": "running", "attempts": attempts + 1, "locked_by": worker, "locked_at": now,
+             "updated_at": now}, synchronize_session=False)
+        if claimed:
+            db.session.commit()
+            return db.session.get(Enrichment_jobs, job_id)
+    db.session.rollback()
+    return None
+
+def run_enrichment_job(job):
+    now = datetime.utcnow()
+    movie = db.session.get(Movies, job.movie_id)
+    if movie is None:
+        job.status = "dead"
+        job.last_error = "movie no longer exists"
+        job.updated_at = now
+        db.session.commit()
+        return
+    enrichment_rate.acquire()
+    year = movie.year
+    try:
+        result = fetch_movie(movie.title, movie.imdb_id, year)
+        if result is None and movie.imdb_id is None and year is not None:
+            # the year may be off, files and users don't always give the release year
+            year = None
+            enrichment_rate.acquire()
+            result = fetch_movie(movie.title)
+    except OmdbUnavailable as error:
+        job.last_error = str(error) or type(error).__name__
+        if job.attempts >= app.config["ENRICH_MAX_ATTEMPTS"]:
+            job.status = "dead"
+        else:
+            job.status = "queued"
+            job.run_after = now + timedelta(seconds=app.config["ENRICH_RETRY_BASE"] * 2 ** (job.attempts - 1))
+        job.updated_at = now
+        db.session.commit()
+        return
+
+    if movie.imdb_id is None:
+        key = lookup_key(movie.title, year=year)
+        store_lookup(key, db.session.get(Omdb_cache, key), result, now)
+    if result is None:
+        # retrying won't help, leave it for someone to look at
+        job.status = "dead"
+        job.last_error = "movie not found on OMDb"
+    else:
+        apply_movie_metadata(movie, result)
+        job.status = "done"
+        job.last_error = None
+    job.updated_at = now
+    db.session.commit()
+
+def apply_movie_metadata(movie, result):
+    """
+    Overwrite a movie's details with OMDb's, retagging it if genre, director
+    or language changed, and fill in the IMDb rating and box office of the
+    rows imported before OMDb was asked about it. The stored dashboards of
+    everyone who has the movie are dropped when anything they count changed.
+    """
+    retag = any(getattr(movie, kind) != result[kind] for kind in TAG_KINDS)
+    restat = retag or movie.year != as_int(result["year"])
+    movie.year = as_int(result["year"])
+    movie.genre = result["genre"]
+    movie.director = result["director"]
+    movie.language = result["language"]
+    movie.poster_url = result["poster"]
+    # unless another movie has that IMDb id already
+    if movie.imdb_id is None and result.get("imdb_id") and \
+            Movies.query.filter_by(imdb_id=result["imdb_id"]).first() is None:
+        movie.imdb_id = result["imdb_id"]
+    if retag:
+        Movie_tags.query.filter_by(movie_id=movie.id).delete()
+        tag_movies([movie])
+    details = {"imdb_rating": as_float(result["imdb_rating"]), "boxoffice": result["boxoffice"],
+               "boxoffice_amount": parse_boxoffice(result["boxoffice"])}
+    for model in (Watch_history, Wishlist):
+        restat |= model.query.filter(model.movie_id==movie.id, model.imdb_rating.is_(None),
+                                     model.boxoffice.is_(None)).update(details, synchronize_session=False) > 0
+    # posters and years show on the dashboards of everyone who has it
+    user_ids = [user_id for user_id, in db.session.query(Watch_history.user_id).filter_by(movie_id=movie.id)] + \
+               [user_id for user_id, in db.session.query(Wishlist.user_id).filter_by(movie_id=movie.id)]
+    if restat and user_ids:
+        # the stored summaries counted the old details; get_stats_summary() rebuilds them
+        User_stats.query.filter(User_stats.user_id.in_(set(user_ids))).delete(synchronize_session=False)
+    bump_data_version(user_ids)
+
+def enrichment_worker(name, stop, once=False):
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                job = claim_enrichment_job(name)
+                if job is None:
+                    if once:
+                        return
+                    stop.wait(app.config["ENRICH_POLL_INTERVAL"])
+                    continue
+                run_enrichment_job(job)
+            except Exception:
+                db.session.rollback()
+                enrichment_logger.exception("Enrichment worker %s failed", name)
+                stop.wait(app.config["ENRICH_POLL_INTERVAL"])
+
+def enrichment_status():
+    counts = dict(db.session.query(Enrichment_jobs.status, func.count()).group_by(Enrichment_jobs.status).all())
+    oldest = db.session.query(func.min(Enrichment_jobs.run_after)).filter(Enrichment_jobs.status=="queued").scalar()
+    dead = Enrichment_jobs.query.filter_by(status="dead").order_by(Enrichment_jobs.updated_at.desc()).limit(20)
+    return {"counts": {status: counts.get(status, 0) for status in ("queued", "running", "done", "dead")},
+            "oldest_queued": oldest.isoformat() if oldest else None,
+            "dead": [{"id": job.id, "movie_id": job.movie_id, "attempts": job.attempts, "error": job.last_error}
+                     for job in dead]}
+
+@app.route("/enrichment/status", methods=["GET"])
+@login_required
+def enrichment_status_api():
+    """Queue counts and the latest dead jobs, or with ?movie_id= the jobs of one movie"""
+    if request.args.get("movie_id"):
+        jobs = Enrichment_jobs.query.filter_by(movie_id=request.args.get("movie_id", type=int)).order_by(Enrichment_jobs.id)
+        return {"jobs": [{"id": job.id, "status": job.status, "attempts": job.attempts,
+                          "run_after": job.run_after.isoformat(), "error": job.last_error} for job in jobs]}
+    return enrichment_status()
+
+enrichment_cli = AppGroup("enrichment", help="Run and inspect the OMDb enrichment queue.")
+app.cli.add_command(enrichment_cli)
+
+@enrichment_cli.command("worker")
+@click.option("--threads", type=int, help="Default: ENRICH_WORKERS.")
+@click.option("--once", is_flag=True, help="Exit when no job is due instead of waiting for more.")
+def enrichment_worker_command(threads, once):
+    """Process enrichment jobs until stopped."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    workers = [threading.Thread(target=enrichment_worker, args=(f"{os.getpid()}-{i}", stop, once))
+               for i in range(threads or app.config["ENRICH_WORKERS"])]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+    click.echo(json.dumps(enrichment_status()["counts"]))
+
+@enrichment_cli.command("status")
+def enrichment_status_command():
+    """Show queue counts and the latest dead jobs."""
+    click.echo(json.dumps(enrichment_status(), indent=2))
+
+@enrichment_cli.command("retry")
+@click.argument("job_ids", nargs=-1, type=int)
+def enrichment_retry(job_ids):
+    """Queue dead jobs again, only JOB_IDS if given."""
+    query = Enrichment_jobs.query.filter_by(status="dead")
+    if job_ids:
+        query = query.filter(Enrichment_jobs.id.in_(job_ids))
+    count = query.update({"status": "queued", "attempts": 0, "run_after": datetime.utcnow()},
+                         synchronize_session=False)
+    db.session.commit()
+    click.echo(f"Queued {count} jobs again")
+
+@enrichment_cli.command("refresh")
+@click.option("--missing-posters", is_flag=True, help="Only movies without a poster.")
+def enrichment_refresh(missing_posters):
+    """Queue every movie (or those missing a poster) for a refresh from OMDb."""
+    query = Movies.query
+    if missing_posters:
+        query = query.filter(or_(Movies.poster_url.is_(None), Movies.poster_url=="N/A"))
+    movies = [movie.id for movie in query]
+    for movie_id in movies:
+        enqueue_enrichment(movie_id)
+    db.session.commit()
+    click.echo(f"Queued {len(movies)} movies")
+
+# Poster proxy
+poster_cache = PosterCache(app.config["POSTER_CACHE_DIR"])
+
+def poster_width(width):
+    """The smallest configured width at least as wide as asked for."""
+    widths = sorted(app.config["POSTER_WIDTHS"])
+    return next((w for w in widths if width is not None and w >= width), widths[-1])
+
+@app.template_global()
+def poster_src(movie_id, poster_url, width):
+    """Url of the cached, resized poster. v= changes with the poster, so the image can be cached forever."""
+    version = hashlib.sha1(poster_url.encode()).hexdigest()[:10]
+    return f"/poster/{movie_id}?w={poster_width(width)}&v={version}"
+
+@app.route("/poster/<int:movie_id>", methods=["GET"])
+@login_required
+def poster(movie_id):
+    """A movie's poster from the local cache, resized to ?w="""
+    movie = db.session.get(Movies, movie_id)
+    if movie is None or not movie.poster_url or movie.poster_url == "N/A":
+        return "No poster", 404
+    try:
+        path, mimetype, etag = poster_cache.thumbnail(movie.poster_url, poster_width(request.args.get("w", type=int)))
+    except PosterUnavailable:
+        # let the browser try the original
+        return redirect(movie.poster_url)
+    # the url carries the poster's version, so it never changes under the same url
+    max_age = 365 * 24 * 3600 if request.args.get("v") else 24 * 3600
+    response = send_file(path, mimetype=mimetype, etag=etag, max_age=max_age, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = bool(request.args.get("v"))
+    return response
+
+posters_cli = AppGroup("posters", help="Manage the local poster cache.")
+app.cli.add_command(posters_cli)
+
+@posters_cli.command("prewarm")
+@click.option("--width", "widths", type=int, multiple=True, help="Default: every POSTER_WIDTHS.")
+@click.option("--workers", type=int, default=8, help="Concurrent downloads.")
+def posters_prewarm(widths, workers):
+    """Download and resize the poster of every movie."""
+    widths = [poster_width(width) for width in widths] or app.config["POSTER_WIDTHS"]
+    urls = [url for url, in db.session.query(Movies.poster_url).filter(
+        Movies.poster_url.isnot(None), Movies.poster_url != "N/A").distinct()]
+
+    def warm(url):
+        try:
+            for width in widths:
+                poster_cache.thumbnail(url, width)
+            return None
+        except PosterUnavailable as error:
+            return str(error)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for url, error in zip(urls, pool.map(warm, urls)):
+            if error:
+                failed += 1
+                click.echo(f"{url}: {error}", err=True)
+    click.echo(f"Cached {len(urls) - failed} of {len(urls)} posters at widths {', '.join(map(str, widths))}")
+
 @app.route("/posterwall", methods=["GET"])
 @login_required
 def poster_wall():
-    poster_list = []
-    # # Retrieve the image data from the database
-
-    all_movies = db.session.query(
-        Movies, Watch_history
+    # each movie once, in the order it was first watched
+    first_watched = func.min(Watch_history.watch_date).label("first_watched")
+    query = db.session.query(
+        Movies.id, Movies.title, Movies.poster_url, first_watched
     ).join(
         Watch_history
     ).filter(
-        Watch_history.user_id==session["user_id"]
+        Watch_history.user_id==session["user_id"],
+        # still waiting for the enrichment worker, or OMDb has none
+        Movies.poster_url.isnot(None),
+        Movies.poster_url != "N/A"
+    ).group_by(
+        Movies.id, Movies.title, Movies.poster_url
     ).order_by(
-        Watch_history.watch_date
-    ).all()
-
-
-    for movie, watch_history in all_movies:
-        poster = movie.poster_url
-        if poster not in poster_list:
-            poster_list.append(poster)
-
-    return render_template("poster_wall.html", poster_list=poster_list)
+        first_watched, Movies.id
+    )
+
+    # Keyset pagination: continue right after the (first watch date, movie id) of the last poster shown
+    if request.args.get("cursor"):
+        try:
+            watch_date, movie_id = decode_cursor(request.args.get("cursor"))
+            watch_date, movie_id = date.fromisoformat(watch_date), int(movie_id)
+        except (TypeError, ValueError):
+            return apology("Invalid page cursor")
+        query = query.having(or_(first_watched > watch_date,
+                                 and_(first_watched == watch_date, Movies.id > movie_id)))
+
+    page_size = app.config["POSTER_WALL_PAGE_SIZE"]
+    results = query.limit(page_size + 1).all()
+    poster_list = [(movie_id, title, poster_url) for movie_id, title, poster_url, _ in results[:page_size]]
+    next_cursor = None
+    if len(results) > page_size:
+        last = results[page_size - 1]
+        next_cursor = encode_cursor(as_date(last.first_watched).isoformat(), last.id)
+
+    # infinite scroll asks for the next posters only
+    if request.args.get("partial"):
+        return render_template("poster_wall_items.html", poster_list=poster_list), {"X-Next-Cursor": next_cursor or ""}
+    return render_template("poster_wall.html", poster_list=poster_list, next_cursor=next_cursor)
+
+def as_date(value):
+    # SQLite returns MIN() of a date column as a string
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+# Recommendations
+# Each worker process keeps its own model: fitted in a background thread on
+# first use, then kept current by the update and refit tasks. A user's ratings
+# are reloaded whenever their data_version moved since the model last saw them.
+recommender_logger = logging.getLogger("recommender")
+# genres and directors are the features of a movie
+RECOMMEND_TAG_KINDS = ("genre", "director")
+try:
+    recommender = Recommender(app.config["RECOMMEND_NEIGHBORS"], app.config["RECOMMEND_CONTENT_WEIGHT"])
+except RecommenderUnavailable:
+    recommender = None
+recommender_first_fit = {"pid": None}
+recommender_first_fit_lock = threading.Lock()
+
+def movie_features(movie_ids=None):
+    """(movie_id, tag id) of the genres and directors of the movies, of every movie by default."""
+    query = db.session.query(Movie_tags.movie_id, Movie_tags.tag_id).join(Tags).filter(
+        Tags.kind.in_(RECOMMEND_TAG_KINDS))
+    if movie_ids is not None:
+        query = query.filter(Movie_tags.movie_id.in_(movie_ids))
+    return query.all()
+
+def fit_recommender():
+    """Fit this process's recommender on every watch (the RECOMMEND_REFIT_INTERVAL task)."""
+    start = time.perf_counter()
+    with app.app_context():
+        # versions first: a watch committed in between only makes a profile look stale
+        versions = {user_id: version or 0 for user_id, version in db.session.query(Users.id, Users.data_version)}
+        ratings = db.session.query(Watch_history.user_id, Watch_history.movie_id,
+                                   Watch_history.personal_rating).yield_per(10000)
+        recommender.fit(ratings, movie_features(), versions)
+    recommender_logger.info("Fitted recommender on %d users in %.2f s", len(versions), time.perf_counter() - start)
+
+def update_recommender():
+    """Fold the ratings loaded since the last update into the neighbors (the RECOMMEND_UPDATE_INTERVAL task)."""
+    updated = recommender.update()
+    if updated:
+        recommender_logger.info("Updated the neighbors of %d movies", updated)
+
+recommender_refit = PeriodicTask(fit_recommender, app.config["RECOMMEND_REFIT_INTERVAL"])
+recommender_update = PeriodicTask(update_recommender, app.config["RECOMMEND_UPDATE_INTERVAL"])
+
+def current_recommender():
+    """The recommender of this process, None without numpy/scipy or while its first fit runs."""
+    if recommender is None:
+        return None
+    recommender_refit.start()
+    recommender_update.start()
+    if not recommender.ready:
+        with recommender_first_fit_lock:
+            if recommender_first_fit["pid"] != os.getpid():
+                recommender_first_fit["pid"] = os.getpid()
+                threading.Thread(target=fit_recommender, name="recommender-fit", daemon=True).start()
+        return None
+    return recommender
+
+def recommend_movies(user_id, n, wishlist_only=False):
+    """
+    [(Movies row, score)] of the n movies to watch next for the user, best
+    first, only from their wishlist with wishlist_only. None while there is
+    no recommender.
+    """
+    model = current_recommender()
+    if model is None:
+        return None
+    version = data_version(user_id)
+    if model.profile_version(user_id) != version:
+        ratings = db.session.query(Watch_history.movie_id, Watch_history.personal_rating).filter_by(
+            user_id=user_id).all()
+        unknown = model.unknown({movie_id for movie_id, _ in ratings})
+        model.set_profile(user_id, ratings, version, movie_features(unknown) if unknown else ())
+    candidates = None
+    if wishlist_only:
+        candidates = [movie_id for movie_id, in db.session.query(Wishlist.movie_id).filter_by(user_id=user_id)]
+    picks = model.recommend(user_id, n, candidates)
+    movies = {movie.id: movie for movie in Movies.query.filter(Movies.id.in_([movie_id for movie_id, _ in picks]))}
+    return [(movies[movie_id], score) for movie_id, score in picks if movie_id in movies]
+
+def recommendation_answers(user_id):
+    """The "What to Watch Next" cards of the recommender, as (question, answer) pairs for build_cards()."""
+    picks = recommend_movies(user_id, 2)
+    if picks is None:
+        return []
+    wished = recommend_movies(user_id, 1, wishlist_only=True)
+    posters = poster_resolver()
+    for movie, _ in picks + wished:
+        posters.prime(movie.id, movie.title, movie.poster_url)
+    return [("Recommended for you", [movie.id for movie, _ in picks] or NO_HISTORY),
+            ("Best match in your Wish List", [movie.id for movie, _ in wished] or NO_WISHLIST)]
+
+@app.route("/recommendations", methods=["GET"])
+@login_required
+def recommendations():
+    """The user's top ?n= movies to watch next (?wishlist=1: from their wishlist) as JSON"""
+    n = request.args.get("n", 10, type=int)
+    if not 1 <= n <= app.config["RECOMMEND_MAX_N"]:
+        return {"error": f"n must be between 1 and {app.config['RECOMMEND_MAX_N']}"}, 400
+    picks = recommend_movies(session["user_id"], n, wishlist_only=request.args.get("wishlist") == "1")
+    if picks is None:
+        # 503 until the first fit is done, or for good without numpy/scipy
+        return {"error": "recommendations are not available yet", "available": recommender is not None}, 503
+    wished = {movie_id for movie_id, in db.session.query(Wishlist.movie_id).filter(
+        Wishlist.user_id==session["user_id"], Wishlist.movie_id.in_([movie.id for movie, _ in picks]))}
+    return {"n": n, "results": [{"movie_id": movie.id, "title": movie.title, "year": movie.year,
+                                 "genre": movie.genre, "score": round(score, 4), "in_wishlist": movie.id in wished}
+                                for movie, score in picks]}
+
+# Stats dashboard cache
+def make_stats_cache(backend):
+    if backend == "memory":
+        return LRUCache(app.config["STATS_CACHE_SIZE"])
+    elif backend == "filesystem":
+        return FileSystemCache(app.config["STATS_CACHE_DIR"], threshold=0)
+    elif backend == "database":
+        return DatabaseCache(Response_cache.__table__, lambda: db.engine)
+    elif backend == "none":
+        return NullCache()
+    raise RuntimeError(f"Unknown STATS_CACHE_BACKEND {backend!r}")
+
+stats_cache = make_stats_cache(app.config["STATS_CACHE_BACKEND"])
+
+def bump_data_version(user_ids=None):
+    """
+    Mark the users' (everyone's by default) history or wishlist as changed, in
+    the caller's transaction. Their cached dashboards are dropped once it commits.
+    """
+    query = Users.query
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+        query = query.filter(Users.id.in_(user_ids))
+    query.update({Users.data_version: Users.data_version + 1}, synchronize_session=False)
+    bumped = db.session.info.setdefault("bumped_users", set())
+    if user_ids is None:
+        db.session.info["bumped_everyone"] = True
+    else:
+        bumped.update(user_ids)
+
+@event.listens_for(db.session, "after_commit")
+def forget_data_versions(session):
+    if session.info.pop("bumped_everyone", False):
+        stats_cache.clear()
+    for user_id in session.info.pop("bumped_users", ()):
+        stats_cache.delete(f"data-version:{user_id}")
+
+@event.listens_for(db.session, "after_soft_rollback")
+def keep_data_versions(session, previous_transaction):
+    # a rolled back savepoint doesn't undo the bumps made outside it
+    if previous_transaction.parent is None:
+        session.info.pop("bumped_everyone", None)
+        session.info.pop("bumped_users", None)
+
+def data_version(user_id):
+    """The user's data_version, from the stats cache when it is there."""
+    key = f"data-version:{user_id}"
+    version = stats_cache.get(key)
+    if version is None:
+        version = db.session.query(Users.data_version).filter_by(id=user_id).scalar() or 0
+        stats_cache.set(key, version, app.config["STATS_CACHE_VERSION_TTL"])
+    return version
 
 @app.route("/stats", methods=["GET"])
 @login_required
 def stats():
-    basic_stats = []
-    favorite = []
-    favorite_with_img = []
-    favorite_with_img_2 = []
-    others = []
-    others_with_img = []
-    others_with_img_2 = []
-    watch_next = []
-    watch_next_with_img = []
-    watch_next_with_img_2 = []
-    stats_list = list()
-    stats_list_with_image = list()
-    stats_list_with_image_2 = list()
-    # Basic stats
-    # total movies watched
-    results = db.session.query(Watch_history).filter_by(user_id=session["user_id"]).count()
-    basic_stats.append({"question": "Movies in your Watch History", 
-                        "answer": results})
-    
-    # number of movies you watched this year
-    current_year = datetime.now().year
-    results = Watch_history.query.filter(Watch_history.user_id==session["user_id"],
-                               extract('year', Watch_history.watch_date) == current_year).count()
-    basic_stats.append({"question": "Movies you Watched This Year", 
-                        "answer": results})
-    
-    # days since you last watched a movie
-    results = find_most_recent_watch()
-    basic_stats.append({"question": "Days since you last watched a movie", 
-                        "answer": results})
-    
-    # number of wishlist items
-    results = db.session.query(Wishlist).filter_by(user_id=session["user_id"]).count()
-    basic_stats.append({"question": "Movies you want to watch", 
-                        "answer": results})
-
-    # Personal Favorites
-    # movies with the highest personal rating
-    results = find_highest(Watch_history, "personal_rating")
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        favorite_with_img.append({"question": "Your Favorite Movie",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        favorite_with_img_2.append({"question": "Your Favorite Movie",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
+    user_id = session["user_id"]
+    today = date.today()
+    # "days since" and "this year" change with the date, not only with the data,
+    # and the recommendation cards appear once the recommender is ready
+    ready = recommender is not None and recommender.ready
+    etag = hashlib.sha1(f"{user_id}:{data_version(user_id)}:{today}:{ready}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
     else:
-        favorite.append({"question": "Your Favorite Movie",  
-                                  "answer": results})
-        
-
-    # movies you watched the most times
-    results = most_watch()
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        favorite_with_img.append({"question": "You can't stop re-watching", 
-                        "answer": results,
-                        "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        favorite_with_img_2.append({"question": "You can't stop re-watching",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        favorite.append({"question": "You can't stop re-watching",  
-                                  "answer": results})
-    
-    # favorite genre
-    results = find_favorite("genre")
-    favorite.append({"question": "Your favorite genre", 
-                        "answer": results})
-    
-    # favorite director
-    results = find_favorite("director")
-    favorite.append({"question": "Your favorite director", 
-                        "answer": results})
-    
-    # unique movies watched
-    # results = db.session.query(Watch_history.movie_id).filter_by(user_id=session["user_id"]).distinct().count()
-    # stats_list.append({"question": "Number of unique movies you have watched", 
-    #                     "answer": results})
-    
-    # Comparing to others
-    # watch history with the highest box office 
-    results = find_highest_box_office(Watch_history)
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        others_with_img.append({"question": "Most popular movie you have watched",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        others_with_img_2.append({"question": "Most popular movie you have watched",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        others.append({"question": "Most popular movie you have watched",  
-                                  "answer": results})
-    
-    # watch history with the highest IMDB rating
-    results = find_highest(Watch_history, "imdb_rating")
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        others_with_img.append({"question": "Highest IMDb rating movie you have watched",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        others_with_img_2.append({"question": "Highest IMDb rating movie you have watched",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        others.append({"question": "Highest IMDb rating movie you have watched",  
-                                  "answer": results})
-
-    # movies you love more than imdb
-    results = compare_personal_rating_with_imdb("rate higher")
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        others_with_img.append({"question": "Movie you love way more than other people",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        others_with_img_2.append({"question": "Movie you love way more than other people",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        others.append({"question": "Movie you love way more than other people",  
-                                  "answer": results})
-
-    # movies you under-rate
-    results = compare_personal_rating_with_imdb("rate lower")
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        others_with_img.append({"question": "The most overrated movie you think",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        others_with_img_2.append({"question": "The most overrated movie you think",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        others.append({"question": "The most overrated movie you think",  
-                                  "answer": results})
-
-
-    # Watch next
-    # oldest movie you have watched
-    results = find_oldest_or_newest_movie("old", Wishlist)
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        watch_next_with_img.append({"question": "Some old fashion",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        watch_next_with_img_2.append({"question": "Some old fashion",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        watch_next.append({"question": "Some old fashion",  
-                                  "answer": results})
-
-    # movies with the highest IMDB rating in your wishlist
-    results = find_highest(Wishlist, "imdb_rating")
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        watch_next_with_img.append({"question": "Highest rating",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        watch_next_with_img_2.append({"question": "Highest rating",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
-    else:
-        watch_next.append({"question": "Highest rating",  
-                                  "answer": results})
-        
-    # wishlist with the highest box office
-    results = find_highest_box_office(Wishlist)
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        watch_next_with_img.append({"question": "Most popular",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        watch_next_with_img_2.append({"question": "Most popular",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
+        cached = stats_cache.get(f"stats:{user_id}")
+        if cached is not None and cached["etag"] == etag:
+            body = cached["body"]
+        else:
+            summary = get_stats_summary(user_id)
+            cards = build_cards(summary, poster_resolver().resolve, today, recommendation_answers(user_id))
+            body = render_template("dashboard_cards.html", 
+                                   stats=[], 
+                                   stats_img=[], 
+                                   stats_img_2=[],
+                                   timeline=dashboard_timeline(user_id, today),
+                                   **cards)
+            stats_cache.set(f"stats:{user_id}", {"etag": etag, "body": body}, app.config["STATS_CACHE_TTL"])
+        response = app.response_class(body)
+    response.set_etag(etag)
+    # the browser keeps the page but checks with us every time
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+# what /stats/top can rank: ?list= -> (table, metrics with a (user_id, metric DESC) index)
+TOP_K_METRICS = {
+    "history": (Watch_history, ("personal_rating", "imdb_rating", "boxoffice_amount")),
+    "wishlist": (Wishlist, ("imdb_rating", "boxoffice_amount")),
+}
+
+@app.route("/stats/top", methods=["GET"])
+@login_required
+def stats_top():
+    """The user's top ?k= movies by ?metric= of ?list=, ties included, as JSON"""
+    list_name = request.args.get("list", "history")
+    metric = request.args.get("metric", "personal_rating")
+    if list_name not in TOP_K_METRICS or metric not in TOP_K_METRICS[list_name][1]:
+        return {"error": f"can't rank {list_name} by {metric}"}, 400
+    k = request.args.get("k", 1, type=int)
+    if not 1 <= k <= app.config["STATS_TOP_MAX_K"]:
+        return {"error": f"k must be between 1 and {app.config['STATS_TOP_MAX_K']}"}, 400
+    ranking = top_k(TOP_K_METRICS[list_name][0], metric, session["user_id"], k)
+    return {"list": list_name, "metric": metric, "k": k,
+            "results": [{"rank": rank, "movie_id": movie_id, "title": title, "value": value}
+                        for rank, movie_id, title, value in ranking]}
+
+# Watch history over time
+def period_start_sql(column, period):
+    """
+    SQL for the first day of the week (Monday), month or year of the date
+    column: a date on Postgres, an ISO date string on SQLite.
+    """
+    if db.engine.dialect.name == "postgresql":
+        return cast(func.date_trunc(period, column), db.Date)
+    if period == "week":
+        # the Sunday ending the week, then back to its Monday
+        return func.date(column, "weekday 0", "-6 days")
+    return func.strftime({"month": "%Y-%m-01", "year": "%Y-01-01"}[period], column)
+
+def watch_timeseries(user_id, period, today):
+    """
+    The user's watches, average rating and genre shares per period (see
+    timeseries.series()) and their day and week streaks: three or four GROUP
+    BY queries over the user's slice of the (user_id, watch_date) index.
+    """
+    start = period_start_sql(Watch_history.watch_date, period).label("start")
+    buckets = db.session.query(
+        start, func.count(), func.avg(Watch_history.personal_rating)
+    ).filter(Watch_history.user_id==user_id).group_by(start).all()
+    genre_counts = db.session.query(
+        start, Tags.name, func.count()
+    ).select_from(Watch_history).join(
+        Movie_tags, Movie_tags.movie_id==Watch_history.movie_id
+    ).join(
+        Tags, and_(Tags.id==Movie_tags.tag_id, Tags.kind=="genre")
+    ).filter(Watch_history.user_id==user_id).group_by(start, Tags.name).all()
+    days = db.session.query(Watch_history.watch_date).filter(
+        Watch_history.user_id==user_id).group_by(Watch_history.watch_date).order_by(Watch_history.watch_date)
+    if period == "week":
+        weeks = [start for start, _, _ in buckets]
     else:
-        watch_next.append({"question": "Most popular",  
-                                  "answer": results})    
-    
-    results = find_oldest_or_newest_movie("new", Wishlist)
-    poster = find_poster_url(results)
-    if type(poster)== list and len(poster)==1:
-        watch_next_with_img.append({"question": "Something new",  
-                                    "answer": results,
-                                    "poster": poster[0]})
-    elif type(poster)== list and len(poster)==2:
-        watch_next_with_img_2.append({"question": "Something new",  
-                                    "answer": results,
-                                    "poster_1": poster[0],
-                                    "poster_2": poster[1]})
+        week = period_start_sql(Watch_history.watch_date, "week").label("week")
+        weeks = [start for start, in db.session.query(week).filter(
+            Watch_history.user_id==user_id).group_by(week)]
+    return {
+        "period": period,
+        "buckets": series([(as_date(start), count, rating) for start, count, rating in buckets],
+                          [(as_date(start), genre, count) for start, genre, count in genre_counts], period),
+        "streaks": {"day": streaks([as_date(day) for day, in days], "day", today),
+                    "week": streaks(sorted(as_date(start) for start in weeks), "week", today)},
+    }
+
+def get_watch_timeseries(user_id, period, today):
+    """watch_timeseries(), from the stats cache while the user's data version and the date are the same."""
+    key = f"timeseries:{user_id}:{period}"
+    version = data_version(user_id)
+    cached = stats_cache.get(key)
+    if cached is not None and cached["version"] == version and cached["today"] == today.isoformat():
+        return cached["data"]
+    data = watch_timeseries(user_id, period, today)
+    stats_cache.set(key, {"version": version, "today": today.isoformat(), "data": data},
+                    app.config["STATS_CACHE_TTL"])
+    return data
+
+def dashboard_timeline(user_id, today):
+    """The "Over Time" section of the dashboard: the last TIMELINE_MONTHS months of the history and the streaks."""
+    timeseries = get_watch_timeseries(user_id, "month", today)
+    months = timeseries["buckets"][-app.config["TIMELINE_MONTHS"]:]
+    return {"months": months, "most": max([month["watches"] for month in months], default=0),
+            "streaks": timeseries["streaks"]}
+
+@app.route("/stats/timeseries", methods=["GET"])
+@login_required
+def stats_timeseries():
+    """The user's watches, average rating and genre shares per ?period=week|month|year, and streaks, as JSON"""
+    period = request.args.get("period", "month")
+    if period not in PERIODS:
+        return {"error": f"period must be one of {', '.join(PERIODS)}"}, 400
+    user_id = session["user_id"]
+    today = date.today()
+    etag = hashlib.sha1(f"timeseries:{user_id}:{data_version(user_id)}:{today}:{period}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
     else:
-        watch_next.append({"question": "Something new",  
-                                  "answer": results})
-    
-    return render_template("dashboard_cards.html", 
-                           basic_stats=basic_stats, 
-                           favorite=favorite, 
-                           favorite_with_img=favorite_with_img, 
-                           favorite_with_img_2=favorite_with_img_2,
-                           others=others, 
-                           others_with_img=others_with_img, 
-                           others_with_img_2=others_with_img_2,
-                           watch_next=watch_next, 
-                           watch_next_with_img=watch_next_with_img, 
-                           watch_next_with_img_2=watch_next_with_img_2,
-                           stats=stats_list, 
-                           stats_img=stats_list_with_image, 
-                           stats_img_2=stats_list_with_image_2)
-
-def find_highest(table, metric):
-    results = list()
-
-    subquery = db.session.query(
-        table,
-        func.rank().over(
-            order_by=getattr(table, metric).desc(),
-            partition_by=table.user_id
-        ).label('rnk')
-    ).subquery()
-
-    query = db.session.query(subquery).filter(
-        subquery.c.rnk==1,
-        subquery.c.user_id==session["user_id"]
-    ).all()
+        response = app.json.response(get_watch_timeseries(user_id, period, today))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def load_stats_summary(user_id, today):
+    """
+    Read the user's watch history and wishlist once (two queries, Movies
+    joined) into a StatsSummary. The posters of the joined movies go into the
+    request's poster resolver, so the cards don't need to query them again.
+    """
+    summary = StatsSummary()
+    posters = poster_resolver()
+
+    history_rows = db.session.query(
+        Movies.id, Movies.title, Watch_history.watch_date, Watch_history.personal_rating,
+        Watch_history.imdb_rating, Watch_history.boxoffice_amount,
+        Movies.genre, Movies.director, Movies.language, Movies.poster_url
+    ).join(
+        Movies
+    ).filter(
+        Watch_history.user_id==user_id
+    ).order_by(
+        # title order, so ties are listed the way the old per-card queries listed them
+        Movies.title, Watch_history.watch_date, Movies.id
+    )
+    for (movie_id, title, watch_date, personal_rating, imdb_rating, boxoffice_amount,
+         genre, director, language, poster) in history_rows:
+        summary.add_watch(movie_id, watch_date, personal_rating, imdb_rating, boxoffice_amount,
+                          genre, director, language, today)
+        posters.prime(movie_id, title, poster)
+
+    wishlist_rows = db.session.query(
+        Movies.id, Movies.title, Movies.year, Wishlist.imdb_rating, Wishlist.boxoffice_amount, Movies.poster_url
+    ).join(
+        Movies
+    ).filter(
+        Wishlist.user_id==user_id
+    ).order_by(
+        Movies.title, Movies.id
+    )
+    for movie_id, title, year, imdb_rating, boxoffice_amount, poster in wishlist_rows:
+        summary.add_wish(movie_id, year, imdb_rating, boxoffice_amount)
+        posters.prime(movie_id, title, poster)
+
+    return summary
+
+def get_stats_summary(user_id):
+    """Read the user's materialized StatsSummary, building it on first use."""
+    row = db.session.get(User_stats, user_id)
+    if row is not None:
+        return StatsSummary.from_dict(json.loads(row.summary))
+    summary = rebuild_user_stats(user_id)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # built by a concurrent request in the meantime
+        db.session.rollback()
+    return summary
+
+def save_stats_summary(row, user_id, summary):
+    if row is None:
+        row = User_stats(user_id=user_id)
+        db.session.add(row)
+    row.summary = json.dumps(summary.to_dict())
+    row.updated_at = datetime.utcnow()
+
+def rebuild_user_stats(user_id):
+    """
+    Recompute the user's StatsSummary from their rows and store it, as part of
+    the caller's transaction. Used after deletes, where maxima can't be updated
+    incrementally, and to repair drift.
+    """
+    summary = load_stats_summary(user_id, date.today())
+    save_stats_summary(db.session.get(User_stats, user_id), user_id, summary)
+    return summary
+
+def locked_stats_row(user_id):
+    # lock the row so concurrent writes of the same user don't lose updates
+    return User_stats.query.filter_by(user_id=user_id).with_for_update().first()
+
+def as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def stats_watch_added(watch, movie):
+    """Fold a new watch history row (a dict) into the user's StatsSummary, in the caller's transaction."""
+    bump_data_version([watch["user_id"]])
+    row = locked_stats_row(watch["user_id"])
+    if row is None:
+        # never built, get_stats_summary() will build it from scratch
+        return
+    summary = StatsSummary.from_dict(json.loads(row.summary))
+    summary.add_watch(movie.id, watch["watch_date"], as_float(watch["personal_rating"]),
+                      as_float(watch["imdb_rating"]), watch["boxoffice_amount"], movie.genre, movie.director,
+                      movie.language, date.today())
+    save_stats_summary(row, watch["user_id"], summary)
+
+def stats_wish_added(wish, movie):
+    """Fold a new wishlist row (a dict) into the user's StatsSummary, in the caller's transaction."""
+    bump_data_version([wish["user_id"]])
+    row = locked_stats_row(wish["user_id"])
+    if row is None:
+        return
+    summary = StatsSummary.from_dict(json.loads(row.summary))
+    year = as_float(movie.year)
+    summary.add_wish(movie.id, int(year) if year is not None else None,
+                     as_float(wish["imdb_rating"]), wish["boxoffice_amount"])
+    save_stats_summary(row, wish["user_id"], summary)
+
+# Write path
+# Each user action is one transaction, committed by the route. Rows are written
+# with INSERT ... ON CONFLICT DO NOTHING and DELETE, and the affected row count
+# tells whether there was a duplicate (or nothing to act on): no SELECT first,
+# and two concurrent submits of the same action can't both get through.
+class Write(enum.Enum):
+    """Outcome of a write-path action."""
+    DONE = "done"
+    # the user already has that row
+    DUPLICATE = "duplicate"
+    # the row the action applies to isn't there (anymore)
+    MISSING = "missing"
+
+def insert_one_or_ignore(model, row):
+    """Insert row (a dict), False if it repeats a primary key or unique column."""
+    return db.session.execute(on_conflict_do_nothing(model).values(**row)).rowcount == 1
+
+def add_watch(watch, movie):
+    """Add the watch history row watch (a dict) of movie, with its stats."""
+    if not insert_one_or_ignore(Watch_history, watch):
+        return Write.DUPLICATE
+    stats_watch_added(watch, movie)
+    return Write.DONE
+
+def add_wish(wish, movie):
+    """Add the wishlist row wish (a dict) of movie, with its stats."""
+    if not insert_one_or_ignore(Wishlist, wish):
+        return Write.DUPLICATE
+    stats_wish_added(wish, movie)
+    return Write.DONE
+
+def move_wish_to_history(watch):
+    """
+    Replace the user's wishlist row of watch["movie_id"] with the watch history
+    row watch. The DELETE comes first: it locks the wishlist row, so a second
+    submit waits for the first and then finds it gone.
+    """
+    deleted = Wishlist.query.filter_by(user_id=watch["user_id"], movie_id=watch["movie_id"]).delete(synchronize_session=False)
+    if not deleted:
+        return Write.MISSING
+    if not insert_one_or_ignore(Watch_history, watch):
+        return Write.DUPLICATE
+    rebuild_user_stats(watch["user_id"])
+    bump_data_version([watch["user_id"]])
+    return Write.DONE
+
+def remove_watch(user_id, movie_id, watch_date):
+    """Delete the user's watch of movie_id on watch_date, with its stats."""
+    deleted = Watch_history.query.filter_by(user_id=user_id, movie_id=movie_id, watch_date=watch_date).delete(synchronize_session=False)
+    if not deleted:
+        return Write.MISSING
+    rebuild_user_stats(user_id)
+    bump_data_version([user_id])
+    return Write.DONE
+
+def remove_wish(user_id, movie_id):
+    """Delete the user's wishlist row of movie_id, with its stats."""
+    deleted = Wishlist.query.filter_by(user_id=user_id, movie_id=movie_id).delete(synchronize_session=False)
+    if not deleted:
+        return Write.MISSING
+    rebuild_user_stats(user_id)
+    bump_data_version([user_id])
+    return Write.DONE
+
+@app.cli.command("rebuild-stats")
+@click.option("--user-id", type=int, help="Only rebuild this user.")
+def rebuild_stats(user_id):
+    """Recompute the materialized dashboard stats, repairing any drift."""
+    users = [user_id] if user_id else [user.id for user in Users.query.order_by(Users.id)]
+    for uid in users:
+        rebuild_user_stats(uid)
+        bump_data_version([uid])
+        db.session.commit()
+    click.echo(f"Rebuilt stats for {len(users)} users")
+
+@app.cli.command("verify-stats")
+@click.option("--user-id", type=int, help="Only check this user.")
+def verify_stats(user_id):
+    """
+    Check the dashboard answers of the stats engine against the find_* queries,
+    and the stored summaries against the rows, rebuilding those that drifted.
+    """
+    today = date.today()
+    users = [user_id] if user_id else [user.id for user in Users.query.order_by(Users.id)]
+    mismatches = 0
+    rebuilt = 0
+    for uid in users:
+        summary = load_stats_summary(uid, today)
+        row = db.session.get(User_stats, uid)
+        if row is not None:
+            drift = differences(StatsSummary.from_dict(json.loads(row.summary)), summary, today)
+            if drift:
+                click.echo(f"user {uid}, stored summary differs in {', '.join(drift)}: rebuilt")
+                rebuild_user_stats(uid)
+                bump_data_version([uid])
+                rebuilt += 1
+        pairs = [
+            ("history count", summary.history_count, Watch_history.query.filter_by(user_id=uid).count()),
+            ("this year", summary.watched_in_year(today.year), count_watched_in_year(uid, today.year)),
+            ("last watch", summary.days_since_last_watch(today), find_most_recent_watch(uid)),
+            ("wishlist count", summary.wishlist_count, Wishlist.query.filter_by(user_id=uid).count()),
+            ("favorite movie", summary.highest(summary.best_personal, NO_HISTORY),
+             find_highest(Watch_history, "personal_rating", uid)),
+            ("most watched", summary.most_watched(), most_watch(uid)),
+            ("favorite genre", summary.favorite("genre"), find_favorite("genre", uid)),
+            ("favorite director", summary.favorite("director"), find_favorite("director", uid)),
+            ("favorite language", summary.favorite("language"), find_favorite("language", uid)),
+            ("history box office", summary.highest_box_office(summary.best_boxoffice,
+                                                              summary.history_count, NO_HISTORY),
+             find_highest_box_office(Watch_history, uid)),
+            ("history imdb", summary.highest(summary.best_imdb, NO_HISTORY),
+             find_highest(Watch_history, "imdb_rating", uid)),
+            ("rate higher", summary.compare_with_imdb("rate higher"),
+             compare_personal_rating_with_imdb("rate higher", uid)),
+            ("rate lower", summary.compare_with_imdb("rate lower"),
+             compare_personal_rating_with_imdb("rate lower", uid)),
+            ("wishlist oldest", summary.wishlist_by_year("old"), find_oldest_or_newest_movie("old", Wishlist, uid)),
+            ("wishlist imdb", summary.highest(summary.wishlist_best_imdb, NO_WISHLIST),
+             find_highest(Wishlist, "imdb_rating", uid)),
+            ("wishlist box office", summary.highest_box_office(summary.wishlist_best_boxoffice,
+                                                               summary.wishlist_count, NO_WISHLIST),
+             find_highest_box_office(Wishlist, uid)),
+            ("wishlist newest", summary.wishlist_by_year("new"), find_oldest_or_newest_movie("new", Wishlist, uid)),
+        ]
+        for name, engine, query in pairs:
+            # the engine lists movie ids, the queries their titles
+            if type(engine) == list:
+                engine = [title for title, _ in poster_resolver().resolve(engine).values()]
+            # ties come back in no particular order from the queries
+            if type(engine) == list and type(query) == list:
+                engine, query = sorted(engine), sorted(query)
+            if name.startswith("favorite ") and type(query) == str:
+                engine, query = sorted(engine.split(", ")), sorted(query.split(", "))
+            if engine != query:
+                mismatches += 1
+                click.echo(f"user {uid}, {name}: engine {engine!r} != query {query!r}")
+    db.session.commit()
+    click.echo(f"Checked {len(users)} users, {mismatches} mismatches, {rebuilt} stored summaries rebuilt")
+
+def count_watched_in_year(user_id, year):
+    # a date range rather than extract('year', ...), so the (user_id, watch_date) index is used
+    return Watch_history.query.filter(Watch_history.user_id==user_id,
+                                      Watch_history.watch_date >= date(year, 1, 1),
+                                      Watch_history.watch_date < date(year + 1, 1, 1)).count()
+
+def top_k(table, metric, user_id, k=1):
+    """
+    [(rank, movie_id, title, value)] of the user's movies with the k highest
+    values of metric, best first. A movie watched more than once counts with
+    its best value. Tied movies share a rank and the next value gets the next
+    rank, so there can be more than k movies.
+    """
+    column = getattr(table, metric)
+    # only this user's slice of the (user_id, metric DESC) index is read, so the
+    # cost follows the user's own rows, not the table
+    best = db.session.query(
+        table.movie_id, func.max(column).label("value")
+    ).filter(
+        table.user_id==user_id, column.isnot(None)
+    ).group_by(table.movie_id).subquery()
+    # the k highest distinct values among the movies' best values
+    top_values = db.session.query(best.c.value).distinct().order_by(best.c.value.desc()).limit(k).subquery()
+    rows = db.session.query(Movies.id, Movies.title, best.c.value).join(best, best.c.movie_id==Movies.id).filter(
+        best.c.value >= db.session.query(func.min(top_values.c.value)).scalar_subquery()
+    ).order_by(best.c.value.desc(), Movies.title, Movies.id)
+
+    results = []
+    rank, previous = 0, None
+    for movie_id, title, value in rows:
+        if value != previous:
+            rank, previous = rank + 1, value
+        results.append((rank, movie_id, title, value))
+    return results
 
-    for movie in query:
-        if movie.movie_id not in results:
-            results.append(movie.movie_id)
+def find_highest(table, metric, user_id):
+    results = [title for _, _, title, _ in top_k(table, metric, user_id)]
 
     if not results:
         if table == Wishlist:
@@ -674,45 +2726,47 @@ def find_highest(table, metric):
     else:
         return results
 
-def find_highest_box_office(table):
-    movie_pairs = {}
-
-    all_movies = table.query.filter(table.user_id==session["user_id"]).all()
+def find_highest_box_office(table, user_id):
+    # one indexed pass over (user_id, boxoffice_amount)
+    count, max_box_office = db.session.query(
+        func.count(), func.max(table.boxoffice_amount)
+    ).filter(
+        table.user_id==user_id
+    ).one()
 
-    for movie in all_movies:
-        if movie.boxoffice == "N/A":
-            movie_pairs[movie.movie_id] = 0
-        elif movie.movie_id not in movie_pairs:
-            box_office_num = int(movie.boxoffice[1:].replace(",", ""))
-            movie_pairs[movie.movie_id] = box_office_num
-    
-    if movie_pairs == {}:
+    if count == 0:
         if table == Wishlist:
             return "You don't have any record in your Wish List"
         elif table == Watch_history:
             return "You don't have any record in your Watch History"
 
-    max_box_office = max(movie_pairs.values())
-
-    if max_box_office == 0:
+    if not max_box_office:
         if table == Wishlist:
             return "You don't have any record with valid box office in your Wish List"
         elif table == Watch_history:
             return "You don't have any record with valid box office in your Watch History"
-    
-    results = [k for k, v in movie_pairs.items() if v == max_box_office]
 
-    return results
+    results = db.session.query(Movies.id, Movies.title).join(table).filter(
+        table.user_id==user_id,
+        table.boxoffice_amount==max_box_office
+    ).distinct().all()
 
-def compare_personal_rating_with_imdb(option):
+    return [title for _, title in results]
+
+def compare_personal_rating_with_imdb(option, user_id):
     if option not in ["rate higher", "rate lower"]:
         raise ValueError('option input should be either "rate higher" or "rate lower"')
     movie_pairs = {}
+    titles = {}
 
-    all_movies = Watch_history.query.filter(Watch_history.user_id==session["user_id"]).all()
+    all_movies = db.session.query(Watch_history, Movies.title).join(Movies).filter(
+        Watch_history.user_id==user_id).all()
 
-    for movie in all_movies:
+    for movie, title in all_movies:
+        if movie.personal_rating is None or movie.imdb_rating is None:
+            continue
         personal_minus_imdb = movie.personal_rating - movie.imdb_rating
+        titles[movie.movie_id] = title
         if movie.movie_id not in movie_pairs:
             movie_pairs[movie.movie_id] = personal_minus_imdb
         # if user has multiple record of the same movie and different rating each time
@@ -732,7 +2786,7 @@ def compare_personal_rating_with_imdb(option):
     if option == "rate lower":
         diff = min(movie_pairs.values(), default=0)
 
-    results = [k for k, v in movie_pairs.items() if v == diff]
+    results = [titles[k] for k, v in movie_pairs.items() if v == diff]
 
     if option == "rate higher" and diff <= 0:
         return "You don't have any record in your Watch History you " + option + " than IMDB"
@@ -741,31 +2795,34 @@ def compare_personal_rating_with_imdb(option):
     else:
         return results
     
-def most_watch():
+def most_watch(user_id):
     movie_pairs = {}
+    titles = {}
 
-    all_movies = Watch_history.query.filter(Watch_history.user_id==session["user_id"]).all()
+    all_movies = db.session.query(Movies.id, Movies.title).join(Watch_history).filter(
+        Watch_history.user_id==user_id).all()
 
-    for movie in all_movies:
-        if movie.movie_id not in movie_pairs:
-            movie_pairs[movie.movie_id] = 1
+    for movie_id, title in all_movies:
+        titles[movie_id] = title
+        if movie_id not in movie_pairs:
+            movie_pairs[movie_id] = 1
         # if user has multiple record of the same movie and different rating each time
-        elif movie.movie_id in movie_pairs:
-            movie_pairs[movie.movie_id] = movie_pairs[movie.movie_id] + 1
+        elif movie_id in movie_pairs:
+            movie_pairs[movie_id] = movie_pairs[movie_id] + 1
 
     if movie_pairs == {}:
         return "You don't have any record in your Watch History"
     
     most_watch = max(movie_pairs.values(), default=0)
 
-    results = [k for k, v in movie_pairs.items() if v == most_watch]
+    results = [titles[k] for k, v in movie_pairs.items() if v == most_watch]
 
     if len(results) > 3:
         return "Too many movies tie as the most watched movie"
     else:
         return results
     
-def find_oldest_or_newest_movie(option, table):
+def find_oldest_or_newest_movie(option, table, user_id):
     if option not in ["old", "new"]:
         raise ValueError('option input should be either "old" or "new"')
     movie_pairs = {}
@@ -775,12 +2832,14 @@ def find_oldest_or_newest_movie(option, table):
     ).join(
         table
     ).filter(
-        table.user_id==session["user_id"]
+        table.user_id==user_id
     ).all()
 
+    titles = {}
     for movie, list in all_movies:
-        if movie.movie_id not in movie_pairs:
-            movie_pairs[movie.movie_id] = movie.year
+        titles[movie.id] = movie.title
+        if movie.id not in movie_pairs:
+            movie_pairs[movie.id] = movie.year
     
     if movie_pairs == {}:
         if table == Watch_history:
@@ -793,54 +2852,45 @@ def find_oldest_or_newest_movie(option, table):
     elif option == "new":
         year = max(movie_pairs.values())
 
-    results = [k for k, v in movie_pairs.items() if v == year]
+    results = [titles[k] for k, v in movie_pairs.items() if v == year]
 
     return results
 
-def find_favorite(option):
-    if option not in ["genre", "director"]:
-        raise ValueError('option input should be either "genre" or "director"')
-    movie_pairs = {}
+def find_favorite(option, user_id):
+    if option not in TAG_KINDS:
+        raise ValueError('option input should be either "genre", "director" or "language"')
 
-    all_movies = db.session.query(
-        Movies, Watch_history
+    # watches per tag, most watched first; six rows are enough to tell a tie of more than five
+    counts = db.session.query(
+        Tags.name, func.count()
     ).join(
-        Watch_history
+        Movie_tags, Movie_tags.tag_id==Tags.id
+    ).join(
+        Watch_history, Watch_history.movie_id==Movie_tags.movie_id
     ).filter(
-        Watch_history.user_id==session["user_id"]
-    ).all()
-
-    for movie, watch_history in all_movies:
-        list = getattr(movie, option).split(", ")
-        for item in list:
-            if item not in movie_pairs:
-                movie_pairs[item] = 1
-            elif item in movie_pairs:
-                movie_pairs[item] = movie_pairs[item] + 1
+        Watch_history.user_id==user_id,
+        Tags.kind==option
+    ).group_by(
+        Tags.name
+    ).order_by(
+        func.count().desc()
+    ).limit(6).all()
 
-    if movie_pairs == {}:
+    if not counts:
         return "You don't have any record in your Watch History"
-    
-    favorite = max(movie_pairs.values(), default=0)
 
-    results = [k for k, v in movie_pairs.items() if v == favorite]
+    favorite = counts[0][1]
+    results = [name for name, count in counts if count == favorite]
 
     if len(results) > 5:
         return "Too many "+ option + " tie as your favorite "+ option
     else:
-        results_str = ""
-        for i in range(len(results)):
-            if i == 0:
-                results_str = results_str + results[i]
-            else:
-                results_str = results_str + ", " + results[i]
-        return results_str
-        #return results
-    
-def find_most_recent_watch():
+        return ", ".join(results)
+
+def find_most_recent_watch(user_id):
     most_recent_movie = Watch_history.query.filter(
-        Watch_history.user_id==session["user_id"],
-        Watch_history.watch_date <= datetime.now()
+        Watch_history.user_id==user_id,
+        Watch_history.watch_date <= date.today()
     ).order_by(
         Watch_history.watch_date.desc()
     ).first()
@@ -852,43 +2902,31 @@ def find_most_recent_watch():
     date_diff = str(date_diff.days)
     return date_diff
 
-def find_poster_url(results):
-    if type(results) == list:
-        url_list = []
-        for movie in results:
-            movie_info = Movies.query.filter(Movies.movie_id==movie).first()
-            url_list.append(movie_info.poster_url)
-        return url_list
-    else:
-        return 0
-
-# @app.route("/add_movie", methods=["GET", "POST"])
-# @login_required
-# def add_movie():
-#     if request.method == "POST":
-
-#         # Ensure user input movie title
-#         if not request.form.get("title"):
-#             return apology("Title must not be null")
-
-#         # Ensure rating is float
-#         try:
-#             rating = float(request.form.get("personal_rating"))
-#         except ValueError:
-#             return apology("Rating must be numerical")
-
-#         # Ensure rating within rating range
-#         if rating < 0:
-#             return apology("Rating can not be negative")
-#         elif rating > 10:
-#             return apology("Rating can't exceed 10")
-
-#         # Update watch history
-#         movie_watched = Watch_history(user_id=session["user_id"], movie_id = request.form.get("title"), personal_rating=rating)
-#         db.session.add(movie_watched)
-#         db.session.commit()
-
-#         return redirect("/")
-
-#     else:
-#         return render_template("add_movie.html")
+class PosterResolver:
+    """
+    Request-scoped identity map of movie id -> (title, poster url).
+
+    Movies already at hand (e.g. from a join) are primed into the map; the
+    rest are fetched together with a single IN query the first time they're asked for.
+    """
+
+    def __init__(self):
+        self.movies = {}
+
+    def prime(self, movie_id, title, poster_url):
+        self.movies[movie_id] = (title, poster_url)
+
+    def resolve(self, movie_ids):
+        missing = {movie_id for movie_id in movie_ids if movie_id not in self.movies}
+        if missing:
+            rows = db.session.query(Movies.id, Movies.title, Movies.poster_url).filter(Movies.id.in_(missing))
+            for movie_id, title, poster_url in rows:
+                self.movies[movie_id] = (title, poster_url)
+            for movie_id in missing:
+                self.movies.setdefault(movie_id, (None, None))
+        return {movie_id: self.movies[movie_id] for movie_id in movie_ids}
+
+def poster_resolver():
+    if "posters" not in g:
+        g.posters = PosterResolver()
+    return g.posters
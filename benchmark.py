@@ -0,0 +1,1052 @@
+"""
+Benchmarks for the movie tracker, run against a seeded synthetic database.
+
+    python benchmark.py [--database URL] [--json FILE] plans [--users 200] [--watches 500]
+    python benchmark.py sessions [--sessions 2000] [--repeat 500]
+    python benchmark.py routes [--users 50] [--watches 500] [--repeat 50] [--omdb-latency 0]
+    python benchmark.py load [--clients 8] [--duration 30] [--server gunicorn] [--workers 4]
+    python benchmark.py topk [--users 100,1000,5000] [--watches 100] [--k 5]
+    python benchmark.py keys [--users 200] [--watches 500] [--batch-size 10000]
+    python benchmark.py timeseries [--users 50] [--watches 2000]
+    python benchmark.py recommend [--users 2000] [--movies 3000] [--watches 100] [--n 10]
+    python benchmark.py compare OLD.json NEW.json
+
+Without --database a throwaway SQLite file is used. Point --database at an
+empty local Postgres database to benchmark the production engine. OMDb is
+replaced by a local stub server (OmdbStub) in routes and load, so no
+benchmark ever calls the real API.
+
+plans: query plans and timings of the hot watch_history queries before and
+       after the (user_id, watch_date) index migration.
+sessions: per-request cost of each SESSION_BACKEND, for a logged-in page view
+          and for a session write (open + modify + save).
+routes: Flask test client micro-benchmarks of each page: p50/p95/p99
+        latency, SQL queries per request and peak Python memory per request.
+load: the app served by gunicorn (or werkzeug's threaded server) with
+      --clients concurrent users browsing a mix of pages for --duration
+      seconds: throughput, p50/p95/p99 latency and errors per route, and the
+      memory of the server processes.
+topk: a user's top --k personal ratings, ranked by a window function over
+      the whole watch_history table (how find_highest() used to do it) and
+      by top_k(), on databases of a growing number of users.
+keys: the joins on the key of movies (history page, stats, search) on a
+      database still keyed by title, the time migration 7 takes to rekey it
+      to integer ids, the same joins afterwards and the size of each table.
+timeseries: a user's watches, average rating and genre shares per week,
+            month and year, bucketed by SQL GROUP BY (watch_timeseries()),
+            by loading every watch into Python, and from the stats cache.
+recommend: offline evaluation of recommender.py on synthetic users and
+           movies, no database: hit rate and NDCG of one held out movie per
+           user for a popularity baseline, ratings only, genres/directors only
+           and the blend, then recommend() latency and how an incremental
+           update() compares with a full refit.
+compare: per-route latency change between two --json reports of routes or
+         load, e.g. from two commits.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+GENRES = ["Drama", "Comedy", "Action", "Sci-Fi", "Horror", "Romance", "Thriller", "Animation",
+          "Documentary", "Crime", "Fantasy", "Mystery"]
+LANGUAGES = ["English", "French", "Japanese", "Korean", "Spanish", "German", "Mandarin"]
+TITLE_WORDS = ["Silent", "Harbor", "Midnight", "Garden", "Last", "Summer", "Broken", "River", "Red", "Shadow",
+               "City", "Lights", "Lost", "Empire", "Winter", "Dream", "Iron", "Heart", "Blue", "Road",
+               "Secret", "Kingdom", "Wild", "Storm", "Golden", "Ghost", "Paper", "Moon", "Hidden", "Star"]
+# every seeded user logs in with this password
+PASSWORD = "benchmark"
+
+
+def load_app(database, omdb_url=None):
+    """Import the app against database (app.py reads its settings at import time)."""
+    os.environ["POSTGRESQL_URL"] = database
+    os.environ.setdefault("API_KEY", "benchmark")
+    if omdb_url:
+        os.environ["OMDB_URL"] = omdb_url
+    import app
+    return app
+
+
+def stub_movie(title):
+    """Made-up but stable OMDb details for title."""
+    h = zlib.crc32(title.encode())
+    return {"Title": title, "Year": str(1930 + h % 95), "imdbRating": str(1 + h % 90 / 10),
+            "Genre": ", ".join(GENRES[h % len(GENRES):h % len(GENRES) + 2]),
+            "Director": f"Director {h % 5000:05d}", "Language": LANGUAGES[h % len(LANGUAGES)],
+            "BoxOffice": f"${h % 900_000_000:,}", "Poster": f"https://posters.example.com/{h}.jpg",
+            "imdbID": f"tt{h % 10_000_000:07d}", "Response": "True"}
+
+
+class OmdbStub:
+    """
+    A local stand-in for the OMDb API on a free port, for OMDB_URL: answers
+    ?t= with stub_movie() after latency seconds, titles starting with
+    "Unknown" aren't found. ?i= knows the IMDb ids it has answered with.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.titles = {}
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.calls += 1
+                time.sleep(stub.latency)
+                query = parse_qs(urlparse(self.path).query)
+                title = query.get("t", [""])[0] or stub.titles.get(query.get("i", [""])[0], "")
+                if not title or title.startswith("Unknown"):
+                    data = {"Response": "False", "Error": "Movie not found!"}
+                else:
+                    data = stub_movie(title)
+                    stub.titles[data["imdbID"]] = title
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def seed(app, users, watches, wishes=20, movies=None, rng=None, legacy=None):
+    """
+    Fill an empty database with users x watches watch history rows and users x wishes
+    wishlist rows over a synthetic catalogue of movies. Returns the user ids.
+    With legacy (the tables of legacy_schema()) movies are keyed by title.
+    """
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    rng = rng or random.Random(42)
+    db = app.db
+    movies = movies or max(1000, watches * 2)
+    titles = [f"{' '.join(rng.sample(TITLE_WORDS, rng.randint(1, 3)))} {i}" for i in range(movies)]
+    movie_rows = [{"title": title,
+                   "year": rng.randint(1930, 2024),
+                   "genre": ", ".join(rng.sample(GENRES, rng.randint(1, 3))),
+                   "director": f"Director {rng.randint(1, movies // 4):05d}",
+                   "language": rng.choice(LANGUAGES),
+                   "poster_url": f"https://posters.example.com/{i}.jpg"}
+                  for i, title in enumerate(titles)]
+    if legacy is None:
+        tables = {model.__tablename__: model.__table__ for model in (app.Watch_history, app.Wishlist)}
+        _insert_chunks(db, insert(app.Movies), movie_rows)
+        all_movies = app.Movies.query.all()
+        # seeded titles are unique
+        movie_ids = {movie.title: movie.id for movie in all_movies}
+        app.tag_movies(all_movies)
+        app.index_titles(all_movies)
+    else:
+        tables = legacy
+        movie_ids = {title: title for title in titles}
+        _insert_chunks(db, insert(legacy["movies"]), [{"movie_id" if key == "title" else key: value
+                                                      for key, value in row.items()} for row in movie_rows])
+        tags = {(row["title"], kind, name)
+                for row in movie_rows for kind in app.TAG_KINDS for name in app.split_tags(row[kind])}
+        tag_ids = app.get_tag_ids({(kind, name) for _, kind, name in tags})
+        _insert_chunks(db, insert(legacy["movie_tags"]), [{"movie_id": title, "tag_id": tag_ids[(kind, name)]}
+                                                          for title, kind, name in tags])
+        _insert_chunks(db, insert(legacy["title_trigrams"]), [{"trigram": gram, "movie_id": title}
+                                                              for title in titles for gram in app.trigrams(title)])
+
+    password = generate_password_hash(PASSWORD)
+    user_rows = [{"id": i + 1, "username": f"user{i + 1}", "password": password} for i in range(users)]
+    _insert_chunks(db, insert(app.Users), user_rows)
+
+    start = date(2010, 1, 1)
+    history_rows = []
+    wishlist_rows = []
+    for user in user_rows:
+        seen = set()
+        while len(seen) < watches:
+            seen.add((rng.choice(titles), start + timedelta(days=rng.randint(0, 5400))))
+        for title, watch_date in seen:
+            boxoffice = rng.choice(["N/A", f"${rng.randint(10_000, 900_000_000):,}"])
+            history_rows.append({"user_id": user["id"], "movie_id": movie_ids[title], "watch_date": watch_date,
+                                 "personal_rating": rng.randint(0, 20) / 2,
+                                 "imdb_rating": rng.randint(10, 95) / 10,
+                                 "boxoffice": boxoffice, "boxoffice_amount": app.parse_boxoffice(boxoffice),
+                                 "comments": None})
+        for title in rng.sample(titles, wishes):
+            boxoffice = rng.choice(["N/A", f"${rng.randint(10_000, 900_000_000):,}"])
+            wishlist_rows.append({"user_id": user["id"], "movie_id": movie_ids[title],
+                                  "imdb_rating": rng.randint(10, 95) / 10,
+                                  "boxoffice": boxoffice, "boxoffice_amount": app.parse_boxoffice(boxoffice),
+                                  "comments": None})
+        if len(history_rows) >= 20_000:
+            _insert_chunks(db, insert(tables["watch_history"]), history_rows)
+            history_rows = []
+    _insert_chunks(db, insert(tables["watch_history"]), history_rows)
+    _insert_chunks(db, insert(tables["wishlist"]), wishlist_rows)
+    db.session.commit()
+    return [user["id"] for user in user_rows]
+
+
+def legacy_schema(app):
+    """
+    (metadata, {name: table}) of movies and the tables referencing it as they
+    were before migration 7: keyed by title, with the indexes of the models.
+    """
+    from sqlalchemy import Column, ForeignKey, Index, MetaData, String, Table
+
+    metadata = MetaData()
+    for model in (app.Users, app.Tags):
+        model.__table__.to_metadata(metadata)
+    tables = {}
+    for model in app.REKEYED_MODELS:
+        columns = [Column("movie_id", String(200), primary_key=True)] if model is app.Movies else []
+        for column in model.__table__.columns:
+            if model is app.Movies and column.name in ("id", "title", "imdb_id"):
+                continue
+            if column.name == "movie_id":
+                columns.append(Column("movie_id", String(200), ForeignKey("movies.movie_id"),
+                                      primary_key=column.primary_key, nullable=column.nullable))
+            else:
+                columns.append(Column(column.name, column.type,
+                                      *[ForeignKey(key.target_fullname) for key in column.foreign_keys],
+                                      primary_key=column.primary_key, nullable=column.nullable))
+        table = tables[model.__tablename__] = Table(model.__tablename__, metadata, *columns)
+        if model is not app.Movies:
+            for index in model.__table__.indexes:
+                Index(index.name, *[table.c[expression.name] if isinstance(expression, Column) else expression
+                                    for expression in index.expressions])
+    return metadata, tables
+
+
+def _insert_chunks(db, statement, rows, size=5000):
+    for i in range(0, len(rows), size):
+        db.session.execute(statement, rows[i:i + size])
+
+
+def timed(run, repeat):
+    """Run run() repeat times, return (median, p95) in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return round(statistics.median(samples), 3), round(samples[int(0.95 * (len(samples) - 1))], 3)
+
+
+def percentiles(samples):
+    """{"p50_ms", "p95_ms", "p99_ms"} of samples in milliseconds."""
+    samples = sorted(samples)
+    if not samples:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {f"p{p}_ms": round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))], 3)
+            for p in (50, 95, 99)}
+
+
+def explain(app, sql, params):
+    from sqlalchemy import text
+
+    db = app.db
+    if db.engine.dialect.name == "sqlite":
+        rows = db.session.execute(text("EXPLAIN QUERY PLAN " + sql), params)
+        return [row[-1] for row in rows]
+    return [row[0] for row in db.session.execute(text("EXPLAIN " + sql), params)]
+
+
+def watch_history_queries(app):
+    """The watch_history queries the app runs on every page, as plain SQL."""
+    if app.db.engine.dialect.name == "sqlite":
+        year = "CAST(STRFTIME('%Y', watch_history.watch_date) AS INTEGER)"
+    else:
+        year = "EXTRACT(year FROM watch_history.watch_date)"
+    return {
+        "history page": """
+            SELECT movies.title, movies.year, movies.genre, watch_history.watch_date, watch_history.personal_rating
+            FROM movies JOIN watch_history ON movies.id = watch_history.movie_id
+            WHERE watch_history.user_id = :user_id
+            ORDER BY watch_history.watch_date DESC, watch_history.movie_id DESC LIMIT 51""",
+        "poster wall": """
+            SELECT movies.poster_url
+            FROM movies JOIN watch_history ON movies.id = watch_history.movie_id
+            WHERE watch_history.user_id = :user_id
+            ORDER BY watch_history.watch_date""",
+        "year count, extract()": f"""
+            SELECT count(*) FROM watch_history
+            WHERE watch_history.user_id = :user_id AND {year} = :year""",
+        "year count, date range": """
+            SELECT count(*) FROM watch_history
+            WHERE watch_history.user_id = :user_id
+            AND watch_history.watch_date >= :year_start AND watch_history.watch_date < :year_end""",
+        "most recent watch": """
+            SELECT watch_history.movie_id, watch_history.watch_date FROM watch_history
+            WHERE watch_history.user_id = :user_id AND watch_history.watch_date <= :today
+            ORDER BY watch_history.watch_date DESC LIMIT 1""",
+    }
+
+
+def measure_queries(app, queries, user_ids, repeat, rng):
+    from sqlalchemy import text
+
+    results = {}
+    year = 2020
+    for name, sql in queries.items():
+        base = {"year": year, "year_start": f"{year}-01-01", "year_end": f"{year + 1}-01-01",
+                "today": date.today().isoformat()}
+        plan = explain(app, sql, dict(base, user_id=user_ids[0]))
+        median, p95 = timed(lambda: app.db.session.execute(
+            text(sql), dict(base, user_id=rng.choice(user_ids))).all(), repeat)
+        results[name] = {"median_ms": median, "p95_ms": p95, "plan": plan}
+    return results
+
+
+def bench_plans(args):
+    app = load_app(args.database)
+    rng = random.Random(7)
+    with app.app.app_context():
+        app.upgrade_database()
+        user_ids = seed(app, args.users, args.watches, rng=rng)
+        queries = watch_history_queries(app)
+        db = app.db
+        from sqlalchemy import text
+
+        # before: the schema as it was, without the index migration
+        db.session.execute(text("DROP INDEX ix_watch_history_user_date"))
+        db.session.execute(text("DELETE FROM schema_migrations WHERE version = 1"))
+        db.session.commit()
+        before = measure_queries(app, queries, user_ids, args.repeat, rng)
+
+        app.upgrade_database()
+        after = measure_queries(app, queries, user_ids, args.repeat, rng)
+        engine = db.engine.dialect.name
+
+    report = {"benchmark": "plans", "engine": engine,
+              "users": args.users, "watches_per_user": args.watches,
+              "before": before, "after": after}
+    for name in queries:
+        print(f"{name}:")
+        for label, results in (("before", before), ("after", after)):
+            result = results[name]
+            print(f"  {label:6} median {result['median_ms']:8.3f} ms   p95 {result['p95_ms']:8.3f} ms")
+            for line in result["plan"]:
+                print(f"           {line}")
+    return report
+
+
+def bench_sessions(args):
+    from flask import request
+    from werkzeug.security import generate_password_hash
+
+    app = load_app(args.database)
+    flask_app = app.app
+    flask_app.secret_key = flask_app.secret_key or "benchmark"
+    flask_app.config["SESSION_FILE_DIR"] = tempfile.mkdtemp(prefix="movie-bench-sessions-")
+    with flask_app.app_context():
+        app.upgrade_database()
+        app.db.session.add(app.Users(username="bench", password=generate_password_hash("bench")))
+        app.db.session.commit()
+
+    report = {"benchmark": "sessions", "sessions": args.sessions, "backends": {}}
+    for backend in ("filesystem", "sqlalchemy", "cookie"):
+        flask_app.config["SESSION_BACKEND"] = backend
+        interface = flask_app.session_interface = app.make_session_interface(backend)
+
+        # other users' sessions, so the store isn't trivially small
+        with flask_app.test_request_context("/"):
+            for i in range(args.sessions if backend != "cookie" else 0):
+                other = interface.open_session(flask_app, request)
+                other["user_id"] = i + 2
+                interface.save_session(flask_app, other, flask_app.response_class())
+
+        client = flask_app.test_client()
+        client.post("/login", data={"username": "bench", "password": "bench"})
+        view = timed(lambda: client.get("/"), args.repeat)
+
+        cookie = client.get_cookie(flask_app.config["SESSION_COOKIE_NAME"]).value
+        headers = {"Cookie": f"{flask_app.config['SESSION_COOKIE_NAME']}={cookie}"}
+
+        def write():
+            with flask_app.test_request_context("/", headers=headers):
+                current = interface.open_session(flask_app, request)
+                current["user_id"] = 1
+                interface.save_session(flask_app, current, flask_app.response_class())
+        write_timing = timed(write, args.repeat)
+
+        report["backends"][backend] = {"page_view_median_ms": view[0], "page_view_p95_ms": view[1],
+                                       "write_median_ms": write_timing[0], "write_p95_ms": write_timing[1]}
+        print(f"{backend:10}  page view median {view[0]:7.3f} ms  p95 {view[1]:7.3f} ms"
+              f"   write median {write_timing[0]:7.3f} ms  p95 {write_timing[1]:7.3f} ms")
+    return report
+
+
+def route_requests(titles):
+    """
+    (name, build) of each benchmarked page, build(rng) returns the (method,
+    path, form data) of one request to it.
+    """
+    return [
+        ("history", lambda rng: ("GET", "/history", None)),
+        ("history, streamed", lambda rng: ("GET", "/history?stream=1", None)),
+        ("wishlist", lambda rng: ("GET", "/wishlist", None)),
+        ("stats", lambda rng: ("GET", "/stats", None)),
+        ("stats, cold", lambda rng: ("GET", "/stats", None)),
+        ("posterwall", lambda rng: ("GET", "/posterwall", None)),
+        ("search, local", lambda rng: ("GET", "/search?q=" + quote(rng.choice(titles)[:-1]), None)),
+        ("autocomplete", lambda rng: ("GET", "/search/autocomplete?q=" + quote(rng.choice(titles)[:4]), None)),
+        ("search, OMDb", lambda rng: ("POST", "/search", {"search_omdb": "1",
+                                                          "title": f"Stub Movie {rng.randrange(10 ** 9)}"})),
+        ("export csv", lambda rng: ("GET", "/export?table=history&format=csv", None)),
+    ]
+
+
+def setup_routes_benchmark(args, omdb):
+    """Import the app against a freshly seeded database, return (app, user ids, movie titles)."""
+    app = load_app(args.database, omdb.url)
+    app.app.config["SESSION_FILE_DIR"] = tempfile.mkdtemp(prefix="movie-bench-sessions-")
+    app.app.session_interface = app.make_session_interface(app.app.config["SESSION_BACKEND"])
+    with app.app.app_context():
+        app.upgrade_database()
+        user_ids = seed(app, args.users, args.watches, rng=random.Random(7))
+        titles = [title for title, in app.db.session.query(app.Movies.title)]
+    return app, user_ids, titles
+
+
+def count_queries(app):
+    """A dict whose "queries" counts every SQL statement the app runs from now on."""
+    from sqlalchemy import event
+
+    counter = {"queries": 0}
+    with app.app.app_context():
+        engine = app.db.engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(*args):
+        counter["queries"] += 1
+
+    return counter
+
+
+def bench_routes(args):
+    omdb = OmdbStub(args.omdb_latency / 1000).start()
+    app, user_ids, titles = setup_routes_benchmark(args, omdb)
+    flask_app = app.app
+    counter = count_queries(app)
+    client = flask_app.test_client()
+    rng = random.Random(11)
+
+    def request(name, build):
+        user_id = rng.choice(user_ids)
+        with client.session_transaction() as current:
+            current["user_id"] = user_id
+        if name == "stats, cold":
+            # neither the stored summary nor the rendered page: bumping the
+            # version drops the cached one, so the page is built from the rows
+            with flask_app.app_context():
+                app.User_stats.query.filter_by(user_id=user_id).delete()
+                app.bump_data_version([user_id])
+                app.db.session.commit()
+        method, path, data = build(rng)
+        queries = counter["queries"]
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        elapsed = (time.perf_counter() - start) * 1000
+        return elapsed, counter["queries"] - queries, response.status_code
+
+    report = {"benchmark": "routes", "commit": git_commit(), "engine": None,
+              "users": args.users, "watches_per_user": args.watches, "repeat": args.repeat, "routes": {}}
+    with flask_app.app_context():
+        report["engine"] = app.db.engine.dialect.name
+    for name, build in route_requests(titles):
+        request(name, build)  # warm up caches and connections
+        samples, queries, errors = [], [], 0
+        for _ in range(args.repeat):
+            elapsed, query_count, status = request(name, build)
+            samples.append(elapsed)
+            queries.append(query_count)
+            errors += status >= 400
+
+        tracemalloc.start()
+        request(name, build)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        result = dict(percentiles(samples), queries_per_request=round(statistics.mean(queries), 1),
+                      peak_memory_kb=round(peak / 1024), errors=errors)
+        report["routes"][name] = result
+        print(f"{name:20} p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  "
+              f"p99 {result['p99_ms']:8.2f} ms  {result['queries_per_request']:6.1f} queries  "
+              f"{result['peak_memory_kb']:7d} KiB  {errors} errors")
+    report["omdb_stub_calls"] = omdb.calls
+    omdb.stop()
+    return report
+
+
+# request weights of the load test: mostly browsing, few OMDb searches
+LOAD_MIX = {"history": 4, "wishlist": 2, "stats": 3, "posterwall": 2, "search, local": 2,
+            "autocomplete": 6, "search, OMDb": 1}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, omdb_url):
+    """Serve the app in a subprocess, return (process, base url) once it answers."""
+    port = free_port()
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, POSTGRESQL_URL=args.database, OMDB_URL=omdb_url,
+               PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    if args.server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "--workers", str(args.workers), "--threads", str(args.threads),
+                   "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port),
+                   "--with-threads", "--no-reload", "--no-debugger"]
+    # in a scratch directory, for the filesystem sessions and the poster cache
+    scratch = tempfile.mkdtemp(prefix="movie-bench-server-")
+    log = open(os.path.join(scratch, "server.log"), "w")
+    print(f"{args.server} log: {log.name}")
+    process = subprocess.Popen(command, env=env, cwd=scratch, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    import requests
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{args.server} exited with status {process.returncode}")
+        try:
+            requests.get(url + "/login", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{args.server} didn't start within 60 seconds")
+
+
+def process_tree_rss_kb(pid):
+    """Resident memory of pid and its children in KiB, None where /proc isn't available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return None
+    return rss + sum(process_tree_rss_kb(child) or 0 for child in children)
+
+
+def bench_load(args):
+    import requests
+
+    omdb = OmdbStub(args.omdb_latency / 1000).start()
+    app, user_ids, titles = setup_routes_benchmark(args, omdb)
+    builds = {name: build for name, build in route_requests(titles) if name in LOAD_MIX}
+    process, url = start_server(args, omdb.url)
+    memory_before = process_tree_rss_kb(process.pid)
+    results = []
+    lock = threading.Lock()
+
+    def client(number):
+        rng = random.Random(number)
+        http = requests.Session()
+        http.post(url + "/login", data={"username": f"user{rng.choice(user_ids)}", "password": PASSWORD})
+        names, weights = list(LOAD_MIX), list(LOAD_MIX.values())
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, path, data = builds[name](rng)
+            start = time.perf_counter()
+            try:
+                status = http.request(method, url + path, data=data, timeout=60).status_code
+            except requests.RequestException:
+                status = None
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                results.append((name, elapsed, status))
+
+    try:
+        with ThreadPoolExecutor(args.clients) as pool:
+            list(pool.map(client, range(args.clients)))
+        memory_after = process_tree_rss_kb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        omdb.stop()
+
+    report = {"benchmark": "load", "commit": git_commit(), "server": args.server,
+              "workers": args.workers if args.server == "gunicorn" else 1,
+              "clients": args.clients, "duration_s": args.duration,
+              "users": args.users, "watches_per_user": args.watches,
+              "requests": len(results), "requests_per_s": round(len(results) / args.duration, 1),
+              "server_rss_kb": {"before": memory_before, "after": memory_after},
+              "omdb_stub_calls": omdb.calls, "routes": {}}
+    print(f"{len(results)} requests, {report['requests_per_s']} requests/s, "
+          f"server memory {memory_before} -> {memory_after} KiB")
+    for name in LOAD_MIX:
+        samples = [elapsed for route, elapsed, _ in results if route == name]
+        errors = sum(1 for route, _, status in results if route == name and (status is None or status >= 400))
+        result = dict(percentiles(samples), requests=len(samples), errors=errors)
+        report["routes"][name] = result
+        if samples:
+            print(f"{name:20} {len(samples):6d} requests  p50 {result['p50_ms']:8.2f} ms  "
+                  f"p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  {errors} errors")
+    return report
+
+
+def bench_topk(args):
+    from sqlalchemy import func
+
+    app = load_app(args.database)
+    rng = random.Random(11)
+
+    def window_top_k(user_id):
+        # every user's rows ranked, then filtered to one user
+        table = app.Watch_history
+        ranked = app.db.session.query(
+            table.user_id, table.movie_id,
+            func.dense_rank().over(order_by=table.personal_rating.desc(),
+                                   partition_by=table.user_id).label("rnk")
+        ).filter(table.personal_rating.isnot(None)).subquery()
+        return app.db.session.query(ranked.c.movie_id, ranked.c.rnk).filter(
+            ranked.c.rnk <= args.k, ranked.c.user_id == user_id).all()
+
+    results = []
+    with app.app.app_context():
+        db = app.db
+        for users in sorted(args.users):
+            db.session.remove()
+            db.drop_all()
+            app.upgrade_database()
+            user_ids = seed(app, users, args.watches, wishes=1, rng=random.Random(42))
+            window = timed(lambda: window_top_k(rng.choice(user_ids)), args.repeat)
+            top_k = timed(lambda: app.top_k(app.Watch_history, "personal_rating",
+                                            rng.choice(user_ids), args.k), args.repeat)
+            results.append({"users": users, "rows": users * args.watches,
+                            "window": {"median_ms": window[0], "p95_ms": window[1]},
+                            "top_k": {"median_ms": top_k[0], "p95_ms": top_k[1]}})
+            print(f"{users:7} users {users * args.watches:9} rows   "
+                  f"window median {window[0]:9.3f} ms p95 {window[1]:9.3f} ms   "
+                  f"top_k median {top_k[0]:7.3f} ms p95 {top_k[1]:7.3f} ms", flush=True)
+        engine = db.engine.dialect.name
+
+    return {"benchmark": "topk", "engine": engine, "watches_per_user": args.watches, "k": args.k,
+            "results": results}
+
+
+def movie_key_queries(legacy):
+    """The app's joins on the key of movies, as plain SQL for the title keyed or the id keyed schema."""
+    key, title = ("movie_id", "movie_id") if legacy else ("id", "title")
+    return {
+        "history page": f"""
+            SELECT movies.{title}, movies.year, movies.genre, watch_history.watch_date, watch_history.personal_rating
+            FROM movies JOIN watch_history ON movies.{key} = watch_history.movie_id
+            WHERE watch_history.user_id = :user_id
+            ORDER BY watch_history.watch_date DESC, watch_history.movie_id DESC LIMIT 51""",
+        "stats load": f"""
+            SELECT movies.{title}, watch_history.watch_date, watch_history.personal_rating,
+                   movies.genre, movies.director, movies.language, movies.poster_url
+            FROM watch_history JOIN movies ON movies.{key} = watch_history.movie_id
+            WHERE watch_history.user_id = :user_id""",
+        "search candidates": f"""
+            SELECT movies.{title}, movies.year FROM movies
+            WHERE movies.{key} IN (SELECT movie_id FROM title_trigrams WHERE trigram IN ('  h', ' ha', 'har')
+                                   GROUP BY movie_id ORDER BY count(*) DESC LIMIT 200)""",
+    }
+
+
+def table_sizes(app, names):
+    """{table: bytes} of each table with its indexes, None where the engine can't tell."""
+    from sqlalchemy import text
+    from sqlalchemy.exc import DBAPIError
+
+    db = app.db
+    if db.engine.dialect.name == "postgresql":
+        sql = "SELECT pg_total_relation_size(:name)"
+    else:
+        # needs SQLite built with the dbstat table
+        sql = "SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = :name)"
+    sizes = {}
+    for name in names:
+        try:
+            sizes[name] = db.session.execute(text(sql), {"name": name}).scalar()
+        except DBAPIError:
+            db.session.rollback()
+            sizes[name] = None
+    return sizes
+
+
+def bench_keys(args):
+    from sqlalchemy import text
+
+    app = load_app(args.database)
+    app.app.config["MIGRATION_BATCH_SIZE"] = args.batch_size
+    rng = random.Random(13)
+
+    def measure(legacy):
+        results = {}
+        for name, sql in movie_key_queries(legacy).items():
+            plan = explain(app, sql, {"user_id": user_ids[0]})
+            median, p95 = timed(lambda: app.db.session.execute(
+                text(sql), {"user_id": rng.choice(user_ids)}).all(), args.repeat)
+            results[name] = {"median_ms": median, "p95_ms": p95, "plan": plan}
+        return results
+
+    with app.app.app_context():
+        db = app.db
+        # the schema as it was before migration 7, every earlier migration done
+        metadata, tables = legacy_schema(app)
+        metadata.create_all(db.engine)
+        db.metadata.create_all(db.engine, tables=[table for table in db.metadata.sorted_tables
+                                                  if table.name not in tables])
+        now = datetime.utcnow()
+        db.session.add_all(app.Schema_migrations(version=version, name=name, applied_at=now)
+                           for version, name, _ in app.MIGRATIONS if version < 7)
+        db.session.commit()
+        user_ids = seed(app, args.users, args.watches, rng=random.Random(42), legacy=tables)
+
+        before = measure(legacy=True)
+        sizes_before = table_sizes(app, tables)
+        db.session.remove()
+        start = time.perf_counter()
+        applied = app.upgrade_database()
+        migration_seconds = time.perf_counter() - start
+        after = measure(legacy=False)
+        sizes_after = table_sizes(app, tables)
+        engine = db.engine.dialect.name
+
+    report = {"benchmark": "keys", "engine": engine, "users": args.users, "watches_per_user": args.watches,
+              "batch_size": args.batch_size, "migrations": applied,
+              "migration_seconds": round(migration_seconds, 3),
+              "title_keys": before, "id_keys": after,
+              "table_bytes": {"title_keys": sizes_before, "id_keys": sizes_after}}
+    print(f"migration 7: {migration_seconds:.2f} s for {args.users * args.watches} watch history rows "
+          f"in batches of {args.batch_size}")
+    for name in before:
+        print(f"{name}:")
+        for label, results in (("title", before), ("id", after)):
+            result = results[name]
+            print(f"  {label:6} median {result['median_ms']:8.3f} ms   p95 {result['p95_ms']:8.3f} ms")
+            for line in result["plan"]:
+                print(f"           {line}")
+    for name in tables:
+        old, new = sizes_before[name], sizes_after[name]
+        if old is not None and new is not None:
+            print(f"{name:15} {old / 1024:10.0f} KiB -> {new / 1024:10.0f} KiB")
+    return report
+
+
+def bench_timeseries(args):
+    from sqlalchemy import and_, func
+    from timeseries import PERIODS, period_start, series
+
+    app = load_app(args.database)
+    rng = random.Random(19)
+    today = date.today()
+
+    def in_python(user_id, period):
+        # every watch of the user comes back and is bucketed here
+        table = app.Watch_history
+        rows = app.db.session.query(table.movie_id, table.watch_date, table.personal_rating).filter(
+            table.user_id == user_id).all()
+        genres = {}
+        for movie_id, name in app.db.session.query(app.Movie_tags.movie_id, app.Tags.name).join(
+                app.Tags, and_(app.Tags.id == app.Movie_tags.tag_id, app.Tags.kind == "genre")).join(
+                table, table.movie_id == app.Movie_tags.movie_id).filter(table.user_id == user_id).distinct():
+            genres.setdefault(movie_id, []).append(name)
+        buckets, counts = {}, {}
+        for movie_id, watch_date, rating in rows:
+            start = period_start(watch_date, period)
+            watches, ratings = buckets.setdefault(start, [0, []])
+            buckets[start][0] += 1
+            if rating is not None:
+                ratings.append(rating)
+            for name in genres.get(movie_id, ()):
+                counts[(start, name)] = counts.get((start, name), 0) + 1
+        return series([(start, watches, sum(ratings) / len(ratings) if ratings else None)
+                       for start, (watches, ratings) in buckets.items()],
+                      [(start, name, count) for (start, name), count in counts.items()], period)
+
+    results = {}
+    with app.app.app_context():
+        app.upgrade_database()
+        user_ids = seed(app, args.users, args.watches, wishes=1, rng=random.Random(42))
+        start = app.period_start_sql(app.Watch_history.watch_date, "month").label("start")
+        query = app.db.session.query(start, func.count(), func.avg(app.Watch_history.personal_rating)).filter(
+            app.Watch_history.user_id == user_ids[0]).group_by(start)
+        plan = explain(app, str(query.statement.compile(app.db.engine, compile_kwargs={"literal_binds": True})), {})
+        for period in PERIODS:
+            user_id = user_ids[0]
+            assert app.watch_timeseries(user_id, period, today)["buckets"] == in_python(user_id, period)
+            sql = timed(lambda: app.watch_timeseries(rng.choice(user_ids), period, today), args.repeat)
+            python = timed(lambda: in_python(rng.choice(user_ids), period), args.repeat)
+            cached = timed(lambda: app.get_watch_timeseries(rng.choice(user_ids[:10]), period, today), args.repeat)
+            buckets = len(app.watch_timeseries(user_id, period, today)["buckets"])
+            results[period] = {"buckets": buckets,
+                               "sql": {"median_ms": sql[0], "p95_ms": sql[1]},
+                               "python": {"median_ms": python[0], "p95_ms": python[1]},
+                               "cached": {"median_ms": cached[0], "p95_ms": cached[1]}}
+            print(f"{period:6} {buckets:4} buckets   SQL GROUP BY median {sql[0]:8.3f} ms p95 {sql[1]:8.3f} ms   "
+                  f"in Python median {python[0]:8.3f} ms   cached median {cached[0]:7.3f} ms", flush=True)
+        engine = app.db.engine.dialect.name
+    print("month buckets plan:")
+    for line in plan:
+        print(f"    {line}")
+    return {"benchmark": "timeseries", "engine": engine, "users": args.users, "watches_per_user": args.watches,
+            "stats_cache_backend": os.environ.get("STATS_CACHE_BACKEND", "memory"), "plan": plan,
+            "results": results}
+
+
+def synthetic_ratings(users, movies, watches, rng):
+    """
+    (ratings, features) of made-up tastes: each movie has one or two genres
+    and one of movies // 20 directors, each user likes two genres and a few
+    directors and dislikes one genre. A user mostly watches movies matching
+    their taste and rates them by how well they match, plus noise.
+    """
+    directors = [f"director:{i}" for i in range(max(1, movies // 20))]
+    tags = {}
+    for movie_id in range(1, movies + 1):
+        genres = rng.sample(GENRES, rng.choice((1, 2)))
+        tags[movie_id] = [f"genre:{genre}" for genre in genres] + [rng.choice(directors)]
+    features = [(movie_id, tag) for movie_id, movie_tags in tags.items() for tag in movie_tags]
+    ratings = []
+    for user_id in range(1, users + 1):
+        liked = set(f"genre:{genre}" for genre in rng.sample(GENRES, 2)) | set(rng.sample(directors, 3))
+        disliked = "genre:" + rng.choice(GENRES)
+        affinity = {movie_id: len(liked.intersection(movie_tags)) - 2 * (disliked in movie_tags)
+                    for movie_id, movie_tags in tags.items()}
+        # taste decides what gets watched, with some randomness
+        pool = sorted(tags, key=lambda movie_id: affinity[movie_id] + rng.random() * 2, reverse=True)
+        for movie_id in pool[:rng.randint(watches // 2, watches)]:
+            rating = 5 + 2 * affinity[movie_id] + rng.gauss(0, 1.5)
+            ratings.append((user_id, movie_id, round(max(0, min(10, rating)) * 2) / 2))
+    return ratings, features
+
+
+def bench_recommend(args):
+    import math
+    from recommender import Recommender
+
+    rng = random.Random(17)
+    ratings, features = synthetic_ratings(args.users, args.movies, args.watches, rng)
+    by_user = {}
+    for user_id, movie_id, rating in ratings:
+        by_user.setdefault(user_id, []).append((movie_id, rating))
+    # leave one out: hide one movie each evaluated user loved, see where it ranks
+    evaluated = rng.sample(sorted(by_user), min(args.eval_users, len(by_user)))
+    held_out = {}
+    for user_id in evaluated:
+        loved = [movie_id for movie_id, rating in by_user[user_id] if rating >= 8]
+        if loved:
+            held_out[user_id] = rng.choice(loved)
+    training = [(user_id, movie_id, rating) for user_id, movie_id, rating in ratings
+                if held_out.get(user_id) != movie_id]
+    print(f"{args.users} users, {args.movies} movies, {len(ratings)} ratings, "
+          f"{len(held_out)} held out, top {args.n}")
+
+    def evaluate(recommend):
+        hits, gain, shown = 0, 0.0, set()
+        for user_id, movie_id in held_out.items():
+            picks = recommend(user_id)
+            shown.update(picks)
+            if movie_id in picks:
+                hits += 1
+                gain += 1 / math.log2(picks.index(movie_id) + 2)
+        return {"hit_rate": round(hits / len(held_out), 4), "ndcg": round(gain / len(held_out), 4),
+                "coverage": round(len(shown) / args.movies, 4)}
+
+    watched = {}
+    for user_id, movie_id, _ in training:
+        watched.setdefault(user_id, set()).add(movie_id)
+    liked = {}
+    for user_id, movie_id, rating in training:
+        if rating > 5:
+            liked[movie_id] = liked.get(movie_id, 0) + 1
+    by_popularity = sorted(liked, key=liked.get, reverse=True)
+    report = {"benchmark": "recommend", "users": args.users, "movies": args.movies,
+              "ratings": len(ratings), "held_out": len(held_out), "n": args.n, "models": {}}
+    report["models"]["popularity"] = evaluate(
+        lambda user_id: [movie_id for movie_id in by_popularity if movie_id not in watched[user_id]][:args.n])
+    print(f"{'popularity':22} hit rate {report['models']['popularity']['hit_rate']:.3f}  "
+          f"ndcg {report['models']['popularity']['ndcg']:.3f}")
+
+    for name, content_weight in (("ratings only", 0.0), ("genres/directors only", 1.0),
+                                 (f"blend {args.content_weight}", args.content_weight)):
+        model = Recommender(args.neighbors, content_weight)
+        start = time.perf_counter()
+        model.fit(training, features)
+        fit_seconds = time.perf_counter() - start
+        result = evaluate(lambda user_id: [movie_id for movie_id, _ in model.recommend(user_id, args.n)])
+        result["fit_seconds"] = round(fit_seconds, 3)
+        report["models"][name] = result
+        print(f"{name:22} hit rate {result['hit_rate']:.3f}  ndcg {result['ndcg']:.3f}  "
+              f"coverage {result['coverage']:.3f}  fit {fit_seconds:.2f} s")
+
+    # serving and incremental updates, on the blend
+    samples = []
+    for _ in range(args.repeat):
+        user_id = rng.choice(evaluated)
+        start = time.perf_counter()
+        model.recommend(user_id, args.n)
+        samples.append((time.perf_counter() - start) * 1000)
+    report["recommend"] = percentiles(samples)
+    # every evaluated user watches their held out movie: fold it in, then compare with a full refit
+    for user_id, movie_id in held_out.items():
+        model.set_profile(user_id, [(m, rating) for m, rating in by_user[user_id]])
+    start = time.perf_counter()
+    updated = model.update()
+    update_seconds = time.perf_counter() - start
+    refit = Recommender(args.neighbors, args.content_weight)
+    start = time.perf_counter()
+    refit.fit(ratings, features)
+    refit_seconds = time.perf_counter() - start
+    overlap = [len({m for m, _ in model.recommend(user_id, args.n)} & {m for m, _ in refit.recommend(user_id, args.n)})
+               / args.n for user_id in evaluated]
+    report["update"] = {"watches": len(held_out), "movies_updated": updated,
+                        "update_seconds": round(update_seconds, 3), "refit_seconds": round(refit_seconds, 3),
+                        "top_n_overlap_with_refit": round(statistics.mean(overlap), 4)}
+    result = report["recommend"]
+    print(f"recommend   p50 {result['p50_ms']:.3f} ms  p95 {result['p95_ms']:.3f} ms  p99 {result['p99_ms']:.3f} ms")
+    print(f"update      {len(held_out)} new watches: neighbors of {updated} movies in {update_seconds:.3f} s "
+          f"(full refit {refit_seconds:.3f} s), top {args.n} overlap with the refit "
+          f"{report['update']['top_n_overlap_with_refit']:.1%}")
+    return report
+
+
+def bench_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{old.get('commit') or args.old} -> {new.get('commit') or args.new}")
+    for name, result in new.get("routes", {}).items():
+        before = old.get("routes", {}).get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if before.get(key) and result.get(key) is not None:
+                changes.append(f"{key[:3]} {before[key]:8.2f} -> {result[key]:8.2f} ms "
+                               f"({(result[key] - before[key]) / before[key]:+6.1%})")
+        print(f"{name:20} " + "   ".join(changes))
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", help="database URL to seed (default: a temporary SQLite file)")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plans = commands.add_parser("plans", help="query plans and timings before/after the watch_history index")
+    plans.add_argument("--users", type=int, default=200)
+    plans.add_argument("--watches", type=int, default=500, help="watch history rows per user")
+    plans.add_argument("--repeat", type=int, default=200, help="timed runs per query")
+    plans.set_defaults(run=bench_plans)
+
+    sessions = commands.add_parser("sessions", help="per-request cost of each session backend")
+    sessions.add_argument("--sessions", type=int, default=2000, help="other sessions in the store")
+    sessions.add_argument("--repeat", type=int, default=500, help="timed requests per backend")
+    sessions.set_defaults(run=bench_sessions)
+
+    routes = commands.add_parser("routes", help="test client micro-benchmarks of every page")
+    routes.add_argument("--users", type=int, default=50)
+    routes.add_argument("--watches", type=int, default=500, help="watch history rows per user")
+    routes.add_argument("--repeat", type=int, default=50, help="timed requests per route")
+    routes.add_argument("--omdb-latency", type=float, default=0, help="milliseconds the OMDb stub waits")
+    routes.set_defaults(run=bench_routes)
+
+    load = commands.add_parser("load", help="concurrent clients against a real server")
+    load.add_argument("--users", type=int, default=50)
+    load.add_argument("--watches", type=int, default=500, help="watch history rows per user")
+    load.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    load.add_argument("--duration", type=float, default=30, help="seconds")
+    load.add_argument("--server", choices=["gunicorn", "werkzeug"], default="gunicorn")
+    load.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    load.add_argument("--threads", type=int, default=1, help="threads per gunicorn worker")
+    load.add_argument("--omdb-latency", type=float, default=100, help="milliseconds the OMDb stub waits")
+    load.set_defaults(run=bench_load)
+
+    topk = commands.add_parser("topk", help="per-user top-k ratings as the number of users grows")
+    topk.add_argument("--users", type=lambda value: [int(n) for n in value.split(",")], default=[100, 1000, 5000],
+                      help="comma separated user counts, each seeded into a fresh database")
+    topk.add_argument("--watches", type=int, default=100, help="watch history rows per user")
+    topk.add_argument("--k", type=int, default=5)
+    topk.add_argument("--repeat", type=int, default=50, help="timed runs per query")
+    topk.set_defaults(run=bench_topk)
+
+    keys = commands.add_parser("keys", help="joins on title keys, migration 7, then joins on integer ids")
+    keys.add_argument("--users", type=int, default=200)
+    keys.add_argument("--watches", type=int, default=500, help="watch history rows per user")
+    keys.add_argument("--batch-size", type=int, default=10000, help="MIGRATION_BATCH_SIZE")
+    keys.add_argument("--repeat", type=int, default=200, help="timed runs per query")
+    keys.set_defaults(run=bench_keys)
+
+    timeseries = commands.add_parser("timeseries", help="watches per week/month/year bucketed in SQL, in Python, cached")
+    timeseries.add_argument("--users", type=int, default=50)
+    timeseries.add_argument("--watches", type=int, default=2000, help="watch history rows per user, over 15 years")
+    timeseries.add_argument("--repeat", type=int, default=50, help="timed runs per period")
+    timeseries.set_defaults(run=bench_timeseries)
+
+    recommend = commands.add_parser("recommend", help="offline evaluation of the recommender on synthetic tastes")
+    recommend.add_argument("--users", type=int, default=2000)
+    recommend.add_argument("--movies", type=int, default=3000)
+    recommend.add_argument("--watches", type=int, default=100, help="most watched movies per user")
+    recommend.add_argument("--eval-users", type=int, default=500, help="users with a held out movie")
+    recommend.add_argument("--n", type=int, default=10, help="recommendations per user")
+    recommend.add_argument("--neighbors", type=int, default=50, help="RECOMMEND_NEIGHBORS")
+    recommend.add_argument("--content-weight", type=float, default=0.3, help="RECOMMEND_CONTENT_WEIGHT")
+    recommend.add_argument("--repeat", type=int, default=1000, help="timed recommendations")
+    recommend.set_defaults(run=bench_recommend)
+
+    compare = commands.add_parser("compare", help="latency change between two --json reports")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.set_defaults(run=bench_compare)
+
+    args = parser.parse_args(argv)
+    if not args.database:
+        args.database = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="movie-bench-"), "bench.db")
+    report = args.run(args)
+    if args.json and report is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Encoding of watch history and wishlist exports.
+
+encode() turns an iterator of row tuples into an iterator of byte chunks in
+CSV, NDJSON or Parquet, a chunk every chunk_rows rows, so an export is
+streamed in constant memory however long the history is. The output only
+depends on the rows, which is what lets /export serve byte ranges of it.
+Reading the rows is done by the /export route in app.py.
+
+The CSV and NDJSON exports of the history use the column names importer.py
+reads, so an export can be imported again as is.
+
+Parquet needs the optional pyarrow package.
+"""
+
+import csv
+import io
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# (name, type) of the exported columns, the types are used for the Parquet schema
+HISTORY_COLUMNS = [("title", "str"), ("year", "int"), ("genre", "str"), ("director", "str"),
+                   ("language", "str"), ("watch_date", "date"), ("personal_rating", "float"),
+                   ("comments", "str"), ("imdb_rating", "float"), ("boxoffice", "str")]
+WISHLIST_COLUMNS = [("title", "str"), ("year", "int"), ("genre", "str"), ("director", "str"),
+                    ("language", "str"), ("comments", "str"), ("imdb_rating", "float"), ("boxoffice", "str")]
+
+# format: (mimetype, file extension)
+FORMATS = {"csv": ("text/csv", "csv"),
+           "ndjson": ("application/x-ndjson", "jsonl"),
+           "parquet": ("application/vnd.apache.parquet", "parquet")}
+
+
+class ExportUnavailable(Exception):
+    """The format needs an optional package that isn't installed."""
+
+
+def encode(rows, columns, fmt, chunk_rows=1000):
+    """Yield the rows encoded as fmt, in byte chunks of chunk_rows rows."""
+    if fmt == "csv":
+        return _csv_chunks(rows, columns, chunk_rows)
+    elif fmt == "ndjson":
+        return _ndjson_chunks(rows, columns, chunk_rows)
+    elif fmt == "parquet":
+        if pyarrow is None:
+            raise ExportUnavailable("Parquet export needs the pyarrow package")
+        return _parquet_chunks(rows, columns, chunk_rows)
+    raise ValueError(f"Unknown export format {fmt!r}")
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _csv_chunks(rows, columns, chunk_rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    yield buffer.getvalue().encode()
+    for chunk in _chunks(rows, chunk_rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(rows, columns, chunk_rows):
+    names = [name for name, _ in columns]
+    for chunk in _chunks(rows, chunk_rows):
+        yield "".join(json.dumps(dict(zip(names, row)), default=str, ensure_ascii=False) + "\n"
+                      for row in chunk).encode()
+
+
+class _Sink:
+    """A write-only file for ParquetWriter whose output is collected between row groups."""
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _parquet_chunks(rows, columns, chunk_rows):
+    types = {"str": pyarrow.string(), "int": pyarrow.int64(), "float": pyarrow.float64(), "date": pyarrow.date32()}
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    # one row group per chunk
+    for chunk in _chunks(rows, chunk_rows):
+        table = pyarrow.Table.from_pylist([dict(zip(schema.names, row)) for row in chunk], schema=schema)
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def byte_range(chunks, start, stop):
+    """Yield the bytes [start, stop) of the concatenated chunks."""
+    offset = 0
+    for chunk in chunks:
+        end = offset + len(chunk)
+        if end > start and offset < stop:
+            yield chunk[max(start - offset, 0):min(stop - offset, len(chunk))]
+        if end >= stop:
+            return
+        offset = end
@@ -1,10 +1,26 @@
 import os
+import base64
+import contextvars
+import json
+import logging
+import random
 import requests
-import urllib.parse
+import secrets
+import threading
+import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 from flask import redirect, render_template, request, session
+from flask.sessions import SessionInterface, session_json_serializer
+from flask_session.sessions import ServerSideSession
 from functools import wraps
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
 
+logger = logging.getLogger(__name__)
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -20,6 +36,20 @@ def apology(message, code=400):
         return s
     return render_template("apology.html", top=code, bottom=escape(message)), code
 
+def encode_cursor(*values):
+    """Encode the sort key of the last row shown into an opaque, url-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor, raise ValueError if it was tampered with."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(values, list):
+        raise ValueError("invalid cursor")
+    return values
+
 def login_required(f):
     """
     Decorate routes to require login.
@@ -33,21 +63,180 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def lookup(title):
-    """Look up movie data for title."""
+class OmdbUnavailable(Exception):
+    """Raised when the OMDb API can't be reached (as opposed to a title it doesn't know)."""
+
+
+class CircuitOpen(OmdbUnavailable):
+    """Raised without calling OMDb while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fail fast after failure_threshold consecutive failures.
+
+    Once open, calls are refused for reset_timeout seconds, then a single
+    trial call is let through: success closes the breaker, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half-open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning("OMDb circuit breaker opened after %d failures", self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class OmdbClient:
+    """
+    HTTP client for the OMDb API.
+
+    Keeps one pooled keep-alive requests.Session per worker process, bounds
+    every call with connect/read timeouts, retries connection errors and 5xx
+    answers with jittered exponential backoff, and stops calling OMDb while
+    the circuit breaker is open.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url="http://www.omdbapi.com/", api_key=None, connect_timeout=3.05,
+                 read_timeout=5, retries=2, backoff=0.25, pool_size=10, breaker=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.retried = 0
+        self.short_circuited = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        # called with the duration of every call, for the request instrumentation
+        self.listeners = []
+
+    @property
+    def session(self):
+        # gunicorn forks workers; a pool must never be shared across processes
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def get(self, **params):
+        """Call the API and return the decoded JSON, raise OmdbUnavailable on failure."""
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise CircuitOpen("OMDb circuit breaker is open")
+
+        params["apikey"] = self.api_key or os.environ.get("API_KEY")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            start = time.perf_counter()
+            try:
+                response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                if response.status_code in self.RETRY_STATUSES:
+                    error = requests.HTTPError(f"OMDb answered {response.status_code}", response=response)
+                    continue
+                response.raise_for_status()
+                data = response.json()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                continue
+            except (requests.RequestException, ValueError) as e:
+                error = e
+                break
+            finally:
+                self._record_latency(time.perf_counter() - start)
+            self.breaker.record_success()
+            return data
+
+        with self._lock:
+            self.errors += 1
+        self.breaker.record_failure()
+        raise OmdbUnavailable(str(error)) from error
+
+    def _record_latency(self, seconds):
+        with self._lock:
+            self.calls += 1
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+        for listener in self.listeners:
+            listener(seconds)
+
+    def metrics(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retried,
+            "short_circuited": self.short_circuited,
+            "latency_avg_ms": round(1000 * self.latency_total / self.calls, 2) if self.calls else 0,
+            "latency_max_ms": round(1000 * self.latency_max, 2),
+            "breaker": self.breaker.state,
+        }
+
+
+omdb = OmdbClient(
+    base_url=os.environ.get("OMDB_URL", "http://www.omdbapi.com/"),
+    connect_timeout=float(os.environ.get("OMDB_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.environ.get("OMDB_READ_TIMEOUT", 5)),
+    retries=int(os.environ.get("OMDB_RETRIES", 2)),
+    breaker=CircuitBreaker(int(os.environ.get("OMDB_BREAKER_THRESHOLD", 5)),
+                           int(os.environ.get("OMDB_BREAKER_RESET", 30))),
+)
+
+
+def fetch_movie(title, imdb_id=None, year=None):
+    """Look up movie data for title, of that year if given, or by IMDb id when it is known.
+
+    Returns None when OMDb doesn't know the title and raises OmdbUnavailable
+    when the API itself failed, so callers can tell the two apart.
+    """
 
     # Contact API
-    try:
-        api_key = os.environ.get("API_KEY")
-        url = f"http://www.omdbapi.com/?t={urllib.parse.quote_plus(title)}&apikey={api_key}"
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException:
-        return None
+    if imdb_id:
+        data = omdb.get(i=imdb_id)
+    elif year:
+        data = omdb.get(t=title, y=year)
+    else:
+        data = omdb.get(t=title)
 
     # Parse response
     try:
-        data = response.json()
         return {
             "title": data["Title"],
             "year": int(data["Year"]),
@@ -57,6 +246,243 @@ def lookup(title):
             "language": data["Language"],
             "boxoffice": data["BoxOffice"],
             "poster": data["Poster"],
+            "imdb_id": data.get("imdbID"),
         }
     except (KeyError, TypeError, ValueError):
-        return None
\ No newline at end of file
+        return None
+
+def fetch_movies(queries, workers=4):
+    """
+    fetch_movie() for many (title, imdb_id, year) queries, with at most workers
+    calls to OMDb in flight. Returns {query: result}; queries that failed map
+    to the OmdbUnavailable raised.
+    """
+    def fetch(query):
+        try:
+            return fetch_movie(*query)
+        except OmdbUnavailable as error:
+            return error
+
+    if not queries:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # each call runs in a copy of the caller's context, so it is counted against the caller's request
+        futures = [pool.submit(contextvars.copy_context().run, fetch, query) for query in queries]
+        return {query: future.result() for query, future in zip(queries, futures)}
+
+def parse_boxoffice(boxoffice):
+    """Turn OMDb's "$1,234,567" into 1234567 (dollars), None for "N/A" or anything unexpected."""
+    if not boxoffice:
+        return None
+    try:
+        return int(boxoffice.strip().lstrip("$").replace(",", ""))
+    except ValueError:
+        return None
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: acquire() blocks until a call is allowed, so at
+    most rate calls per second are made on average, with bursts of up to burst.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # negative tokens are calls already promised to earlier callers
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache where every entry carries its own expiry.
+
+    None is a valid cached value (used for negative caching), so get() takes
+    a default to tell a miss apart from a cached "not found".
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DatabaseCache:
+    """
+    Key/value cache in a database table (key, value, expires_at) shared by every
+    worker, with the get/set/delete/clear of LRUCache and cachelib's caches.
+    Values are stored as JSON. Like DatabaseSessionInterface, every call runs in
+    its own short transaction and never touches the request's ORM session.
+    """
+
+    def __init__(self, table, engine):
+        self.table = table
+        # a callable, the engine of Flask-SQLAlchemy is only available in an app context
+        self.engine = engine
+
+    def get(self, key, default=None):
+        with self.engine().connect() as connection:
+            row = connection.execute(select(self.table.c.value, self.table.c.expires_at)
+                                     .where(self.table.c.key == key)).first()
+        if row is None or row.expires_at <= datetime.utcnow():
+            return default
+        return json.loads(row.value)
+
+    def set(self, key, value, ttl):
+        values = {"value": json.dumps(value), "expires_at": datetime.utcnow() + timedelta(seconds=ttl)}
+        try:
+            with self.engine().begin() as connection:
+                updated = connection.execute(update(self.table).where(self.table.c.key == key)
+                                             .values(**values)).rowcount
+                if not updated:
+                    connection.execute(self.table.insert().values(key=key, **values))
+        except IntegrityError:
+            # another worker inserted the same key first, either value will do
+            pass
+
+    def delete(self, key):
+        with self.engine().begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.key == key))
+
+    def clear(self):
+        with self.engine().begin() as connection:
+            connection.execute(delete(self.table))
+
+
+class DatabaseSessionInterface(SessionInterface):
+    """
+    Server-side sessions stored in a database table through an existing
+    SQLAlchemy engine, so every worker on every host sees the same sessions.
+
+    The cookie only holds a random session id. Session writes run in their
+    own short transaction and never commit the request's ORM session. A
+    session that hasn't changed is written back only when less than
+    idle_timeout - touch_interval is left before it expires, not on every
+    request. Browser-session (non permanent) sessions expire idle_timeout
+    after their last write, permanent ones after PERMANENT_SESSION_LIFETIME.
+    """
+
+    def __init__(self, table, engine, idle_timeout=timedelta(days=7), touch_interval=timedelta(minutes=5)):
+        self.table = table
+        # a callable, the engine of Flask-SQLAlchemy is only available in an app context
+        self.engine = engine
+        self.idle_timeout = idle_timeout
+        self.touch_interval = touch_interval
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with self.engine().connect() as connection:
+                row = connection.execute(select(self.table.c.data, self.table.c.expires_at)
+                                         .where(self.table.c.session_id == sid)).first()
+            if row is not None and row.expires_at > datetime.utcnow():
+                try:
+                    session = ServerSideSession(session_json_serializer.loads(row.data), sid=sid)
+                    session.expires_at = row.expires_at
+                    return session
+                except ValueError:
+                    pass
+        session = ServerSideSession(sid=secrets.token_urlsafe(32))
+        session.expires_at = None
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                # logged out
+                with self.engine().begin() as connection:
+                    connection.execute(delete(self.table).where(self.table.c.session_id == session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = datetime.utcnow()
+        lifetime = app.permanent_session_lifetime if session.permanent else self.idle_timeout
+        if (not session.modified and session.expires_at is not None
+                and session.expires_at - now > lifetime - self.touch_interval):
+            return
+
+        values = {"data": session_json_serializer.dumps(dict(session)), "expires_at": now + lifetime}
+        with self.engine().begin() as connection:
+            updated = connection.execute(update(self.table).where(self.table.c.session_id == session.sid)
+                                         .values(**values)).rowcount
+            if not updated:
+                connection.execute(self.table.insert().values(session_id=session.sid, **values))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+class PeriodicTask:
+    """
+    Run task() every interval seconds in a daemon thread of the current process.
+
+    start() is cheap to call on every request; it starts the thread once per
+    process, so forked gunicorn workers each get their own.
+    """
+
+    def __init__(self, task, interval):
+        self.task = task
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="periodic-" + self.task.__name__, daemon=True).start()
+
+    def _run(self):
+        while True:
+            # jittered, so workers started together don't all run at once
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+            try:
+                self.task()
+            except Exception:
+                logger.exception("Periodic task %s failed", self.task.__name__)
@@ -0,0 +1,148 @@
+"""
+Parsing of watch history exports for the bulk import.
+
+read_records() streams the rows of a CSV or JSON upload without loading the
+whole file, and normalize() maps one Letterboxd, IMDb or Movie Tracker row
+to the fields of a watch history record. Rows that can't be imported raise
+Rejected with the reason. Looking the movies up and writing them is done by
+import_history() in app.py.
+
+Supported files:
+- Letterboxd diary.csv / watched.csv / ratings.csv (ratings are 0.5-5 stars)
+- IMDb ratings.csv (the "Date Rated" is used as the watch date, the "Const"
+  IMDb id to look the movie up)
+- CSV or JSON with title, watch_date, personal_rating and comments fields,
+  and optionally year and imdb_id, as a JSON array or one object per line
+"""
+
+import csv
+import io
+import json
+
+from datetime import date
+from itertools import islice
+
+
+class Rejected(ValueError):
+    """A row that can't be imported; the message says why."""
+
+
+def detect_format(filename, head):
+    """"csv" or "json", from the file extension or else the first bytes of the file."""
+    filename = (filename or "").lower()
+    if filename.endswith(".csv"):
+        return "csv"
+    if filename.endswith((".json", ".jsonl", ".ndjson")):
+        return "json"
+    return "json" if head.lstrip(b"\xef\xbb\xbf \t\r\n")[:1] in (b"[", b"{") else "csv"
+
+
+def read_records(stream, fmt):
+    """Yield (line number, raw row dict) from a binary stream, one row at a time."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == "json":
+        for number, row in enumerate(iter_json(text), 1):
+            yield number, row
+    else:
+        raise ValueError(f"Unknown import format {fmt!r}")
+
+
+def iter_json(text, chunk_size=64 * 1024):
+    """
+    Yield the values of a JSON array, or of one-value-per-line JSON, reading
+    text chunk_size characters at a time.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    while True:
+        # between values: whitespace, commas and the brackets of the outer array
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,[]":
+            pos += 1
+        try:
+            if pos == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, pos)
+            value, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            chunk = text.read(chunk_size)
+            if not chunk:
+                if pos < len(buffer):
+                    raise ValueError(f"Invalid JSON near {buffer[pos:pos + 40]!r}")
+                return
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield value
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _field(row, *names):
+    for name in names:
+        value = row.get(name)
+        if value is not None and str(value).strip() != "":
+            return str(value).strip()
+    return None
+
+
+def normalize(raw):
+    """
+    Map an exported row to {"title", "imdb_id", "year", "watch_date",
+    "personal_rating", "comments"}, raise Rejected when it can't be imported.
+    """
+    if not isinstance(raw, dict):
+        raise Rejected("not a record")
+    row = {str(key).strip().lower(): value for key, value in raw.items() if key is not None}
+
+    title = _field(row, "title", "name", "movie_id")
+    if title is None:
+        raise Rejected("missing title")
+
+    imdb_id = _field(row, "imdb_id", "const")
+    if imdb_id is not None and not imdb_id.startswith("tt"):
+        imdb_id = None
+
+    year = _field(row, "year")
+    try:
+        year = int(year) if year is not None else None
+    except ValueError:
+        year = None
+
+    # Letterboxd's diary has both the day it was logged ("date") and the day it was watched
+    watched = _field(row, "watch_date", "watched date", "date rated", "date")
+    if watched is None:
+        raise Rejected("missing watch date")
+    try:
+        watch_date = date.fromisoformat(watched[:10])
+    except ValueError:
+        raise Rejected("invalid watch date")
+
+    rating = _field(row, "personal_rating", "your rating", "rating")
+    if rating is not None:
+        try:
+            rating = float(rating)
+        except ValueError:
+            raise Rejected("invalid rating")
+        if "letterboxd uri" in row:
+            # stars out of 5
+            rating *= 2
+        if rating < 0 or rating > 10:
+            raise Rejected("rating not between 0 and 10")
+
+    return {"title": title,
+            "imdb_id": imdb_id,
+            "year": year,
+            "watch_date": watch_date,
+            "personal_rating": rating,
+            "comments": _field(row, "comments", "review")}
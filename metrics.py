@@ -0,0 +1,161 @@
+"""
+Request instrumentation: what one request spent on SQL and OMDb, and
+Prometheus-style counters and histograms for /metrics.
+
+RequestStats is filled in by the SQLAlchemy engine events and the OMDb client
+hook set up in app.py, for the requests picked by INSTRUMENT_SAMPLE_RATE.
+Registry keeps the metrics of this worker process and renders them in the
+Prometheus text format.
+"""
+
+import threading
+
+from bisect import bisect_left
+
+# seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# statements per request
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class RequestStats:
+    """SQL statements and OMDb calls of one request; calls may come from several threads."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.omdb_calls = 0
+        self.omdb_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_query(self, statement, seconds):
+        with self._lock:
+            self.queries += 1
+            self.db_time += seconds
+            if seconds > self.slowest_time:
+                self.slowest_time = seconds
+                self.slowest_statement = statement
+
+    def add_omdb_call(self, seconds):
+        with self._lock:
+            self.omdb_calls += 1
+            self.omdb_time += seconds
+
+    def server_timing(self, total):
+        """Value of a Server-Timing header, durations in milliseconds."""
+        return ", ".join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'db-slowest;dur={self.slowest_time * 1000:.1f}',
+            f'omdb;dur={self.omdb_time * 1000:.1f};desc="{self.omdb_calls} calls"',
+            f"total;dur={total * 1000:.1f}",
+        ])
+
+    def to_dict(self):
+        return {"queries": self.queries,
+                "db_ms": round(self.db_time * 1000, 2),
+                "slowest_query_ms": round(self.slowest_time * 1000, 2),
+                "slowest_query": " ".join((self.slowest_statement or "").split())[:500] or None,
+                "omdb_calls": self.omdb_calls,
+                "omdb_ms": round(self.omdb_time * 1000, 2)}
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels: [count per bucket (the last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    labels = _labels(self.labelnames + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics of this process, in registration order."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collected(self, name, help, collect, kind="gauge"):
+        """
+        A metric read when rendering: collect() returns a number, or {key: number}
+        rendered with a "key" label.
+        """
+        self.collectors.append((name, help, kind, collect))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for name, help, kind, collect in self.collectors:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            value = collect()
+            if isinstance(value, dict):
+                lines += [f"{name}{_labels(('key',), (key,))} {number}" for key, number in sorted(value.items())]
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
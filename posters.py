@@ -0,0 +1,122 @@
+"""
+On-disk cache of poster images, for the /poster proxy.
+
+Each poster is downloaded once and stored under the sha256 of its content,
+with a small index from poster url to content hash, and resized copies are
+kept next to it per width. Files are written to a temporary name and renamed,
+so concurrent workers filling the same entry never see a partial file.
+
+    root/urls/<sha1 of url>          content hash of what the url returned
+    root/originals/<hash>            the downloaded image
+    root/thumbs/<hash>-<width>.jpg   resized to width pixels wide
+
+Resizing needs the optional Pillow package; without it the original image
+is served at every width. An image Pillow can't decode, or one of more than
+max_pixels pixels, is PosterUnavailable like a failed download.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+
+import requests
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class PosterUnavailable(Exception):
+    """The poster couldn't be downloaded."""
+
+
+class PosterCache:
+    """Content-addressed poster files under root, see the module docstring for the layout."""
+
+    def __init__(self, root, timeout=(3.05, 10), max_bytes=10 * 1024 * 1024, max_pixels=25_000_000):
+        self.root = root
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+    def original(self, url):
+        """Content hash of the poster at url, downloading it on first use."""
+        index = os.path.join(self.root, "urls", hashlib.sha1(url.encode()).hexdigest())
+        try:
+            with open(index) as f:
+                digest = f.read().strip()
+            if os.path.exists(self._original_path(digest)):
+                return digest
+        except FileNotFoundError:
+            pass
+
+        data = self._download(url)
+        digest = hashlib.sha256(data).hexdigest()
+        self._write(self._original_path(digest), data)
+        self._write(index, digest.encode())
+        return digest
+
+    def thumbnail(self, url, width):
+        """(path, mimetype, etag) of the poster resized to width, making it if needed."""
+        digest = self.original(url)
+        if Image is None:
+            return self._original_path(digest), self._mimetype(digest), f"{digest[:32]}"
+        path = os.path.join(self.root, "thumbs", f"{digest}-{width}.jpg")
+        if not os.path.exists(path):
+            try:
+                with open(self._original_path(digest), "rb") as f:
+                    # only the header is read until load()
+                    image = Image.open(f)
+                    if image.width * image.height > self.max_pixels:
+                        raise PosterUnavailable(f"Poster larger than {self.max_pixels} pixels: {url}")
+                    image.load()
+                if image.width > width:
+                    image.thumbnail((width, width * 10))
+                output = io.BytesIO()
+                image.convert("RGB").save(output, "JPEG", quality=85, optimize=True, progressive=True)
+            except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as error:
+                # not an image, a truncated or corrupt one, or a decompression bomb
+                raise PosterUnavailable(f"Not an image: {url}") from error
+            self._write(path, output.getvalue())
+        return path, "image/jpeg", f"{digest[:32]}-{width}"
+
+    def _download(self, url):
+        if not url.startswith(("http://", "https://")):
+            raise PosterUnavailable(f"Not a poster url: {url!r}")
+        data = bytearray()
+        try:
+            with requests.get(url, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(64 * 1024):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise PosterUnavailable(f"Poster larger than {self.max_bytes} bytes: {url}")
+        except requests.RequestException as error:
+            raise PosterUnavailable(str(error)) from error
+        return bytes(data)
+
+    def _original_path(self, digest):
+        return os.path.join(self.root, "originals", digest)
+
+    def _mimetype(self, digest):
+        with open(self._original_path(digest), "rb") as f:
+            head = f.read(8)
+        if head.startswith(b"\x89PNG"):
+            return "image/png"
+        if head[:4] == b"RIFF":
+            return "image/webp"
+        return "image/jpeg"
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
@@ -0,0 +1,272 @@
+"""
+"Watch next" recommendations: item-based collaborative filtering blended
+with the genres and directors movies share.
+
+Each user's watch history is a sparse row of preferences, one per movie: the
+personal rating mapped to -1..1 around the middle of the scale, so a movie
+the user disliked pulls its neighbors down. Two movies are similar when the
+same users feel the same about them (the cosine of their columns of the
+users x movies matrix, shrunk for movies few users rated) and, for
+content_weight of the similarity, when they share tags (the cosine of their
+feature vectors). Every movie keeps its `neighbors` most similar movies in
+two fixed width arrays, the in-memory index, so a user's scores are the
+neighbor rows of what they watched weighted by their preferences: one
+bincount over a few thousand entries.
+
+fit() builds everything from every rating. set_profile() replaces one
+user's ratings and queues the movies they changed; update() recomputes the
+neighbors of just those movies, so new watches are folded in without a full
+refit. The neighbor lists of other movies can drift slightly until the next
+fit().
+
+Needs the optional numpy and scipy packages.
+"""
+
+import threading
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+# the middle of the 0-10 personal rating scale, neither liked nor disliked
+NEUTRAL_RATING = 5.0
+# preference of a watch without a rating: watching it says a little
+UNRATED_PREFERENCE = 0.2
+
+
+class RecommenderUnavailable(Exception):
+    """numpy or scipy isn't installed."""
+
+
+def preference(rating):
+    """A personal rating (0-10, or None) as a preference between -1 and 1."""
+    if rating is None:
+        return UNRATED_PREFERENCE
+    return max(-1.0, min(1.0, (float(rating) - NEUTRAL_RATING) / NEUTRAL_RATING))
+
+
+class Recommender:
+    """
+    Item-item recommender over movie ids, see the module docstring. Safe to
+    share between threads: recommend() keeps working while fit() or update() runs.
+    """
+
+    # what fit() replaces in one go
+    _STATE = ("_movie_ids", "_cols", "_features", "_movie_features", "_profiles", "_versions",
+              "_pending", "_index", "_weights", "_popularity", "_indexed_ids", "ready")
+
+    def __init__(self, neighbors=50, content_weight=0.3, shrink=2.0, chunk_cells=4_000_000):
+        if np is None:
+            raise RecommenderUnavailable("Recommendations need the numpy and scipy packages")
+        self.neighbors = neighbors
+        self.content_weight = content_weight
+        self.shrink = shrink
+        # similarities are worked out for chunk_cells (movie, movie) pairs at a time
+        self.chunk_cells = chunk_cells
+        # guards the state, held briefly; _update_lock keeps fit() and update() to one at a time
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._movie_ids = []
+        self._cols = {}
+        self._features = {}
+        # feature columns of each movie column
+        self._movie_features = []
+        # user_id -> (movie columns, preferences)
+        self._profiles = {}
+        self._versions = {}
+        # movie columns whose neighbors are out of date
+        self._pending = set()
+        self._index = np.zeros((0, neighbors), dtype=np.int64)
+        self._weights = np.zeros((0, neighbors), dtype=np.float32)
+        self._popularity = np.zeros(0)
+        self._indexed_ids = np.zeros(0, dtype=np.int64)
+        # fit() has run
+        self.ready = False
+
+    def fit(self, ratings, features, versions=None):
+        """
+        Build the model from (user_id, movie_id, rating) ratings and
+        (movie_id, feature) features, e.g. tag ids. versions: {user_id:
+        version} the profiles are at, see profile_version().
+        """
+        with self._update_lock:
+            fresh = Recommender(self.neighbors, self.content_weight, self.shrink, self.chunk_cells)
+            for movie_id, feature in features:
+                fresh._add_feature(movie_id, feature)
+            by_user = {}
+            for user_id, movie_id, rating in ratings:
+                by_user.setdefault(user_id, {}).setdefault(movie_id, []).append(preference(rating))
+            versions = versions or {}
+            for user_id, preferences in by_user.items():
+                fresh._set_profile(user_id, preferences, versions.get(user_id))
+            for user_id in versions.keys() - by_user.keys():
+                fresh._versions[user_id] = versions[user_id]
+            fresh._pending = set(range(len(fresh._movie_ids)))
+            fresh._update()
+            with self._lock:
+                for name in self._STATE:
+                    setattr(self, name, getattr(fresh, name))
+                self.ready = True
+
+    def profile_version(self, user_id):
+        """The version given with the user's ratings, None if they never were."""
+        return self._versions.get(user_id)
+
+    def unknown(self, movie_ids):
+        """The movie ids the model has never seen, whose features set_profile() needs."""
+        return [movie_id for movie_id in movie_ids if movie_id not in self._cols]
+
+    def set_profile(self, user_id, ratings, version=None, features=()):
+        """
+        Replace the user's ratings with (movie_id, rating) pairs, a movie
+        watched several times counting with its average, and queue the movies
+        whose preference changed for update(). features: (movie_id, feature)
+        of the movies unknown() reported.
+        """
+        preferences = {}
+        for movie_id, rating in ratings:
+            preferences.setdefault(movie_id, []).append(preference(rating))
+        with self._lock:
+            for movie_id, feature in features:
+                self._add_feature(movie_id, feature)
+            self._set_profile(user_id, preferences, version)
+
+    def update(self):
+        """Recompute the neighbors of the movies queued by set_profile(), return how many."""
+        with self._update_lock:
+            return self._update()
+
+    def recommend(self, user_id, n=10, candidates=None):
+        """
+        [(movie_id, score)] of the n movies the user hasn't watched that score
+        highest, best first; candidates: only rank these movie ids. Movies
+        nothing the user watched points to are ranked by how many users liked
+        them, after those with a positive score.
+        """
+        with self._lock:
+            size = len(self._index)
+            movie_ids = self._indexed_ids
+            popularity = self._popularity
+            scores = np.zeros(size)
+            watched = np.zeros(0, dtype=np.int64)
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                cols, values = profile
+                # movies added since the last update() have no neighbors yet
+                known = cols < size
+                watched = cols[known]
+                votes = self._weights[watched] * values[known, None]
+                scores = np.bincount(self._index[watched].ravel(), weights=votes.ravel(), minlength=size)
+            if candidates is not None:
+                candidates = np.array([self._cols[movie_id] for movie_id in candidates
+                                       if self._cols.get(movie_id, size) < size], dtype=np.int64)
+        if size == 0:
+            return []
+        eligible = np.ones(size, dtype=bool)
+        if candidates is not None:
+            eligible[:] = False
+            eligible[candidates] = True
+        eligible[watched] = False
+        count = min(n, int(eligible.sum()))
+        if count == 0:
+            return []
+        # popularity only breaks ties, it never outweighs a real score
+        ranking = np.where(eligible, scores + 1e-6 * popularity / (popularity.max() + 1), -np.inf)
+        top = np.argpartition(-ranking, count - 1)[:count]
+        top = top[np.argsort(-ranking[top], kind="stable")]
+        return [(int(movie_ids[col]), float(scores[col])) for col in top]
+
+    def _col(self, movie_id):
+        col = self._cols.get(movie_id)
+        if col is None:
+            col = self._cols[movie_id] = len(self._movie_ids)
+            self._movie_ids.append(movie_id)
+            self._movie_features.append([])
+            self._pending.add(col)
+        return col
+
+    def _add_feature(self, movie_id, feature):
+        col = self._col(movie_id)
+        feature_col = self._features.setdefault(feature, len(self._features))
+        if feature_col not in self._movie_features[col]:
+            self._movie_features[col].append(feature_col)
+
+    def _set_profile(self, user_id, preferences, version):
+        """Set the user's profile from {movie_id: [preference]}, queue the movies that changed."""
+        cols = np.array([self._col(movie_id) for movie_id in preferences], dtype=np.int64)
+        values = np.array([sum(values) / len(values) for values in preferences.values()])
+        old_cols, old_values = self._profiles.get(user_id, (np.zeros(0, dtype=np.int64), np.zeros(0)))
+        old = dict(zip(old_cols.tolist(), old_values.tolist()))
+        new = dict(zip(cols.tolist(), values.tolist()))
+        self._pending.update(col for col in old.keys() | new.keys() if old.get(col) != new.get(col))
+        self._profiles[user_id] = (cols, values)
+        self._versions[user_id] = version
+
+    def _matrices(self):
+        """The movies x users preferences, the movies x features matrix and each movie's count of likes."""
+        size = len(self._movie_ids)
+        profiles = list(self._profiles.values())
+        cols = np.concatenate([cols for cols, _ in profiles] + [np.zeros(0, dtype=np.int64)])
+        values = np.concatenate([values for _, values in profiles] + [np.zeros(0)])
+        users = np.repeat(np.arange(len(profiles)), [len(cols) for cols, _ in profiles])
+        preferences = sparse.csr_matrix((values, (cols, users)), shape=(size, len(profiles)))
+        popularity = np.bincount(cols[values > 0], minlength=size).astype(float)
+        feature_cols = [col for features in self._movie_features for col in features]
+        movies = np.repeat(np.arange(size), [len(features) for features in self._movie_features])
+        features = sparse.csr_matrix((np.ones(len(feature_cols)), (movies, feature_cols)),
+                                     shape=(size, len(self._features)))
+        return size, preferences, features, popularity
+
+    def _update(self):
+        with self._lock:
+            pending = np.array(sorted(self._pending), dtype=np.int64)
+            self._pending = set()
+            size, preferences, features, popularity = self._matrices()
+            movie_ids = np.array(self._movie_ids, dtype=np.int64)
+        index, weights = self._neighbors_of(pending, preferences, features)
+        with self._lock:
+            if size > len(self._index):
+                grow = size - len(self._index)
+                self._index = np.vstack([self._index, np.zeros((grow, self.neighbors), dtype=np.int64)])
+                self._weights = np.vstack([self._weights, np.zeros((grow, self.neighbors), dtype=np.float32)])
+            self._index[pending] = index
+            self._weights[pending] = weights
+            self._popularity = popularity
+            self._indexed_ids = movie_ids
+        return len(pending)
+
+    def _neighbors_of(self, cols, preferences, features):
+        """(index, weights) rows of the neighbors of the movie columns cols."""
+        size = preferences.shape[0]
+        index = np.zeros((len(cols), self.neighbors), dtype=np.int64)
+        weights = np.zeros((len(cols), self.neighbors), dtype=np.float32)
+        if size == 0 or len(cols) == 0:
+            return index, weights
+        norms = np.sqrt(np.asarray(preferences.multiply(preferences).sum(axis=1)).ravel())
+        feature_norms = np.sqrt(np.asarray(features.sum(axis=1)).ravel())
+        feature_norms[feature_norms == 0] = 1
+        by_user = preferences.T.tocsr()
+        by_feature = features.T.tocsr()
+        width = min(self.neighbors, size)
+        step = max(1, self.chunk_cells // size)
+        for start in range(0, len(cols), step):
+            part = cols[start:start + step]
+            rated = (preferences[part] @ by_user).toarray()
+            rated /= norms[part, None] * norms[None, :] + self.shrink
+            shared = (features[part] @ by_feature).toarray()
+            shared /= feature_norms[part, None] * feature_norms[None, :]
+            similarity = (1 - self.content_weight) * rated + self.content_weight * shared
+            # a movie isn't its own neighbor
+            similarity[np.arange(len(part)), part] = 0
+            if width < size:
+                top = np.argpartition(-similarity, width - 1, axis=1)[:, :width]
+            else:
+                top = np.broadcast_to(np.arange(size), (len(part), size))
+            best = np.take_along_axis(similarity, top, axis=1)
+            # only similar movies vote
+            best[best < 0] = 0
+            index[start:start + len(part), :width] = top
+            weights[start:start + len(part), :width] = best
+        return index, weights
@@ -0,0 +1,160 @@
+"""
+Trigram matching of movie titles, for the local search in front of OMDb.
+
+Each title is split into the three-letter sequences of its words, the way
+PostgreSQL's pg_trgm does it, and kept in the title_trigrams table (see
+index_titles() in app.py). A query is matched by looking up the titles that
+share its trigrams, then score() ranks those candidates, so a typo or a
+missing word only costs a few trigrams instead of the whole match. Short
+titles have too few trigrams for that, so a close spelling of the whole
+title (difflib's ratio) counts as a match too.
+
+The last word of a query isn't closed off, so "the godf" matches "The
+Godfather" as a prefix. Accents and case are ignored.
+
+PrefixIndex is the in-memory index behind the autocomplete of the search box.
+"""
+
+import re
+import threading
+import unicodedata
+
+from bisect import bisect_left
+from difflib import SequenceMatcher
+
+
+def fold(text):
+    """Lowercase text without accents."""
+    text = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def words(text):
+    return re.findall(r"\w+", fold(text))
+
+
+def trigrams(text, prefix=False):
+    """
+    The trigrams of text's words, each padded with two spaces in front and
+    one behind. With prefix=True the last word gets no trailing space, so it
+    also matches longer words starting with it.
+    """
+    grams = set()
+    text_words = words(text)
+    for i, word in enumerate(text_words):
+        padded = "  " + word
+        if not (prefix and i == len(text_words) - 1):
+            padded += " "
+        grams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return grams
+
+
+def score(query, title):
+    """
+    How well title matches query, between 0 and about 1.2: mostly the share
+    of the query's trigrams found in the title, then how much of the title
+    the query covers, with a bonus when the title starts with the query.
+    A misspelling of the whole title scores its similarity ratio instead.
+    """
+    return _Query(query).score(title)
+
+
+def rank(query, titles, threshold=0.45, limit=None):
+    """[(score, title)] of the titles scoring at least threshold, best first."""
+    query = _Query(query)
+    scored = [(query.score(title), title) for title in titles]
+    scored = sorted((pair for pair in scored if pair[0] >= threshold), key=lambda pair: (-pair[0], pair[1]))
+    return scored[:limit] if limit else scored
+
+
+class _Query:
+    """The parts of a query score() needs, worked out once for all the candidates."""
+
+    def __init__(self, query):
+        self.wanted = trigrams(query, prefix=True)
+        self.text = " ".join(words(query))
+        # SequenceMatcher caches what it knows about its second sequence
+        self.matcher = SequenceMatcher(None, "", self.text, autojunk=False)
+
+    def score(self, title):
+        if not self.wanted:
+            return 0
+        found = trigrams(title)
+        shared = len(self.wanted & found)
+        result = 0.7 * shared / len(self.wanted) + 0.3 * shared / len(self.wanted | found)
+        title = " ".join(words(title))
+        if title.startswith(self.text):
+            result += 0.2
+        self.matcher.set_seq1(title)
+        # quick_ratio() is an upper bound of ratio()
+        if self.matcher.real_quick_ratio() >= 0.7 and self.matcher.quick_ratio() >= 0.7:
+            result = max(result, self.matcher.ratio())
+        return result
+
+
+class PrefixIndex:
+    """
+    Sorted array of titles for typeahead: every title is kept once per word,
+    from that word to the end, so "the d", "dark kn" and "kni" all find "The
+    Dark Knight" with a binary search. Safe to share between threads.
+    """
+
+    def __init__(self, titles=()):
+        self._lock = threading.Lock()
+        self.load(titles)
+
+    @staticmethod
+    def _entries(title):
+        title_words = words(title)
+        return [(" ".join(title_words[i:]), i, title) for i in range(len(title_words))]
+
+    def load(self, titles):
+        """Replace the contents of the index with titles."""
+        titles = set(titles)
+        entries = sorted(entry for title in titles for entry in self._entries(title))
+        with self._lock:
+            self._keys = [key for key, _, _ in entries]
+            self._entries_sorted = [(position, title) for _, position, title in entries]
+            self._titles = titles
+
+    def add(self, titles):
+        """Add the titles that aren't in the index yet."""
+        with self._lock:
+            titles = set(titles) - self._titles
+            entries = [entry for title in titles for entry in self._entries(title)]
+            self._titles |= titles
+            if len(entries) > 64:
+                # cheaper to sort everything again than to shift the arrays for each entry
+                entries = sorted(entries + [(key, position, title) for key, (position, title)
+                                            in zip(self._keys, self._entries_sorted)])
+                self._keys = [key for key, _, _ in entries]
+                self._entries_sorted = [(position, title) for _, position, title in entries]
+                return
+            for key, position, title in entries:
+                i = bisect_left(self._keys, key)
+                self._keys.insert(i, key)
+                self._entries_sorted.insert(i, (position, title))
+
+    def __len__(self):
+        return len(self._titles)
+
+    def __contains__(self, title):
+        return title in self._titles
+
+    def search(self, prefix, limit=50):
+        """
+        [(title, word position)] of up to limit titles having a word sequence
+        starting with prefix, position 0 when the title itself starts with it.
+        """
+        prefix = " ".join(words(prefix))
+        if not prefix:
+            return []
+        found = {}
+        with self._lock:
+            i = bisect_left(self._keys, prefix)
+            while i < len(self._keys) and self._keys[i].startswith(prefix) and len(found) < limit:
+                position, title = self._entries_sorted[i]
+                if position < found.get(title, position + 1):
+                    found[title] = position
+                i += 1
+        return list(found.items())
@@ -0,0 +1,289 @@
+"""
+Single pass computation of the stats dashboard.
+
+The /stats view used to run one query (or full scan) per card. Instead, the
+user's watch history and wishlist rows are fed once into a StatsSummary,
+which keeps every running aggregate the cards need, and build_cards() turns
+that summary into the lists dashboard_cards.html expects.
+
+The answers match the find_* functions in app.py, including their messages
+for empty tables and ties.
+"""
+
+import json
+
+from collections import Counter
+from datetime import date
+
+NO_HISTORY = "You don't have any record in your Watch History"
+NO_WISHLIST = "You don't have any record in your Wish List"
+
+
+def _update_best(best, value, movie_id):
+    """Keep the highest value seen and every movie that reached it."""
+    if value is None:
+        return
+    if best["value"] is None or value > best["value"]:
+        best["value"] = value
+        best["movies"] = [movie_id]
+    elif value == best["value"] and movie_id not in best["movies"]:
+        best["movies"].append(movie_id)
+
+
+class StatsSummary:
+    """
+    Running aggregates over one user's watch history and wishlist.
+
+    Rows are added with add_watch()/add_wish(); nothing here touches the
+    database. Movies are kept by id, so remakes sharing a title stay apart.
+    Dates are kept as ISO strings so the summary stays plain data and
+    round-trips through JSON with to_dict()/from_dict().
+    """
+
+    def __init__(self):
+        # watch history
+        self.history_count = 0
+        self.year_counts = {}
+        self.last_watch = None
+        self.future_watches = []
+        self.watch_counts = {}
+        self.best_personal = {"value": None, "movies": []}
+        self.best_imdb = {"value": None, "movies": []}
+        self.best_boxoffice = {"value": None, "movies": []}
+        self.rate_higher = {}
+        self.rate_lower = {}
+        self.genres = Counter()
+        self.directors = Counter()
+        self.languages = Counter()
+        # wishlist
+        self.wishlist_count = 0
+        self.wishlist_years = {}
+        self.wishlist_best_imdb = {"value": None, "movies": []}
+        self.wishlist_best_boxoffice = {"value": None, "movies": []}
+
+    def add_watch(self, movie_id, watch_date, personal_rating, imdb_rating, boxoffice_amount,
+                  genre, director, language, today):
+        self.history_count += 1
+        year = str(watch_date.year)
+        self.year_counts[year] = self.year_counts.get(year, 0) + 1
+
+        watched = watch_date.isoformat()
+        if watch_date > today:
+            self.future_watches.append(watched)
+        elif self.last_watch is None or watched > self.last_watch:
+            self.last_watch = watched
+
+        self.watch_counts[movie_id] = self.watch_counts.get(movie_id, 0) + 1
+        _update_best(self.best_personal, personal_rating, movie_id)
+        _update_best(self.best_imdb, imdb_rating, movie_id)
+        _update_best(self.best_boxoffice, boxoffice_amount, movie_id)
+
+        if personal_rating is not None and imdb_rating is not None:
+            diff = personal_rating - imdb_rating
+            if movie_id not in self.rate_higher or diff > self.rate_higher[movie_id]:
+                self.rate_higher[movie_id] = diff
+            if movie_id not in self.rate_lower or diff < self.rate_lower[movie_id]:
+                self.rate_lower[movie_id] = diff
+
+        if genre:
+            self.genres.update(genre.split(", "))
+        if director:
+            self.directors.update(director.split(", "))
+        if language:
+            self.languages.update(language.split(", "))
+
+    def add_wish(self, movie_id, year, imdb_rating, boxoffice_amount):
+        self.wishlist_count += 1
+        if year is not None and movie_id not in self.wishlist_years:
+            self.wishlist_years[movie_id] = year
+        _update_best(self.wishlist_best_imdb, imdb_rating, movie_id)
+        _update_best(self.wishlist_best_boxoffice, boxoffice_amount, movie_id)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        for name, value in data.items():
+            setattr(summary, name, value)
+        # JSON object keys are strings
+        for name in ("watch_counts", "rate_higher", "rate_lower", "wishlist_years"):
+            setattr(summary, name, {int(movie_id): value for movie_id, value in getattr(summary, name).items()})
+        summary.genres = Counter(summary.genres)
+        summary.directors = Counter(summary.directors)
+        summary.languages = Counter(summary.languages)
+        return summary
+
+    # The answers below mirror the find_* functions in app.py
+
+    def watched_in_year(self, year):
+        return self.year_counts.get(str(year), 0)
+
+    def days_since_last_watch(self, today):
+        watched = [d for d in self.future_watches if d <= today.isoformat()]
+        if self.last_watch is not None:
+            watched.append(self.last_watch)
+        if not watched:
+            return NO_HISTORY
+        return str((today - date.fromisoformat(max(watched))).days)
+
+    def highest(self, best, empty_message):
+        return list(best["movies"]) or empty_message
+
+    def highest_box_office(self, best, count, empty_message):
+        if not count:
+            return empty_message
+        if not best["value"]:
+            return empty_message.replace("any record", "any record with valid box office")
+        return list(best["movies"])
+
+    def compare_with_imdb(self, option):
+        movie_pairs = self.rate_higher if option == "rate higher" else self.rate_lower
+        if not movie_pairs:
+            return NO_HISTORY
+        if option == "rate higher":
+            diff = max(movie_pairs.values())
+            if diff <= 0:
+                return NO_HISTORY + " you " + option + " than IMDB"
+        else:
+            diff = min(movie_pairs.values())
+            if diff >= 0:
+                return NO_HISTORY + " you " + option + " than IMDB"
+        return [k for k, v in movie_pairs.items() if v == diff]
+
+    def most_watched(self):
+        if not self.watch_counts:
+            return NO_HISTORY
+        most_watch = max(self.watch_counts.values())
+        results = [k for k, v in self.watch_counts.items() if v == most_watch]
+        if len(results) > 3:
+            return "Too many movies tie as the most watched movie"
+        return results
+
+    def favorite(self, option):
+        tally = {"genre": self.genres, "director": self.directors, "language": self.languages}[option]
+        if not tally:
+            return NO_HISTORY
+        favorite = max(tally.values())
+        results = [k for k, v in tally.items() if v == favorite]
+        if len(results) > 5:
+            return "Too many " + option + " tie as your favorite " + option
+        return ", ".join(results)
+
+    def wishlist_by_year(self, option):
+        if not self.wishlist_years:
+            return NO_WISHLIST
+        if option == "old":
+            year = min(self.wishlist_years.values())
+        else:
+            year = max(self.wishlist_years.values())
+        return [k for k, v in self.wishlist_years.items() if v == year]
+
+
+def _comparable(summary, today):
+    """summary as plain data, without what depends on when it was built or in which order rows came."""
+    data = json.loads(json.dumps(summary.to_dict()))
+    today = today.isoformat()
+    # a future watch of the day the summary was stored may be a past one by now
+    watched = [day for day in data["future_watches"] if day <= today] + [data["last_watch"]] * bool(data["last_watch"])
+    data["last_watch"] = max(watched, default=None)
+    data["future_watches"] = sorted(day for day in data["future_watches"] if day > today)
+    for value in data.values():
+        if isinstance(value, dict) and "movies" in value:
+            value["movies"] = sorted(value["movies"])
+    return data
+
+
+def differences(stored, fresh, today):
+    """The names of the fields where a stored StatsSummary drifted from one freshly built from the rows."""
+    stored, fresh = _comparable(stored, today), _comparable(fresh, today)
+    return sorted(name for name in stored.keys() | fresh.keys() if stored.get(name) != fresh.get(name))
+
+
+def empty_cards():
+    return {name: [] for name in ("basic_stats",
+                                  "favorite", "favorite_with_img", "favorite_with_img_2",
+                                  "others", "others_with_img", "others_with_img_2",
+                                  "watch_next", "watch_next_with_img", "watch_next_with_img_2")}
+
+
+def add_card(cards, section, question, answer, movies):
+    """
+    Add a card to section, with one or two posters when the answer is one or
+    two movies. An answer that is a list of movies is shown as their titles;
+    movies maps each of them to its (title, poster url).
+    """
+    if type(answer) == list:
+        titles = [movies[movie][0] for movie in answer]
+    if type(answer) == list and len(answer) == 1:
+        cards[section + "_with_img"].append({"question": question,
+                                             "answer": titles,
+                                             "poster": movies[answer[0]][1]})
+    elif type(answer) == list and len(answer) == 2:
+        cards[section + "_with_img_2"].append({"question": question,
+                                               "answer": titles,
+                                               "poster_1": movies[answer[0]][1],
+                                               "poster_2": movies[answer[1]][1]})
+    elif type(answer) == list:
+        cards[section].append({"question": question,
+                               "answer": titles})
+    else:
+        cards[section].append({"question": question,
+                               "answer": answer})
+
+
+def build_cards(summary, resolve_movies, today, recommendations=()):
+    """
+    Turn a StatsSummary into the card lists of dashboard_cards.html.
+
+    resolve_movies takes a list of movie ids and returns a dict of their
+    (title, poster url). It is called once, with every movie a card shows.
+    recommendations are extra (question, answer) "Watch next" cards, answers
+    listing movie ids like the summary's.
+    """
+    picture_answers = [
+        # Personal Favorites
+        ("favorite", "Your Favorite Movie", summary.highest(summary.best_personal, NO_HISTORY)),
+        ("favorite", "You can't stop re-watching", summary.most_watched()),
+        # Comparing to others
+        ("others", "Most popular movie you have watched",
+         summary.highest_box_office(summary.best_boxoffice, summary.history_count, NO_HISTORY)),
+        ("others", "Highest IMDb rating movie you have watched", summary.highest(summary.best_imdb, NO_HISTORY)),
+        ("others", "Movie you love way more than other people", summary.compare_with_imdb("rate higher")),
+        ("others", "The most overrated movie you think", summary.compare_with_imdb("rate lower")),
+        # Watch next
+        ("watch_next", "Some old fashion", summary.wishlist_by_year("old")),
+        ("watch_next", "Highest rating", summary.highest(summary.wishlist_best_imdb, NO_WISHLIST)),
+        ("watch_next", "Most popular", summary.highest_box_office(summary.wishlist_best_boxoffice,
+                                                                  summary.wishlist_count, NO_WISHLIST)),
+        ("watch_next", "Something new", summary.wishlist_by_year("new")),
+    ] + [("watch_next", question, answer) for question, answer in recommendations]
+    movies = resolve_movies([movie_id for _, _, answer in picture_answers
+                             if type(answer) == list
+                             for movie_id in answer])
+
+    cards = empty_cards()
+
+    # Basic stats
+    cards["basic_stats"].append({"question": "Movies in your Watch History",
+                                 "answer": summary.history_count})
+    cards["basic_stats"].append({"question": "Movies you Watched This Year",
+                                 "answer": summary.watched_in_year(today.year)})
+    cards["basic_stats"].append({"question": "Days since you last watched a movie",
+                                 "answer": summary.days_since_last_watch(today)})
+    cards["basic_stats"].append({"question": "Movies you want to watch",
+                                 "answer": summary.wishlist_count})
+
+    for section, question, answer in picture_answers[:2]:
+        add_card(cards, section, question, answer, movies)
+    cards["favorite"].append({"question": "Your favorite genre",
+                              "answer": summary.favorite("genre")})
+    cards["favorite"].append({"question": "Your favorite director",
+                              "answer": summary.favorite("director")})
+    cards["favorite"].append({"question": "Your favorite language",
+                              "answer": summary.favorite("language")})
+    for section, question, answer in picture_answers[2:]:
+        add_card(cards, section, question, answer, movies)
+
+    return cards
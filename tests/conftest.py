@@ -0,0 +1,99 @@
+import os
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+
+# app reads its configuration when it is imported
+_db_dir = tempfile.mkdtemp(prefix="movie-tests-")
+os.environ["POSTGRESQL_URL"] = "sqlite:///" + os.path.join(_db_dir, "test.db")
+os.environ.setdefault("API_KEY", "test")
+os.environ["STATS_CACHE_BACKEND"] = "memory"
+# sessions of the test client go in the sessions table, not in flask_session/
+os.environ["SESSION_BACKEND"] = "sqlalchemy"
+
+import app as movie_app
+from helper import parse_boxoffice
+
+
+@pytest.fixture
+def db():
+    """A fresh SQLite database, inside an app context."""
+    with movie_app.app.app_context():
+        movie_app.db.create_all()
+        movie_app.stats_cache.clear()
+        yield movie_app.db
+        movie_app.db.session.remove()
+        movie_app.db.drop_all()
+
+
+def add_user(username):
+    user = movie_app.Users(username=username, password="x")
+    movie_app.db.session.add(user)
+    movie_app.db.session.flush()
+    return user.id
+
+
+def add_movie(title, year, genre="Drama", director="Someone", language="English"):
+    movie = movie_app.Movies(title=title, year=year, genre=genre, director=director, language=language,
+                             poster_url=f"http://posters/{title}.jpg")
+    movie_app.db.session.add(movie)
+    movie_app.db.session.flush()
+    movie_app.tag_movies([movie])
+    return movie
+
+
+def watch(user_id, movie, watch_date, personal_rating, imdb_rating, boxoffice):
+    return {"user_id": user_id, "movie_id": movie.id, "watch_date": watch_date,
+            "personal_rating": personal_rating, "comments": "", "imdb_rating": imdb_rating,
+            "boxoffice": boxoffice, "boxoffice_amount": parse_boxoffice(boxoffice)}
+
+
+def wish(user_id, movie, imdb_rating, boxoffice):
+    return {"user_id": user_id, "movie_id": movie.id, "comments": "", "imdb_rating": imdb_rating,
+            "boxoffice": boxoffice, "boxoffice_amount": parse_boxoffice(boxoffice)}
+
+
+@pytest.fixture
+def users(db):
+    """
+    {name: user id} of users whose rows hit the edge cases of the dashboard:
+    ties, empty tables, watches in the future, missing or zero box office and
+    movies with several genres.
+    """
+    today = date.today()
+    ids = {name: add_user(name)
+           for name in ("ties", "empty", "wishlist only", "future", "future only", "no box office")}
+    alpha = add_movie("Alpha", 1960, genre="Drama, Comedy", director="Ann Lee")
+    beta = add_movie("Beta", 1960, genre="Comedy, Action", director="Bo Chan")
+    gamma = add_movie("Gamma", 2015, genre="Sci-Fi", director="Ann Lee", language="French")
+    delta = add_movie("Delta", 2015, genre="Drama, Sci-Fi", director="Cy Dorn", language="English, French")
+    epsilon = add_movie("Epsilon", 1999, genre="Horror")
+
+    rows = [
+        # two favorites, two most watched and two biggest box offices
+        watch(ids["ties"], alpha, today - timedelta(days=3), 9, 7.5, "$1,000,000"),
+        watch(ids["ties"], alpha, today - timedelta(days=400), 6, 7.5, "$1,000,000"),
+        watch(ids["ties"], beta, today - timedelta(days=10), 9, 8.0, "$1,000,000"),
+        watch(ids["ties"], beta, today - timedelta(days=20), 8, 8.0, "$1,000,000"),
+        watch(ids["ties"], gamma, today - timedelta(days=30), 4, 8.0, "$20,000"),
+        watch(ids["future"], gamma, today + timedelta(days=5), 7, 8.0, "$20,000"),
+        watch(ids["future"], delta, today - timedelta(days=2), 5, 6.1, "$3,500"),
+        watch(ids["future"], epsilon, today + timedelta(days=40), None, None, "N/A"),
+        watch(ids["future only"], beta, today + timedelta(days=1), 6, 8.0, "$1,000,000"),
+        # directors tie, the genres with more than one name don't
+        watch(ids["no box office"], alpha, today, 7, 7.5, "N/A"),
+        watch(ids["no box office"], delta, today - timedelta(days=1), 7, 6.1, "$0"),
+    ]
+    wishes = [
+        wish(ids["ties"], delta, 6.1, "$3,500"),
+        wish(ids["ties"], epsilon, 6.1, "$3,500"),
+        wish(ids["wishlist only"], alpha, 7.5, "N/A"),
+        wish(ids["wishlist only"], gamma, None, "$0"),
+        wish(ids["wishlist only"], epsilon, 5.0, "N/A"),
+        wish(ids["no box office"], beta, 8.0, "N/A"),
+    ]
+    db.session.execute(movie_app.Watch_history.__table__.insert(), rows)
+    db.session.execute(movie_app.Wishlist.__table__.insert(), wishes)
+    db.session.commit()
+    return ids
@@ -0,0 +1,53 @@
+import app as movie_app
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+
+def count_passes(monkeypatch):
+    passes = []
+    export_chunks = movie_app.export_chunks
+
+    def counted(*args):
+        passes.append(args)
+        return export_chunks(*args)
+
+    monkeypatch.setattr(movie_app, "export_chunks", counted)
+    return passes
+
+
+def test_resumed_download_encodes_once(users, monkeypatch):
+    client = movie_app.app.test_client()
+    login(client, users["ties"])
+    full = client.get("/export?table=history&format=ndjson")
+    data, etag = full.data, full.headers["ETag"]
+    movie_app.stats_cache.clear()
+    passes = count_passes(monkeypatch)
+
+    # length unknown: one pass into a spooled file
+    part = client.get("/export?table=history&format=ndjson", headers={"Range": "bytes=10-", "If-Range": etag})
+    assert part.status_code == 206
+    assert part.data == data[10:]
+    assert part.headers["Content-Range"] == f"bytes 10-{len(data) - 1}/{len(data)}"
+    assert len(passes) == 1
+    assert movie_app.stats_cache.get(f"export-size:{etag.strip(chr(34))}") == len(data)
+
+    # length kept under the ETag: one pass, streamed
+    part = client.get("/export?table=history&format=ndjson", headers={"Range": "bytes=-5", "If-Range": etag})
+    assert part.data == data[-5:]
+    assert len(passes) == 2
+
+    unsatisfiable = client.get("/export?table=history&format=ndjson",
+                               headers={"Range": f"bytes={len(data)}-", "If-Range": etag})
+    assert unsatisfiable.status_code == 416
+
+
+def test_full_download_keeps_its_size(users):
+    client = movie_app.app.test_client()
+    login(client, users["ties"])
+    full = client.get("/export?table=wishlist&format=csv")
+    size = len(full.data)
+    etag = full.headers["ETag"].strip(chr(34))
+    assert movie_app.stats_cache.get(f"export-size:{etag}") == size
@@ -0,0 +1,44 @@
+import io
+
+import app as movie_app
+from importer import read_records
+
+IMDB_EXPORT = (
+    "Const,Your Rating,Date Rated,Title,URL,Title Type,IMDb Rating,Runtime (mins),Year,Genres\n"
+    "tt0087182,7,2024-02-01,Dune,https://www.imdb.com/title/tt0087182/,Movie,6.3,137,1984,Sci-Fi\n"
+    "tt1160419,9,2024-02-02,Dune,https://www.imdb.com/title/tt1160419/,Movie,8.0,155,2021,Sci-Fi\n"
+    ",8,2024-02-03,Alpha,,Movie,7.5,100,1960,Drama\n"
+)
+
+
+def test_upload_queues_unknown_movies(users):
+    user_id = users["empty"]
+    records = read_records(io.BytesIO(IMDB_EXPORT.encode()), "csv")
+    report = movie_app.import_history(user_id, records, fetch=False)
+    assert (report["imported"], report["rejected"], report["queued"]) == (3, 0, 3)
+
+    movies = {(movie.title, movie.year): movie for movie in movie_app.Movies.query}
+    # the remake is a movie of its own, the row without an IMDb id goes to the movie of that title and year
+    assert movies[("Dune", 1984)].imdb_id == "tt0087182"
+    assert movies[("Dune", 2021)].imdb_id == "tt1160419"
+    assert movie_app.Watch_history.query.filter_by(user_id=user_id, movie_id=movies[("Alpha", 1960)].id).count() == 1
+    assert movie_app.Enrichment_jobs.query.filter_by(status="queued").count() == 3
+
+
+def test_enrichment_fills_imported_rows(users):
+    user_id = users["empty"]
+    movie_app.import_history(user_id, read_records(io.BytesIO(IMDB_EXPORT.encode()), "csv"), fetch=False)
+    dune = movie_app.Movies.query.filter_by(imdb_id="tt1160419").one()
+    movie_app.get_stats_summary(user_id)
+
+    movie_app.apply_movie_metadata(dune, {"title": "Dune", "year": 2021, "genre": "Action, Sci-Fi",
+                                          "director": "Denis Villeneuve", "language": "English",
+                                          "poster": None, "imdb_id": "tt1160419", "imdb_rating": "8.0",
+                                          "boxoffice": "$108,897,830"})
+    movie_app.db.session.commit()
+
+    watch = movie_app.Watch_history.query.filter_by(user_id=user_id, movie_id=dune.id).one()
+    assert (watch.imdb_rating, watch.boxoffice_amount) == (8.0, 108897830)
+    summary = movie_app.get_stats_summary(user_id)
+    assert summary.highest_box_office(summary.best_boxoffice, summary.history_count, "") == [dune.id]
+    assert summary.history_count == 3
@@ -0,0 +1,65 @@
+import io
+
+import pytest
+
+import app as movie_app
+from posters import PosterCache, PosterUnavailable
+
+from conftest import add_movie, add_user
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def jpeg(width, height):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "red").save(output, "JPEG")
+    return output.getvalue()
+
+
+def cache_serving(tmp_path, monkeypatch, data, **options):
+    cache = PosterCache(str(tmp_path), **options)
+    monkeypatch.setattr(cache, "_download", lambda url: data)
+    return cache
+
+
+@pytest.mark.parametrize("data", [b"<html>not an image</html>", jpeg(300, 450)[:200]])
+def test_undecodable_posters_are_unavailable(tmp_path, monkeypatch, data):
+    cache = cache_serving(tmp_path, monkeypatch, data)
+    with pytest.raises(PosterUnavailable):
+        cache.thumbnail("http://posters/broken.jpg", 200)
+
+
+def test_decompression_bombs_are_unavailable(tmp_path, monkeypatch):
+    # Pillow refuses images of more than twice MAX_IMAGE_PIXELS outright
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    cache = cache_serving(tmp_path, monkeypatch, jpeg(300, 450))
+    with pytest.raises(PosterUnavailable):
+        cache.thumbnail("http://posters/bomb.jpg", 200)
+
+
+def test_posters_over_max_pixels_are_unavailable(tmp_path, monkeypatch):
+    cache = cache_serving(tmp_path, monkeypatch, jpeg(300, 450), max_pixels=300 * 449)
+    with pytest.raises(PosterUnavailable):
+        cache.thumbnail("http://posters/big.jpg", 200)
+
+
+def test_posters_are_resized(tmp_path, monkeypatch):
+    cache = cache_serving(tmp_path, monkeypatch, jpeg(300, 450))
+    path, mimetype, _ = cache.thumbnail("http://posters/ok.jpg", 200)
+    assert mimetype == "image/jpeg"
+    assert Image.open(path).size == (200, 300)
+
+
+def test_route_falls_back_to_the_original_url(db, tmp_path, monkeypatch):
+    user_id = add_user("posters")
+    movie = add_movie("Bomb", 2000)
+    db.session.commit()
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    monkeypatch.setattr(movie_app, "poster_cache", cache_serving(tmp_path, monkeypatch, jpeg(300, 450)))
+
+    client = movie_app.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    response = client.get(f"/poster/{movie.id}?w=200")
+    assert response.status_code == 302
+    assert response.headers["Location"] == movie.poster_url
@@ -0,0 +1,210 @@
+import json
+from datetime import date, timedelta
+
+import pytest
+
+import app as movie_app
+from stats_engine import NO_HISTORY, NO_WISHLIST, StatsSummary, add_card, build_cards, differences, empty_cards
+
+from conftest import add_movie, add_user, watch, wish
+
+USERS = ("ties", "empty", "wishlist only", "future", "future only", "no box office")
+
+
+def query_cards(user_id, today):
+    """The dashboard cards as the find_* queries answer them, one query per card."""
+    history, wishlist = movie_app.Watch_history, movie_app.Wishlist
+    picture_answers = [
+        ("favorite", "Your Favorite Movie", movie_app.find_highest(history, "personal_rating", user_id)),
+        ("favorite", "You can't stop re-watching", movie_app.most_watch(user_id)),
+        ("others", "Most popular movie you have watched", movie_app.find_highest_box_office(history, user_id)),
+        ("others", "Highest IMDb rating movie you have watched",
+         movie_app.find_highest(history, "imdb_rating", user_id)),
+        ("others", "Movie you love way more than other people",
+         movie_app.compare_personal_rating_with_imdb("rate higher", user_id)),
+        ("others", "The most overrated movie you think",
+         movie_app.compare_personal_rating_with_imdb("rate lower", user_id)),
+        ("watch_next", "Some old fashion", movie_app.find_oldest_or_newest_movie("old", wishlist, user_id)),
+        ("watch_next", "Highest rating", movie_app.find_highest(wishlist, "imdb_rating", user_id)),
+        ("watch_next", "Most popular", movie_app.find_highest_box_office(wishlist, user_id)),
+        ("watch_next", "Something new", movie_app.find_oldest_or_newest_movie("new", wishlist, user_id)),
+    ]
+    # the queries answer with titles, which are unique among the seeded movies
+    movies = {movie.title: (movie.title, movie.poster_url) for movie in movie_app.Movies.query}
+
+    cards = empty_cards()
+    cards["basic_stats"] += [
+        {"question": "Movies in your Watch History",
+         "answer": history.query.filter_by(user_id=user_id).count()},
+        {"question": "Movies you Watched This Year",
+         "answer": movie_app.count_watched_in_year(user_id, today.year)},
+        {"question": "Days since you last watched a movie", "answer": movie_app.find_most_recent_watch(user_id)},
+        {"question": "Movies you want to watch", "answer": wishlist.query.filter_by(user_id=user_id).count()},
+    ]
+    for section, question, answer in picture_answers[:2]:
+        add_card(cards, section, question, answer, movies)
+    for kind in movie_app.TAG_KINDS:
+        cards["favorite"].append({"question": f"Your favorite {kind}",
+                                  "answer": movie_app.find_favorite(kind, user_id)})
+    for section, question, answer in picture_answers[2:]:
+        add_card(cards, section, question, answer, movies)
+    return cards
+
+
+def titles(movie_ids):
+    return [movie_app.db.session.get(movie_app.Movies, movie_id).title for movie_id in movie_ids]
+
+
+def unordered(cards):
+    """cards with tied movies and tags in a fixed order, each movie keeping its poster."""
+    result = {}
+    for section, section_cards in cards.items():
+        result[section] = []
+        for card in section_cards:
+            card = dict(card)
+            answer = card["answer"]
+            if type(answer) == list:
+                posters = [card.pop(key) for key in ("poster_1", "poster_2") if key in card]
+                card["answer"] = sorted(zip(answer, posters or [card.pop("poster", None)] * len(answer)))
+            elif type(answer) == str and card["question"].startswith("Your favorite "):
+                card["answer"] = sorted(answer.split(", "))
+            result[section].append(card)
+    return result
+
+
+@pytest.mark.parametrize("name", USERS)
+def test_cards_match_queries(users, name):
+    today = date.today()
+    user_id = users[name]
+    summary = movie_app.load_stats_summary(user_id, today)
+    cards = build_cards(summary, movie_app.poster_resolver().resolve, today)
+    expected = query_cards(user_id, today)
+    for section in expected:
+        assert len(cards[section]) == len(expected[section]), section
+        for card, expected_card in zip(unordered(cards)[section], unordered(expected)[section]):
+            assert card == expected_card
+
+
+def test_edge_case_answers(users):
+    today = date.today()
+    ties = movie_app.load_stats_summary(users["ties"], today)
+    assert sorted(titles(ties.highest(ties.best_personal, ""))) == ["Alpha", "Beta"]
+    assert sorted(titles(ties.most_watched())) == ["Alpha", "Beta"]
+    assert ties.favorite("genre") == "Comedy"
+    assert sorted(titles(ties.highest_box_office(ties.best_boxoffice, ties.history_count, ""))) == ["Alpha", "Beta"]
+
+    future_only = movie_app.load_stats_summary(users["future only"], today)
+    assert future_only.days_since_last_watch(today) == NO_HISTORY
+
+    no_box_office = movie_app.load_stats_summary(users["no box office"], today)
+    assert sorted(no_box_office.favorite("director").split(", ")) == ["Ann Lee", "Cy Dorn"]
+    assert no_box_office.favorite("genre") == "Drama"
+    assert no_box_office.highest_box_office(no_box_office.best_boxoffice, no_box_office.history_count,
+                                            NO_HISTORY) == \
+        "You don't have any record with valid box office in your Watch History"
+
+    empty = build_cards(movie_app.load_stats_summary(users["empty"], today), movie_app.poster_resolver().resolve,
+                        today)
+    assert [card["answer"] for card in empty["basic_stats"]] == [0, 0, NO_HISTORY, 0]
+
+
+def test_stored_summary_follows_writes(users):
+    today = date.today()
+    user_id = users["ties"]
+    movie_app.get_stats_summary(user_id)
+    zeta = add_movie("Zeta", 1950, genre="Drama, Western")
+    movie_app.add_watch(watch(user_id, zeta, today - timedelta(days=1), 10, 9.9, "$5,000,000"), zeta)
+    movie_app.add_wish(wish(user_id, zeta, 9.9, "$5,000,000"), zeta)
+    movie_app.db.session.commit()
+
+    stored = movie_app.get_stats_summary(user_id)
+    assert differences(stored, movie_app.load_stats_summary(user_id, today), today) == []
+    assert stored.highest(stored.best_personal, "") == [zeta.id]
+
+
+def test_remakes_sharing_a_title_keep_their_posters(db):
+    today = date.today()
+    user_id = add_user("remakes")
+    original, remake = add_movie("Dune", 1984), add_movie("Dune", 2021)
+    original.poster_url, remake.poster_url = "http://posters/dune-1984.jpg", "http://posters/dune-2021.jpg"
+    rows = [watch(user_id, original, today - timedelta(days=2), 9, 6.3, "$30,925,690"),
+            watch(user_id, remake, today - timedelta(days=1), 9, 8.0, "$108,897,830")]
+    movie_app.db.session.execute(movie_app.Watch_history.__table__.insert(), rows)
+    movie_app.db.session.commit()
+
+    summary = movie_app.get_stats_summary(user_id)
+    assert sorted(summary.highest(summary.best_personal, "")) == sorted([original.id, remake.id])
+    assert summary.watch_counts == {original.id: 1, remake.id: 1}
+
+    cards = build_cards(summary, movie_app.poster_resolver().resolve, today)
+    favorite = next(card for card in cards["favorite_with_img_2"] if card["question"] == "Your Favorite Movie")
+    assert sorted(zip(favorite["answer"], (favorite["poster_1"], favorite["poster_2"]))) == [
+        ("Dune", "http://posters/dune-1984.jpg"), ("Dune", "http://posters/dune-2021.jpg")]
+    popular = next(card for card in cards["others_with_img"]
+                   if card["question"] == "Most popular movie you have watched")
+    assert popular["poster"] == "http://posters/dune-2021.jpg"
+
+
+def test_verify_stats_rebuilds_drifted_summary(users):
+    user_id = users["ties"]
+    movie_app.get_stats_summary(user_id)
+    row = movie_app.db.session.get(movie_app.User_stats, user_id)
+    drifted = StatsSummary.from_dict(json.loads(row.summary))
+    drifted.history_count += 1
+    row.summary = json.dumps(drifted.to_dict())
+    movie_app.db.session.commit()
+
+    output = movie_app.app.test_cli_runner().invoke(args=["verify-stats", "--user-id", str(user_id)]).output
+    assert "stored summary differs in history_count" in output
+    assert "0 mismatches, 1 stored summaries rebuilt" in output
+    assert movie_app.get_stats_summary(user_id).history_count == 5
+
+
+def test_summary_from_rows_without_a_database():
+    today = date(2024, 6, 15)
+    summary = StatsSummary()
+    # movie 1 watched twice, movie 2 once today and movie 3 in the future
+    summary.add_watch(1, date(2023, 12, 31), 9, 7.0, 1000, "Drama, Comedy", "Ann Lee", "English", today)
+    summary.add_watch(1, date(2024, 6, 1), 6, 7.0, 1000, "Drama, Comedy", "Ann Lee", "English", today)
+    summary.add_watch(2, today, 9, 9.5, None, "Drama", "Bo Chan", "English, French", today)
+    summary.add_watch(3, date(2024, 7, 1), None, None, 0, "Horror", "Cy Dorn", "English", today)
+    summary.add_wish(4, 1950, 8.0, 500)
+    summary.add_wish(5, 1950, 8.0, None)
+
+    assert (summary.history_count, summary.watched_in_year(2024), summary.days_since_last_watch(today)) == (4, 3, "0")
+    assert summary.days_since_last_watch(date(2024, 7, 3)) == "2"
+    assert summary.highest(summary.best_personal, NO_HISTORY) == [1, 2]
+    assert summary.most_watched() == [1]
+    assert summary.highest_box_office(summary.best_boxoffice, summary.history_count, NO_HISTORY) == [1]
+    assert summary.compare_with_imdb("rate higher") == [1]
+    assert summary.compare_with_imdb("rate lower") == [1]
+    assert summary.favorite("genre") == "Drama"
+    assert summary.favorite("language") == "English"
+    assert summary.wishlist_by_year("old") == [4, 5]
+    assert summary.highest(summary.wishlist_best_imdb, NO_WISHLIST) == [4, 5]
+
+    # stored as JSON, movie ids come back as ints
+    stored = StatsSummary.from_dict(json.loads(json.dumps(summary.to_dict())))
+    assert stored.watch_counts == {1: 2, 2: 1, 3: 1}
+    assert differences(stored, summary, today) == []
+
+
+def test_build_cards_resolves_movies_once():
+    today = date(2024, 6, 15)
+    summary = StatsSummary()
+    for movie_id in (1, 2, 3):
+        summary.add_watch(movie_id, today, 8, 8.0, 100, "Drama", "Ann Lee", "English", today)
+    summary.add_wish(4, 1999, 7.0, 100)
+
+    calls = []
+
+    def resolve(movie_ids):
+        calls.append(sorted(set(movie_ids)))
+        return {movie_id: (f"Movie {movie_id}", f"http://posters/{movie_id}.jpg") for movie_id in movie_ids}
+
+    cards = build_cards(summary, resolve, today)
+    assert calls == [[1, 2, 3, 4]]
+    # three tied movies are listed by title, without posters
+    assert {"question": "Your Favorite Movie", "answer": ["Movie 1", "Movie 2", "Movie 3"]} in cards["favorite"]
+    assert {"question": "Highest rating", "answer": ["Movie 4"],
+            "poster": "http://posters/4.jpg"} in cards["watch_next_with_img"]
@@ -0,0 +1,28 @@
+from datetime import date, timedelta
+
+from timeseries import streaks
+
+
+def days(first, count):
+    return [first + timedelta(days=offset) for offset in range(count)]
+
+
+def test_current_day_streak():
+    today = date(2024, 6, 15)
+    result = streaks(days(date(2024, 6, 1), 3) + days(date(2024, 6, 12), 3), "day", today)
+    assert result["longest"] == {"length": 3, "start": "2024-06-01", "end": "2024-06-03"}
+    assert result["current"] == {"length": 3, "start": "2024-06-12", "end": "2024-06-14"}
+
+
+def test_future_watches_are_left_out():
+    today = date(2024, 6, 15)
+    # watched the last two days, and logged the next five ahead of time
+    result = streaks(days(date(2024, 6, 13), 2) + days(date(2024, 6, 16), 5), "day", today)
+    assert result["longest"] == {"length": 2, "start": "2024-06-13", "end": "2024-06-14"}
+    assert result["current"] == {"length": 2, "start": "2024-06-13", "end": "2024-06-14"}
+
+    weeks = [date(2024, 6, 3), date(2024, 6, 10), date(2024, 6, 17), date(2024, 6, 24)]
+    result = streaks(weeks, "week", today)
+    assert result["longest"] == result["current"] == {"length": 2, "start": "2024-06-03", "end": "2024-06-10"}
+
+    assert streaks([date(2024, 7, 1)], "month", today) == {"longest": None, "current": None}
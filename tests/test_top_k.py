@@ -0,0 +1,59 @@
+from datetime import date, timedelta
+
+import app as movie_app
+
+from conftest import add_movie, add_user, watch
+
+
+def add_watches(user_id, ratings):
+    """ratings: [(movie, personal rating)], a day apart"""
+    today = date.today()
+    rows = [watch(user_id, movie, today - timedelta(days=day), rating, None, "N/A")
+            for day, (movie, rating) in enumerate(ratings)]
+    movie_app.db.session.execute(movie_app.Watch_history.__table__.insert(), rows)
+    movie_app.db.session.commit()
+
+
+def test_rewatches_count_once_with_their_best_value(db):
+    user_id = add_user("rewatcher")
+    alpha, beta = add_movie("Alpha", 1960), add_movie("Beta", 1970)
+    add_watches(user_id, [(alpha, 10), (alpha, 9), (beta, 8)])
+
+    ranking = movie_app.top_k(movie_app.Watch_history, "personal_rating", user_id, 2)
+    assert ranking == [(1, alpha.id, "Alpha", 10.0), (2, beta.id, "Beta", 8.0)]
+
+
+def test_ties_at_the_cutoff_are_all_listed(db):
+    user_id = add_user("ties")
+    alpha, beta, gamma, delta = (add_movie(title, 2000) for title in ("Alpha", "Beta", "Gamma", "Delta"))
+    add_watches(user_id, [(alpha, 9), (beta, 7), (gamma, 7), (gamma, 3), (delta, 5)])
+
+    ranking = movie_app.top_k(movie_app.Watch_history, "personal_rating", user_id, 2)
+    assert ranking == [(1, alpha.id, "Alpha", 9.0), (2, beta.id, "Beta", 7.0), (2, gamma.id, "Gamma", 7.0)]
+
+
+def test_remakes_sharing_a_title_rank_separately(db):
+    user_id = add_user("remakes")
+    original, remake = add_movie("Dune", 1984), add_movie("Dune", 2021)
+    add_watches(user_id, [(original, 6), (remake, 9)])
+
+    ranking = movie_app.top_k(movie_app.Watch_history, "personal_rating", user_id, 2)
+    assert ranking == [(1, remake.id, "Dune", 9.0), (2, original.id, "Dune", 6.0)]
+
+
+def test_stats_top_route(db):
+    user_id = add_user("route")
+    alpha, beta = add_movie("Alpha", 1960), add_movie("Beta", 1970)
+    add_watches(user_id, [(alpha, 10), (alpha, 9), (beta, 8)])
+
+    client = movie_app.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    response = client.get("/stats/top?list=history&metric=personal_rating&k=2")
+    assert response.status_code == 200
+    assert response.get_json()["results"] == [
+        {"rank": 1, "movie_id": alpha.id, "title": "Alpha", "value": 10.0},
+        {"rank": 2, "movie_id": beta.id, "title": "Beta", "value": 8.0},
+    ]
+    assert client.get("/stats/top?list=wishlist&metric=personal_rating").status_code == 400
+    assert client.get(f"/stats/top?k={movie_app.app.config['STATS_TOP_MAX_K'] + 1}").status_code == 400
@@ -0,0 +1,96 @@
+"""
+A user's watch history over time: watches, average personal rating and
+genre share per week, month or year, and watch streaks.
+
+The database does the bucketing, a GROUP BY on the first day of each
+watch's period (see watch_timeseries() in app.py), so only one row per
+period comes back however long the history is. This module fills in the
+periods without a watch, turns genre counts into shares and finds the
+streaks of consecutive periods with a watch. Everything it returns is plain
+JSON data, dates as ISO strings, so it can go into any stats cache backend.
+"""
+
+from datetime import date, timedelta
+
+PERIODS = ("week", "month", "year")
+
+
+def period_start(day, period):
+    """The first day of day's period: its Monday, the 1st of its month or January 1st."""
+    if period == "day":
+        return day
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    if period == "year":
+        return day.replace(month=1, day=1)
+    raise ValueError(f"Unknown period {period!r}")
+
+
+def next_start(start, period):
+    """The first day of the period after the one starting on start."""
+    if period == "day":
+        return start + timedelta(days=1)
+    if period == "week":
+        return start + timedelta(days=7)
+    if period == "month":
+        return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    if period == "year":
+        return date(start.year + 1, 1, 1)
+    raise ValueError(f"Unknown period {period!r}")
+
+
+def series(buckets, genre_counts, period, top_genres=5):
+    """
+    The periods from the first watch to the last, empty ones included, as
+    {"start", "watches", "average_rating", "genres"} dicts.
+
+    buckets are (start, watches, average rating) rows and genre_counts
+    (start, genre, watches) rows of the GROUP BY queries. A genre's share is
+    the part of the period's watches that are of that genre; a movie can
+    have several, so shares don't add up to 1. Each period keeps its
+    top_genres genres.
+    """
+    by_start = {start: (watches, rating) for start, watches, rating in buckets}
+    genres = {}
+    for start, genre, watches in genre_counts:
+        genres.setdefault(start, []).append((genre, watches))
+    if not by_start:
+        return []
+    result = []
+    start, last = min(by_start), max(by_start)
+    while start <= last:
+        watches, rating = by_start.get(start, (0, None))
+        shares = sorted(genres.get(start, ()), key=lambda pair: (-pair[1], pair[0]))[:top_genres]
+        result.append({"start": start.isoformat(), "watches": watches,
+                       "average_rating": round(rating, 2) if rating is not None else None,
+                       "genres": {genre: round(count / watches, 3) for genre, count in shares}})
+        start = next_start(start, period)
+    return result
+
+
+def streaks(starts, period, today):
+    """
+    The longest and the current run of consecutive periods with a watch, as
+    {"longest", "current"}, each {"length", "start", "end"} or None. starts
+    are the sorted first days of the periods with a watch; those after
+    today's period (watches dated in the future) don't count. A run is still
+    current while the period after its last one (today's at the latest)
+    hasn't ended.
+    """
+    this_period = period_start(today, period)
+    longest = current = None
+    run_start = previous = None
+    for start in starts:
+        if start > this_period:
+            break
+        if previous is None or next_start(previous, period) != start:
+            run_start, length = start, 0
+        length += 1
+        previous = start
+        if longest is None or length > longest["length"]:
+            longest = {"length": length, "start": run_start.isoformat(), "end": start.isoformat()}
+    if previous is not None and next_start(previous, period) >= this_period:
+        current = {"length": length, "start": run_start.isoformat(), "end": previous.isoformat()}
+    return {"longest": longest, "current": current}